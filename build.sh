@@ -15,4 +15,10 @@ python manage.py migrate
 python manage.py loaddata province_fixture.json --ignorenonexistent || echo "Province già caricate o errore durante il caricamento"
 
 # Assegna provincia di default agli utenti senza provincia
-python manage.py assign_default_provincia || echo "Errore nell'assegnazione provincia di default"
\ No newline at end of file
+python manage.py assign_default_provincia || echo "Errore nell'assegnazione provincia di default"
+
+# Compila la tabella dei sinonimi (evita di caricare WordNet in ogni worker)
+python manage.py compila_sinonimi || echo "Tabella sinonimi non compilata: il matching userà WordNet a runtime"
+
+# Popola la tabella delle compatibilità tra annunci (usata dal ricalcolo catene su richiesta)
+python manage.py ricostruisci_compatibilita || echo "Tabella compatibilità non ricostruita"
@@ -12,6 +12,7 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'scambio_sito.settings')
 django.setup()
 
+from scambi.dettagli_ciclo import annunci_ids_dettagli
 from scambi.models import CicloScambio, Annuncio, UserProfile
 from django.contrib.auth.models import User
 
@@ -30,15 +31,7 @@ print(f"   - Cicli validi: {cicli_validi.count()}")
 print("\n2. ANNUNCI REFERENZIATI NEI CICLI:")
 annunci_ids_nei_cicli = set()
 for ciclo in cicli_validi:
-    dettagli = ciclo.dettagli
-    if 'scambi' in dettagli:
-        for scambio in dettagli['scambi']:
-            oggetti = scambio.get('oggetti', [])
-            for oggetto in oggetti:
-                if 'offerto' in oggetto and 'id' in oggetto['offerto']:
-                    annunci_ids_nei_cicli.add(oggetto['offerto']['id'])
-                if 'richiesto' in oggetto and 'id' in oggetto['richiesto']:
-                    annunci_ids_nei_cicli.add(oggetto['richiesto']['id'])
+    annunci_ids_nei_cicli.update(annunci_ids_dettagli(ciclo.dettagli))
 
 print(f"   - Annunci totali referenziati: {len(annunci_ids_nei_cicli)}")
 
@@ -104,15 +97,7 @@ print("\n4. CICLI CON ANNUNCI INATTIVI:")
 cicli_con_problemi = 0
 for ciclo in cicli_validi[:20]:  # Primi 20 cicli
     annunci_ciclo = set()
-    dettagli = ciclo.dettagli
-    if 'scambi' in dettagli:
-        for scambio in dettagli['scambi']:
-            oggetti = scambio.get('oggetti', [])
-            for oggetto in oggetti:
-                if 'offerto' in oggetto and 'id' in oggetto['offerto']:
-                    annunci_ciclo.add(oggetto['offerto']['id'])
-                if 'richiesto' in oggetto and 'id' in oggetto['richiesto']:
-                    annunci_ciclo.add(oggetto['richiesto']['id'])
+    annunci_ciclo.update(annunci_ids_dettagli(ciclo.dettagli))
 
     # Controlla quanti sono inattivi
     annunci_inattivi_ciclo = [aid for aid in annunci_ciclo if aid in annunci_dict and not annunci_dict[aid].attivo]
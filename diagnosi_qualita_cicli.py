@@ -10,6 +10,7 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'scambio_sito.settings')
 django.setup()
 
+from scambi.dettagli_ciclo import annunci_ids_dettagli
 from scambi.models import CicloScambio, Annuncio
 from scambi.matching import converti_ciclo_db_a_view_format, calcola_qualita_ciclo
 
@@ -24,15 +25,7 @@ print(f"\n📊 Cicli validi nel DB: {cicli_validi.count()}")
 # 2. Pre-carica annunci (come nel codice di produzione)
 annunci_ids = set()
 for ciclo_db in cicli_validi:
-    dettagli = ciclo_db.dettagli
-    if 'scambi' in dettagli:
-        for scambio in dettagli['scambi']:
-            oggetti = scambio.get('oggetti', [])
-            for oggetto in oggetti:
-                if 'offerto' in oggetto and 'id' in oggetto['offerto']:
-                    annunci_ids.add(oggetto['offerto']['id'])
-                if 'richiesto' in oggetto and 'id' in oggetto['richiesto']:
-                    annunci_ids.add(oggetto['richiesto']['id'])
+    annunci_ids.update(annunci_ids_dettagli(ciclo_db.dettagli))
 
 annunci_dict = {a.id: a for a in Annuncio.objects.filter(id__in=annunci_ids)}
 print(f"📦 Pre-caricati {len(annunci_dict)} annunci")
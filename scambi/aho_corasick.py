@@ -0,0 +1,106 @@
+"""
+Automa di Aho-Corasick per la ricerca di più termini in un solo passaggio.
+
+L'automa viene costruito una volta (all'import di synonym_matcher) a partire dal
+dizionario dei termini composti: la scansione di un titolo costa O(lunghezza del
+titolo + occorrenze trovate), indipendentemente dal numero di termini.
+
+Le occorrenze vengono accettate solo a parola intera: "smart tv" non viene
+trovato in "smart tvbox", "dash cam" non viene trovato in "dash camera".
+"""
+from collections import deque
+
+
+def _confine_parola(testo, posizione):
+    """True se in quella posizione del testo non c'è un carattere di parola"""
+    if posizione < 0 or posizione >= len(testo):
+        return True
+    carattere = testo[posizione]
+    return not (carattere.isalnum() or carattere == '_')
+
+
+class AhoCorasick:
+    """
+    Automa multi-pattern con transizioni in dizionari per stato.
+
+    Uso:
+        automa = AhoCorasick(['smart tv', 'hard disk'])
+        automa.cerca('vendo smart tv 55 pollici')   # {'smart tv'}
+    """
+
+    def __init__(self, termini=()):
+        self.transizioni = [{}]     # stato -> {carattere: stato}
+        self.fallimento = [0]       # stato -> stato di fallimento
+        self.uscite = [()]          # stato -> termini che terminano in questo stato
+        self.termini = set()
+
+        for termine in termini:
+            self._aggiungi(termine)
+        self._collega_fallimenti()
+
+    def __len__(self):
+        return len(self.termini)
+
+    def _aggiungi(self, termine):
+        """Inserisce un termine nel trie"""
+        termine = termine.strip().lower()
+        if not termine or termine in self.termini:
+            return
+        self.termini.add(termine)
+
+        stato = 0
+        for carattere in termine:
+            prossimo = self.transizioni[stato].get(carattere)
+            if prossimo is None:
+                prossimo = len(self.transizioni)
+                self.transizioni.append({})
+                self.fallimento.append(0)
+                self.uscite.append(())
+                self.transizioni[stato][carattere] = prossimo
+            stato = prossimo
+        self.uscite[stato] = self.uscite[stato] + (termine,)
+
+    def _collega_fallimenti(self):
+        """Calcola i link di fallimento in ampiezza e propaga le uscite"""
+        coda = deque(self.transizioni[0].values())
+        while coda:
+            stato = coda.popleft()
+            for carattere, figlio in self.transizioni[stato].items():
+                coda.append(figlio)
+
+                ripiego = self.fallimento[stato]
+                while ripiego and carattere not in self.transizioni[ripiego]:
+                    ripiego = self.fallimento[ripiego]
+                destinazione = self.transizioni[ripiego].get(carattere, 0)
+                self.fallimento[figlio] = destinazione if destinazione != figlio else 0
+
+                if self.uscite[self.fallimento[figlio]]:
+                    self.uscite[figlio] = self.uscite[figlio] + self.uscite[self.fallimento[figlio]]
+
+    def occorrenze(self, testo):
+        """
+        Genera le occorrenze (inizio, fine, termine) a parola intera nel testo.
+        Il testo deve essere già in minuscolo.
+        """
+        transizioni = self.transizioni
+        fallimento = self.fallimento
+        uscite = self.uscite
+
+        stato = 0
+        for posizione, carattere in enumerate(testo):
+            while stato and carattere not in transizioni[stato]:
+                stato = fallimento[stato]
+            stato = transizioni[stato].get(carattere, 0)
+
+            if not uscite[stato]:
+                continue
+            if not _confine_parola(testo, posizione + 1):
+                continue
+            for termine in uscite[stato]:
+                inizio = posizione + 1 - len(termine)
+                if _confine_parola(testo, inizio - 1):
+                    yield inizio, posizione + 1, termine
+
+    def cerca(self, testo):
+        """Insieme dei termini presenti nel testo (a parola intera)"""
+        return {termine for _, _, termine in self.occorrenze(testo.lower())}
@@ -0,0 +1,156 @@
+"""
+Kernel "a matrice" per le compatibilità offerta × richiesta.
+
+Le richieste indicizzate da KeywordIndex vengono numerate in ordine di id e
+ogni lista dell'indice (token, sinonimo, token parziale, categoria, utente)
+diventa una bitmask su quelle posizioni (un int Python). Per ogni offerta la
+riga della matrice di compatibilità si ottiene con poche operazioni bit a bit
+su interi lunghi, eseguite in C, invece di una chiamata a tipo_match per coppia:
+
+    specifico  = richieste con TUTTE le parole presenti nell'offerta: conteggio
+                 bit-sliced delle parole in comune, confrontato con il numero
+                 di parole di ogni richiesta
+    parziale   = OR delle liste dei token parzialmente compatibili, meno specifico
+    sinonimo   = OR delle liste delle classi di sinonimi, meno i precedenti
+    categoria  = lista della categoria dell'offerta (richieste cerca_per_categoria)
+
+La classificazione è identica a KeywordIndex.tipo_match / oggetti_compatibili_con_tipo.
+
+Le liste sono bitmask su int Python e non matrici sparse CSR di NumPy/SciPy:
+le due librerie non sono dipendenze del progetto (requirements.txt), e con
+righe così sparse le operazioni bit a bit sugli interi fanno la stessa algebra
+degli insiemi senza conversioni e senza una dipendenza binaria in più sul deploy.
+"""
+
+
+def _bitmask(posizioni):
+    """Bitmask con i bit delle posizioni indicate"""
+    mask = 0
+    for posizione in posizioni:
+        mask |= 1 << posizione
+    return mask
+
+
+def posizioni_bit(mask):
+    """Posizioni dei bit a 1 della mask, in ordine crescente"""
+    bit = bin(mask)[:1:-1]
+    posizione = bit.find('1')
+    while posizione != -1:
+        yield posizione
+        posizione = bit.find('1', posizione + 1)
+
+
+class CompatibilityKernel:
+    """
+    Matrice di compatibilità calcolata a righe di bitmask sulle richieste di un KeywordIndex.
+
+    Uso:
+        kernel = CompatibilityKernel(indice)
+        for offerta, richiesta, tipo_match in kernel.coppie_compatibili(offerte):
+            ...
+    """
+
+    TIPI_MATCH = ('specifico', 'parziale', 'sinonimo', 'categoria')
+
+    def __init__(self, indice):
+        self.indice = indice
+        self.richieste = [indice.richieste[rid] for rid in sorted(indice.richieste)]
+        posizione = {r.id: i for i, r in enumerate(self.richieste)}
+
+        def maschere(liste):
+            return {chiave: _bitmask(posizione[rid] for rid in ids) for chiave, ids in liste.items()}
+
+        self.tutte = (1 << len(self.richieste)) - 1
+        self.per_token = maschere(indice.per_token)
+        self.per_sinonimo = maschere(indice.per_sinonimo)
+        self.per_categoria = maschere(indice.per_categoria)
+        self.per_parziale = maschere(indice.vocabolario_parziale)
+
+        per_utente = {}
+        for i, richiesta in enumerate(self.richieste):
+            per_utente[richiesta.utente_id] = per_utente.get(richiesta.utente_id, 0) | (1 << i)
+        self.per_utente = per_utente
+
+        # Richieste con parole chiave (le uniche che possono avere match sul titolo)
+        # e piani di bit del numero di parole di ciascuna
+        self.testuali = 0
+        self.piani_lunghezza = []
+        for i, richiesta in enumerate(self.richieste):
+            if richiesta.cerca_per_categoria:
+                continue
+            n_parole = len(indice.parole_chiave(richiesta))
+            if not n_parole:
+                continue
+            self.testuali |= 1 << i
+            piano = 0
+            while n_parole:
+                if piano == len(self.piani_lunghezza):
+                    self.piani_lunghezza.append(0)
+                if n_parole & 1:
+                    self.piani_lunghezza[piano] |= 1 << i
+                n_parole >>= 1
+                piano += 1
+
+    def _maschera_specifico(self, parole):
+        """Richieste le cui parole sono tutte contenute in quelle dell'offerta"""
+        piani = [0] * len(self.piani_lunghezza)
+        for parola in parole:
+            riporto = self.per_token.get(parola)
+            if not riporto:
+                continue
+            # Somma bit-sliced: ogni piano è un bit del conteggio di ogni richiesta
+            for i in range(len(piani)):
+                piani[i], riporto = piani[i] ^ riporto, piani[i] & riporto
+                if not riporto:
+                    break
+
+        uguali = self.testuali
+        for conteggio, lunghezza in zip(piani, self.piani_lunghezza):
+            uguali &= self.tutte ^ (conteggio ^ lunghezza)
+            if not uguali:
+                break
+        return uguali
+
+    def riga(self, offerta):
+        """
+        Riga della matrice per un'offerta.
+
+        Returns:
+            tuple: bitmask (specifico, parziale, sinonimo, categoria), disgiunte,
+                   già private delle richieste dello stesso utente
+        """
+        indice = self.indice
+        ammesse = self.tutte ^ self.per_utente.get(offerta.utente_id, 0)
+
+        specifico = self._maschera_specifico(indice.parole_chiave(offerta)) & ammesse
+
+        parziale = 0
+        for token in indice.token_parziali_annuncio(offerta):
+            parziale |= self.per_parziale.get(token, 0)
+        parziale &= ammesse & ~specifico
+
+        sinonimo = 0
+        for termine in indice.sinonimi_chiave(offerta):
+            sinonimo |= self.per_sinonimo.get(termine, 0)
+        sinonimo &= ammesse & ~(specifico | parziale)
+
+        categoria = 0
+        if offerta.categoria_id:
+            categoria = self.per_categoria.get(offerta.categoria_id, 0) & ammesse
+
+        return specifico, parziale, sinonimo, categoria
+
+    def coppie_compatibili(self, offerte):
+        """
+        Genera le coppie (offerta, richiesta, tipo_match) compatibili, nello
+        stesso ordine di KeywordIndex.coppie_compatibili.
+        """
+        for offerta in offerte:
+            # Le quattro maschere sono disgiunte: basta unirne le posizioni in ordine
+            compatibili = sorted(
+                (posizione, tipo_match)
+                for tipo_match, mask in zip(self.TIPI_MATCH, self.riga(offerta))
+                for posizione in posizioni_bit(mask)
+            )
+            for posizione, tipo_match in compatibili:
+                yield offerta, self.richieste[posizione], tipo_match
@@ -0,0 +1,653 @@
+"""
+Motore di enumerazione dei cicli sul grafo delle compatibilità.
+
+Alternativa a CycleFinder._trova_cicli_da_nodo (DFS ricorsivo da ogni nodo):
+- ogni ciclo viene trovato UNA sola volta, partendo dal suo nodo minimo
+  (partenza canonica: il percorso attraversa solo nodi con indice > partenza)
+- DFS iterativa su adiacenza compatta CSR (array di interi), senza copie del percorso
+- insieme dei visitati come maschera per indice di nodo (bytearray)
+- potatura con la distanza minima verso la partenza (BFS sul grafo inverso):
+  i rami che non possono chiudersi entro max_length vengono scartati subito
+- solo i nodi delle componenti fortemente connesse non banali vengono visitati;
+  le componenti (o gruppi di partenze) possono essere distribuite su più processi
+- modalità top-K (cicli_migliori): ricerca best-first guidata dal punteggio
+  degli archi, con budget di espansioni e di tempo
+- ricerca per singolo utente (cicli_per_utente): meet-in-the-middle tra percorsi
+  in avanti e all'indietro, per il ricalcolo on-demand
+- ricerca per arco (cicli_con_arco): solo i cicli che usano un arco aggiunto,
+  per il calcolo incrementale guidato dalle differenze del grafo
+- multigrafo etichettato (cicli_multigrafo): gli archi portano le coppie
+  (offerta_id, richiesta_id, tipo_match), restituite insieme al ciclo
+
+Le funzioni sono pure (nessun accesso al database), così possono girare
+anche in processi separati.
+"""
+import heapq
+import time
+from array import array
+from collections import defaultdict, deque
+
+
+# Motori disponibili per calcola_cicli --engine
+MOTORE_DFS = 'dfs'
+MOTORE_CANONICO = 'canonico'
+MOTORE_TOPK = 'topk'
+MOTORE_MULTIGRAFO = 'multigrafo'
+MOTORI_CICLI = (MOTORE_DFS, MOTORE_CANONICO, MOTORE_TOPK, MOTORE_MULTIGRAFO)
+
+# Punteggio massimo di un arco (calcola_punteggio_qualita_avanzato: 40+25+15+20)
+PUNTEGGIO_MASSIMO_ARCO = 100
+
+
+class GrafoCSR:
+    """
+    Grafo diretto in formato CSR (compressed sparse row).
+
+    I nodi sono gli user_id ordinati; internamente si usano gli indici 0..n-1.
+    I vicini di ogni nodo sono ordinati per indice, così l'ordine di visita
+    è lo stesso della DFS classica sul grafo con liste ordinate.
+    """
+
+    def __init__(self, grafo):
+        nodi = set(grafo)
+        for vicini in grafo.values():
+            nodi.update(vicini)
+
+        self.nodi = sorted(nodi)
+        self.indice = {user_id: i for i, user_id in enumerate(self.nodi)}
+
+        self.offset, self.adiacenti = self._comprimi(
+            {self.indice[u]: [self.indice[v] for v in vicini] for u, vicini in grafo.items()}
+        )
+
+        inverso = {}
+        for u, vicini in grafo.items():
+            for v in vicini:
+                inverso.setdefault(self.indice[v], []).append(self.indice[u])
+        self.offset_inverso, self.adiacenti_inverso = self._comprimi(inverso)
+
+    def _comprimi(self, liste):
+        """Converte {indice: [indici vicini]} in (offset, adiacenti)"""
+        offset = array('l', [0])
+        adiacenti = array('l')
+        for i in range(len(self.nodi)):
+            adiacenti.extend(sorted(liste.get(i, ())))
+            offset.append(len(adiacenti))
+        return offset, adiacenti
+
+    def __len__(self):
+        return len(self.nodi)
+
+    def vicini(self, i):
+        return self.adiacenti[self.offset[i]:self.offset[i + 1]]
+
+    def predecessori(self, i):
+        return self.adiacenti_inverso[self.offset_inverso[i]:self.offset_inverso[i + 1]]
+
+
+def distanze_verso_partenza(csr, partenza, max_length):
+    """
+    BFS sul grafo inverso: numero minimo di archi da ogni nodo (> partenza)
+    verso la partenza, limitato a max_length - 1.
+
+    Returns:
+        dict: indice nodo -> distanza (solo nodi che possono chiudere un ciclo)
+    """
+    distanze = {partenza: 0}
+    coda = deque([partenza])
+
+    while coda:
+        nodo = coda.popleft()
+        d = distanze[nodo] + 1
+        if d >= max_length:
+            continue
+        for pred in csr.predecessori(nodo):
+            if pred > partenza and pred not in distanze:
+                distanze[pred] = d
+                coda.append(pred)
+
+    return distanze
+
+
+def cicli_da_partenza(csr, partenza, max_length, visitati=None):
+    """
+    Genera i cicli (liste di indici) il cui nodo minimo è `partenza`.
+
+    I cicli escono nello stesso ordine della DFS ricorsiva di CycleFinder,
+    già normalizzati (iniziano dal nodo minimo).
+    """
+    distanze = distanze_verso_partenza(csr, partenza, max_length)
+    if len(distanze) < 2:
+        return
+
+    offset = csr.offset
+    adiacenti = csr.adiacenti
+    if visitati is None:
+        visitati = bytearray(len(csr))
+
+    percorso = [partenza]
+    pila = [offset[partenza]]      # prossima posizione da esplorare per ogni livello
+    visitati[partenza] = 1
+
+    while pila:
+        nodo = percorso[-1]
+        pos = pila[-1]
+        fine = offset[nodo + 1]
+        successivo = None
+
+        while pos < fine:
+            vicino = adiacenti[pos]
+            pos += 1
+
+            if vicino == partenza:
+                if len(percorso) >= 2:
+                    yield list(percorso)
+                continue
+
+            if vicino < partenza or visitati[vicino]:
+                continue
+
+            # Potatura: il ciclo chiuso passando da `vicino` avrebbe almeno
+            # len(percorso) + distanza nodi
+            distanza = distanze.get(vicino)
+            if distanza is None or len(percorso) + distanza > max_length:
+                continue
+
+            successivo = vicino
+            break
+
+        if successivo is None:
+            pila.pop()
+            visitati[percorso.pop()] = 0
+        else:
+            pila[-1] = pos
+            percorso.append(successivo)
+            pila.append(offset[successivo])
+            visitati[successivo] = 1
+
+
+def componenti_fortemente_connesse(grafo):
+    """
+    Componenti fortemente connesse del grafo {user_id: [user_id]} (Tarjan iterativo).
+
+    Returns:
+        list: componenti come liste ordinate di user_id
+    """
+    nodi = set(grafo)
+    for vicini in grafo.values():
+        nodi.update(vicini)
+
+    indice = {}
+    minimo = {}
+    pila = []
+    in_pila = set()
+    componenti = []
+    contatore = 0
+
+    for radice in sorted(nodi):
+        if radice in indice:
+            continue
+
+        indice[radice] = minimo[radice] = contatore
+        contatore += 1
+        pila.append(radice)
+        in_pila.add(radice)
+        lavoro = [(radice, iter(grafo.get(radice, ())))]
+
+        while lavoro:
+            nodo, vicini = lavoro[-1]
+            for vicino in vicini:
+                if vicino not in indice:
+                    indice[vicino] = minimo[vicino] = contatore
+                    contatore += 1
+                    pila.append(vicino)
+                    in_pila.add(vicino)
+                    lavoro.append((vicino, iter(grafo.get(vicino, ()))))
+                    break
+                if vicino in in_pila:
+                    minimo[nodo] = min(minimo[nodo], indice[vicino])
+            else:
+                lavoro.pop()
+                if lavoro:
+                    padre = lavoro[-1][0]
+                    minimo[padre] = min(minimo[padre], minimo[nodo])
+
+                if minimo[nodo] == indice[nodo]:
+                    componente = []
+                    while True:
+                        membro = pila.pop()
+                        in_pila.discard(membro)
+                        componente.append(membro)
+                        if membro == nodo:
+                            break
+                    componenti.append(sorted(componente))
+
+    return componenti
+
+
+def componenti_cicliche(grafo):
+    """
+    Componenti fortemente connesse non banali (almeno 2 utenti), ordinate per
+    utente minimo: solo i loro nodi possono far parte di un ciclo.
+    """
+    componenti = [c for c in componenti_fortemente_connesse(grafo) if len(c) >= 2]
+    componenti.sort(key=lambda c: c[0])
+    return componenti
+
+
+def sottografo(grafo, nodi):
+    """Restrizione del grafo agli archi interni all'insieme di nodi"""
+    nodi = set(nodi)
+    return {
+        u: [v for v in grafo.get(u, ()) if v in nodi]
+        for u in sorted(nodi)
+    }
+
+
+# Componenti con almeno tanti nodi vengono divise per nodo di partenza tra i worker
+SOGLIA_PARTIZIONE = 50
+
+
+def _suddividi_compiti(grafo, componenti, partenze, workers):
+    """
+    Prepara i compiti (sottografo, partenze) per i worker.
+
+    Le componenti piccole vengono raggruppate fino a SOGLIA_PARTIZIONE nodi,
+    quelle grandi vengono divise per nodo di partenza in modo alternato
+    (i nodi minimi sono i più costosi, così il carico si distribuisce).
+    """
+    compiti = []
+    gruppo_nodi = []
+    gruppo_partenze = []
+
+    for componente in componenti:
+        # Il nodo massimo della componente non può essere minimo di nessun ciclo
+        candidate = [u for u in componente[:-1] if partenze is None or u in partenze]
+        if not candidate:
+            continue
+
+        if len(componente) >= SOGLIA_PARTIZIONE:
+            sotto = sottografo(grafo, componente)
+            parti = max(1, min(workers * 4, len(candidate)))
+            for i in range(parti):
+                compiti.append((sotto, candidate[i::parti]))
+            continue
+
+        gruppo_nodi.extend(componente)
+        gruppo_partenze.extend(candidate)
+        if len(gruppo_nodi) >= SOGLIA_PARTIZIONE:
+            compiti.append((sottografo(grafo, gruppo_nodi), gruppo_partenze))
+            gruppo_nodi, gruppo_partenze = [], []
+
+    if gruppo_partenze:
+        compiti.append((sottografo(grafo, gruppo_nodi), gruppo_partenze))
+
+    return compiti
+
+
+def _cicli_per_partenze(compito):
+    """
+    Eseguito nei worker: cicli di un sottografo per un gruppo di partenze.
+
+    Returns:
+        dict: user_id di partenza -> lista di cicli (liste di user_id)
+    """
+    sotto, partenze, max_length = compito
+    csr = GrafoCSR(sotto)
+    nodi = csr.nodi
+    visitati = bytearray(len(csr))
+
+    risultati = {}
+    for user_id in partenze:
+        risultati[user_id] = [
+            [nodi[j] for j in ciclo]
+            for ciclo in cicli_da_partenza(csr, csr.indice[user_id], max_length, visitati)
+        ]
+    return risultati
+
+
+def enumera_cicli(grafo, max_length=6, partenze=None, workers=1):
+    """
+    Genera tutti i cicli semplici (2..max_length utenti) del grafo {user_id: [user_id]}.
+
+    Il grafo viene prima ridotto alle componenti fortemente connesse non banali.
+    Con workers > 1 i compiti vengono distribuiti su un ProcessPoolExecutor;
+    i risultati vengono riuniti per utente di partenza crescente, quindi
+    l'ordine dei cicli non dipende dal numero di worker.
+
+    Args:
+        grafo: dizionario di adiacenza di CycleFinder
+        max_length: lunghezza massima dei cicli
+        partenze: se indicato, solo i cicli il cui utente minimo è in questo insieme
+        workers: numero di processi (1 = tutto nel processo corrente)
+
+    Yields:
+        list: user_id del ciclo, normalizzato a partire dal minimo
+    """
+    componenti = componenti_cicliche(grafo)
+    compiti = _suddividi_compiti(grafo, componenti, partenze, max(1, workers))
+
+    if workers > 1 and len(compiti) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        per_partenza = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for risultati in pool.map(_cicli_per_partenze, [c + (max_length,) for c in compiti]):
+                per_partenza.update(risultati)
+
+        for user_id in sorted(per_partenza):
+            yield from per_partenza[user_id]
+        return
+
+    # Sequenziale: un CSR per compito, partenze visitate in ordine crescente globale
+    grafi = []
+    ordine = []
+    for sotto, partenze_compito in compiti:
+        csr = GrafoCSR(sotto)
+        grafi.append(csr)
+        ordine.extend((user_id, csr) for user_id in partenze_compito)
+
+    visitati = {}
+    for user_id, csr in sorted(ordine, key=lambda x: x[0]):
+        maschera = visitati.setdefault(id(csr), bytearray(len(csr)))
+        nodi = csr.nodi
+        for ciclo in cicli_da_partenza(csr, csr.indice[user_id], max_length, maschera):
+            yield [nodi[j] for j in ciclo]
+
+
+def costo_arco(punteggio):
+    """
+    Costo di un arco per la ricerca top-K: 1 (arco perfetto) .. 2 (punteggio nullo).
+    Il costo di un ciclo cresce con la lunghezza e cala con la qualità.
+    """
+    punteggio = min(max(punteggio or 0, 0), PUNTEGGIO_MASSIMO_ARCO)
+    return 1 + (PUNTEGGIO_MASSIMO_ARCO - punteggio) / PUNTEGGIO_MASSIMO_ARCO
+
+
+def cicli_migliori(grafo, punteggi, max_length=6, k_per_utente=20, k_globale=None,
+                   max_espansioni=200000, tempo_max=None):
+    """
+    Ricerca best-first dei cicli migliori entro un budget.
+
+    I percorsi parziali (da partenza canonica) vengono espansi in ordine di
+    costo crescente (vedi costo_arco), quindi i cicli escono dal più corto e
+    di qualità più alta al peggiore. Un ciclo viene tenuto se almeno uno dei
+    suoi utenti ha meno di k_per_utente cicli; la ricerca si ferma a k_globale
+    cicli oppure quando il budget di espansioni o di tempo è esaurito.
+
+    Args:
+        grafo: dizionario di adiacenza di CycleFinder
+        punteggi: {(user_da, user_a): punteggio 0..100} per ogni arco
+        max_length: lunghezza massima dei cicli
+        k_per_utente: cicli massimi per utente (None = nessun limite)
+        k_globale: cicli massimi in totale (None = nessun limite)
+        max_espansioni: percorsi parziali espansi al massimo
+        tempo_max: secondi massimi di ricerca (None = nessun limite)
+
+    Returns:
+        tuple: (lista di (user_ids, costo), statistiche)
+    """
+    inizio = time.time()
+    statistiche = {'espansioni': 0, 'cicli': 0, 'scartati': 0, 'interrotto': None}
+
+    ridotto = {}
+    for componente in componenti_cicliche(grafo):
+        ridotto.update(sottografo(grafo, componente))
+    if not ridotto:
+        return [], statistiche
+
+    csr = GrafoCSR(ridotto)
+    nodi = csr.nodi
+    offset = csr.offset
+    adiacenti = csr.adiacenti
+    costi = array('d', (0.0 for _ in adiacenti))
+    for i, user_id in enumerate(nodi):
+        for pos in range(offset[i], offset[i + 1]):
+            costi[pos] = costo_arco(punteggi.get((user_id, nodi[adiacenti[pos]]), 0))
+
+    contatore = 0
+    frontiera = []
+    for i in range(len(nodi)):
+        frontiera.append((0.0, contatore, False, (i,)))
+        contatore += 1
+    heapq.heapify(frontiera)
+
+    distanze_per_partenza = {}
+    gia_visti = set()
+    cicli_per_utente = defaultdict(int)
+    cicli = []
+
+    while frontiera:
+        costo, _, chiuso, percorso = heapq.heappop(frontiera)
+
+        if chiuso:
+            chiave = frozenset(percorso)
+            if chiave in gia_visti:
+                continue
+            gia_visti.add(chiave)
+
+            utenti = [nodi[j] for j in percorso]
+            if k_per_utente is not None and all(cicli_per_utente[u] >= k_per_utente for u in utenti):
+                statistiche['scartati'] += 1
+                continue
+
+            for u in utenti:
+                cicli_per_utente[u] += 1
+            cicli.append((utenti, costo))
+
+            if k_globale is not None and len(cicli) >= k_globale:
+                statistiche['interrotto'] = 'k_globale'
+                break
+            continue
+
+        if statistiche['espansioni'] >= max_espansioni:
+            statistiche['interrotto'] = 'espansioni'
+            break
+        if tempo_max is not None and statistiche['espansioni'] % 1000 == 0 and time.time() - inizio > tempo_max:
+            statistiche['interrotto'] = 'tempo'
+            break
+        statistiche['espansioni'] += 1
+
+        partenza = percorso[0]
+        distanze = distanze_per_partenza.get(partenza)
+        if distanze is None:
+            distanze = distanze_per_partenza[partenza] = distanze_verso_partenza(csr, partenza, max_length)
+
+        nodo = percorso[-1]
+        for pos in range(offset[nodo], offset[nodo + 1]):
+            vicino = adiacenti[pos]
+
+            if vicino == partenza:
+                if len(percorso) >= 2:
+                    heapq.heappush(frontiera, (costo + costi[pos], contatore, True, percorso))
+                    contatore += 1
+                continue
+
+            if vicino < partenza or vicino in percorso:
+                continue
+
+            distanza = distanze.get(vicino)
+            if distanza is None or len(percorso) + distanza > max_length:
+                continue
+
+            heapq.heappush(frontiera, (costo + costi[pos], contatore, False, percorso + (vicino,)))
+            contatore += 1
+
+    statistiche['cicli'] = len(cicli)
+    return cicli, statistiche
+
+
+def grafo_inverso(grafo):
+    """Grafo con archi invertiti {user_id: [predecessori ordinati]}"""
+    inverso = defaultdict(list)
+    for u in sorted(grafo):
+        for v in grafo[u]:
+            inverso[v].append(u)
+    return dict(inverso)
+
+
+def distanze_verso(inverso, destinazione, max_length):
+    """
+    BFS sul grafo inverso {user_id: [predecessori]}: numero minimo di archi
+    da ogni utente verso `destinazione`, limitato a max_length - 1.
+    """
+    distanze = {destinazione: 0}
+    coda = deque([destinazione])
+    while coda:
+        nodo = coda.popleft()
+        d = distanze[nodo] + 1
+        if d >= max_length:
+            continue
+        for pred in inverso.get(nodo, ()):
+            if pred not in distanze:
+                distanze[pred] = d
+                coda.append(pred)
+    return distanze
+
+
+def cicli_per_utente(grafo, inverso, utente, max_length=6):
+    """
+    Genera i cicli semplici (2..max_length utenti) che passano per `utente`.
+
+    Meet-in-the-middle: un ciclo di L archi viene spezzato nel nodo che sta a
+    ⌈L/2⌉ archi dall'utente. Si espandono i percorsi in avanti fino a
+    ⌈max_length/2⌉ archi e quelli all'indietro (archi inversi) fino a
+    ⌊max_length/2⌋, poi si uniscono sul nodo d'incontro se non condividono
+    altri nodi. Ogni ciclo ha una sola scomposizione, quindi esce una volta sola.
+
+    Args:
+        grafo: dizionario di adiacenza di CycleFinder
+        inverso: grafo_inverso(grafo)
+        utente: user_id per cui cercare i cicli
+        max_length: lunghezza massima dei cicli
+
+    Yields:
+        list: user_id del ciclo, a partire da `utente`
+    """
+    if utente not in grafo or utente not in inverso:
+        return
+
+    meta_avanti = (max_length + 1) // 2
+    meta_indietro = max_length // 2
+
+    # Distanza minima di ogni nodo verso l'utente (per potare i percorsi in avanti)
+    distanze = distanze_verso(inverso, utente, max_length)
+
+    # Percorsi all'indietro: (nodo d'incontro, archi) -> [(nodo, ..., utente)]
+    indietro = defaultdict(list)
+    frontiera = [(utente,)]
+    for archi in range(1, meta_indietro + 1):
+        successiva = []
+        for percorso in frontiera:
+            for pred in inverso.get(percorso[0], ()):
+                if pred == utente or pred in percorso:
+                    continue
+                nuovo = (pred,) + percorso
+                indietro[(pred, archi)].append(nuovo)
+                successiva.append(nuovo)
+        frontiera = successiva
+
+    # Percorsi in avanti, uniti a quelli all'indietro sul nodo finale
+    frontiera = [(utente,)]
+    for archi in range(1, meta_avanti + 1):
+        successiva = []
+        for percorso in frontiera:
+            for vicino in grafo.get(percorso[-1], ()):
+                if vicino == utente or vicino in percorso:
+                    continue
+                distanza = distanze.get(vicino)
+                if distanza is None or archi + distanza > max_length:
+                    continue
+
+                nuovo = percorso + (vicino,)
+                interni = nuovo[1:-1]
+
+                # Ciclo di 2*archi - 1 o 2*archi archi: il nodo d'incontro è a ⌈L/2⌉
+                for archi_indietro in (archi - 1, archi):
+                    if archi_indietro < 1 or archi + archi_indietro > max_length:
+                        continue
+                    for ritorno in indietro.get((vicino, archi_indietro), ()):
+                        if interni and not set(interni).isdisjoint(ritorno[1:-1]):
+                            continue
+                        yield list(nuovo) + list(ritorno[1:-1])
+
+                if archi < meta_avanti:
+                    successiva.append(nuovo)
+        frontiera = successiva
+
+
+def archi_del_grafo(grafo):
+    """Insieme degli archi (user_da, user_a) del grafo"""
+    return {(u, v) for u, vicini in grafo.items() for v in vicini}
+
+
+def archi_del_ciclo(users):
+    """Archi (user_da, user_a) percorsi da un ciclo [u0, u1, ..., un-1] → u0"""
+    return [(users[i], users[(i + 1) % len(users)]) for i in range(len(users))]
+
+
+def ciclo_usa_archi(users, archi):
+    """True se il ciclo percorre almeno uno degli archi indicati"""
+    return any(arco in archi for arco in archi_del_ciclo(users))
+
+
+def cicli_con_arco(grafo, inverso, user_da, user_a, max_length=6):
+    """
+    Genera i cicli semplici (2..max_length utenti) che usano l'arco user_da → user_a:
+    sono esattamente i percorsi semplici user_a → ... → user_da con al più
+    max_length - 1 archi, chiusi dall'arco stesso.
+
+    Yields:
+        list: user_id del ciclo, a partire da user_da
+    """
+    if user_da == user_a or user_a not in grafo.get(user_da, ()):
+        return
+
+    distanze = distanze_verso(inverso, user_da, max_length)
+    if user_a not in distanze:
+        return
+
+    percorso = [user_da, user_a]
+    nel_percorso = {user_da, user_a}
+    pila = [iter(grafo.get(user_a, ()))]
+
+    while pila:
+        successivo = None
+        for vicino in pila[-1]:
+            if vicino == user_da:
+                yield list(percorso)
+                continue
+            if vicino in nel_percorso:
+                continue
+            distanza = distanze.get(vicino)
+            if distanza is None or len(percorso) + distanza > max_length:
+                continue
+            successivo = vicino
+            break
+
+        if successivo is None:
+            pila.pop()
+            nel_percorso.discard(percorso.pop())
+        else:
+            percorso.append(successivo)
+            nel_percorso.add(successivo)
+            pila.append(iter(grafo.get(successivo, ())))
+
+
+def cicli_multigrafo(archi, max_length=6, workers=1):
+    """
+    Cicli del multigrafo etichettato {(user_da, user_a): [(offerta_id, richiesta_id, tipo_match)]}.
+
+    La ricerca avviene sulla proiezione utente→utente (un arco per coppia di
+    utenti, come enumera_cicli); per ogni passaggio del ciclo vengono
+    restituite le etichette dell'arco, cioè gli annunci scambiati.
+
+    Yields:
+        tuple: (user_ids del ciclo, [etichette del passaggio i → i+1])
+    """
+    grafo = {}
+    for user_da, user_a in sorted(archi):
+        grafo.setdefault(user_da, []).append(user_a)
+
+    for ciclo in enumera_cicli(grafo, max_length, workers=workers):
+        yield ciclo, [archi[arco] for arco in archi_del_ciclo(ciclo)]
@@ -0,0 +1,168 @@
+"""
+Formato compatto (v2) dei dettagli di CicloScambio.
+
+Il formato v1 ripete titolo e categoria di ogni annuncio tre volte (in
+scambi[].oggetti, in utenti e in oggetti) più un timestamp ISO per ciclo.
+Il formato v2 salva solo gli id e un codice per il tipo di match di ogni coppia:
+
+    {'v': 2, 'scambi': [[da_user, a_user, [[offerto_id, richiesto_id, 's'], ...]], ...]}
+
+Chi legge solo gli id usa passaggi() / annunci_ids_dettagli(); titoli e
+categorie vengono ricostruiti solo quando servono (espandi_dettagli), dagli
+annunci già caricati dal chiamante. Tutte le funzioni accettano entrambi i
+formati, così i cicli non ancora migrati restano leggibili.
+"""
+
+VERSIONE_COMPATTA = 2
+
+CODICI_MATCH = {
+    'specifico': 's',
+    'parziale': 'p',
+    'sinonimo': 'n',
+    'categoria': 'c',
+}
+TIPI_MATCH = {codice: tipo for tipo, codice in CODICI_MATCH.items()}
+
+# Chiavi v1 ricavabili dagli scambi (o inutilizzate): non vengono salvate nel formato v2
+CHIAVI_RIDONDANTI = ('scambi', 'oggetti', 'utenti', 'timestamp')
+
+
+def is_compatti(dettagli):
+    """True se i dettagli sono nel formato compatto v2"""
+    return bool(dettagli) and dettagli.get('v') == VERSIONE_COMPATTA
+
+
+def comprimi_scambi(scambi):
+    """
+    Dettagli v2 a partire dagli scambi di ogni passaggio
+    (formato di CycleFinder._formatta_scambio, None = passaggio senza oggetti)
+    """
+    return {
+        'v': VERSIONE_COMPATTA,
+        'scambi': [
+            [
+                scambio.get('da_user'),
+                scambio.get('a_user'),
+                [
+                    [
+                        oggetto.get('offerto', {}).get('id'),
+                        oggetto.get('richiesto', {}).get('id'),
+                        CODICI_MATCH.get(oggetto.get('tipo_match'), oggetto.get('tipo_match')),
+                    ]
+                    for oggetto in scambio.get('oggetti', [])
+                ],
+            ]
+            for scambio in scambi
+            if scambio and scambio.get('oggetti')
+        ],
+    }
+
+
+def comprimi_dettagli(dettagli):
+    """Dettagli v1 convertiti nel formato v2 (le chiavi non ridondanti vengono conservate)"""
+    if is_compatti(dettagli):
+        return dettagli
+
+    compatti = {chiave: valore for chiave, valore in dettagli.items() if chiave not in CHIAVI_RIDONDANTI}
+    compatti.update(comprimi_scambi(dettagli.get('scambi', [])))
+    return compatti
+
+
+def passaggi(dettagli):
+    """
+    Passaggi con almeno un oggetto, in ordine:
+    [(da_user, a_user, [(offerto_id, richiesto_id, tipo_match), ...])]
+    """
+    if is_compatti(dettagli):
+        return [
+            (da_user, a_user, [(offerto_id, richiesto_id, TIPI_MATCH.get(codice, codice))
+                               for offerto_id, richiesto_id, codice in oggetti])
+            for da_user, a_user, oggetti in dettagli['scambi']
+            if oggetti
+        ]
+
+    risultato = []
+    for scambio in (dettagli or {}).get('scambi', []):
+        if not scambio or not scambio.get('oggetti'):
+            continue
+        risultato.append((
+            scambio.get('da_user'),
+            scambio.get('a_user'),
+            [
+                (oggetto.get('offerto', {}).get('id'), oggetto.get('richiesto', {}).get('id'), oggetto.get('tipo_match'))
+                for oggetto in scambio['oggetti']
+            ],
+        ))
+    return risultato
+
+
+def annunci_ids_dettagli(dettagli):
+    """Id di tutti gli annunci citati negli scambi"""
+    annunci_ids = set()
+    for _da_user, _a_user, oggetti in passaggi(dettagli):
+        for offerto_id, richiesto_id, _tipo_match in oggetti:
+            annunci_ids.add(offerto_id)
+            annunci_ids.add(richiesto_id)
+    annunci_ids.discard(None)
+    return annunci_ids
+
+
+def annunci_mostrati(dettagli):
+    """Id degli annunci mostrati (l'ultimo oggetto di ogni passaggio), come dettagli['utenti'] del v1"""
+    annunci_ids = set()
+    for _da_user, _a_user, oggetti in passaggi(dettagli):
+        offerto_id, richiesto_id, _tipo_match = oggetti[-1]
+        annunci_ids.add(offerto_id)
+        annunci_ids.add(richiesto_id)
+    annunci_ids.discard(None)
+    return annunci_ids
+
+
+def espandi_dettagli(dettagli, annunci, users):
+    """
+    Dettagli nel formato v1 (scambi, oggetti, utenti) con titoli e categorie
+    presi dagli annunci già caricati.
+
+    Args:
+        dettagli: dettagli v1 o v2
+        annunci: dict {annuncio_id: Annuncio} (con categoria già caricata)
+        users: utenti del ciclo (CicloScambio.users), per la lista utenti
+    """
+    if not is_compatti(dettagli):
+        return dettagli
+
+    def info(annuncio_id):
+        annuncio = annunci.get(annuncio_id)
+        return {
+            'id': annuncio_id,
+            'titolo': annuncio.titolo if annuncio else None,
+            'categoria': annuncio.categoria.nome if annuncio else None,
+        }
+
+    espansi = {chiave: valore for chiave, valore in dettagli.items() if chiave not in ('v', 'scambi')}
+    espansi.update({'scambi': [], 'oggetti': [], 'utenti': []})
+
+    per_utente = {}
+    for da_user, a_user, oggetti in passaggi(dettagli):
+        scambio = {
+            'da_user': da_user,
+            'a_user': a_user,
+            'oggetti': [
+                {'offerto': info(offerto_id), 'richiesto': info(richiesto_id), 'tipo_match': tipo_match}
+                for offerto_id, richiesto_id, tipo_match in oggetti
+            ],
+        }
+        espansi['scambi'].append(scambio)
+        espansi['oggetti'].extend(scambio['oggetti'])
+        per_utente[da_user] = scambio['oggetti'][-1]
+
+    # Come nel v1: per ogni utente l'ultimo oggetto del passaggio che parte da lui
+    for user_id in users:
+        ultimo = per_utente.get(user_id)
+        espansi['utenti'].append({
+            'user': {'id': user_id},
+            'offerta': ultimo['offerto'] if ultimo else None,
+            'richiede': ultimo['richiesto'] if ultimo else None,
+        })
+
+    return espansi
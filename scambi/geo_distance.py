@@ -0,0 +1,179 @@
+"""
+Distanze geografiche tra province, da una matrice calcolata una volta per processo.
+
+Le province sono poco più di cento: invece di rifare la formula di Haversine
+(e le query sui profili) a ogni confronto tra due utenti, la matrice
+provincia × provincia viene costruita al primo utilizzo con una sola query su
+Provincia e poi consultata per indice.
+
+I signals su Provincia (vedi scambi/signals.py) la scartano nel processo che
+salva e incrementano la versione delle province nel DB (VersioneDati): gli altri
+processi (worker gunicorn, calcolo cicli) la rileggono al massimo ogni
+INTERVALLO_CONTROLLO_VERSIONE secondi e ricostruiscono la matrice se è cambiata.
+"""
+import math
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+RAGGIO_TERRA_KM = 6371
+
+# Distanza convenzionale quando la provincia di uno dei due utenti non è nota
+DISTANZA_SCONOSCIUTA = 9999
+
+# Distanza assunta per grafo, cicli e tabella delle compatibilità quando la
+# provincia di uno dei due utenti non è nota: il calcolo cicli ha sempre usato
+# 50 km, così questi utenti non restano esclusi dagli scambi a mano
+DISTANZA_SCONOSCIUTA_CICLI = getattr(settings, 'DISTANZA_SCONOSCIUTA_CICLI_KM', 50)
+
+# Chiave di VersioneDati per le province
+CHIAVE_VERSIONE = 'province'
+
+# Secondi tra due controlli della versione delle province nel DB
+INTERVALLO_CONTROLLO_VERSIONE = 60
+
+# Matrice del processo corrente (None = da ricostruire), versione delle province
+# da cui è stata costruita e istante (time.monotonic) dell'ultimo controllo
+_MATRICE = None
+_VERSIONE = None
+_ULTIMO_CONTROLLO = 0.0
+
+
+def calcola_distanza_haversine(lat1, lon1, lat2, lon2):
+    """Calcola distanza in km tra due punti usando la formula di Haversine"""
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    lat2_rad = math.radians(lat2)
+    lon2_rad = math.radians(lon2)
+
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+
+    a = (math.sin(dlat/2)**2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2)
+    c = 2 * math.asin(math.sqrt(a))
+
+    return RAGGIO_TERRA_KM * c
+
+
+class MatriceDistanze:
+    """
+    Distanze in km (intere) tra i capoluoghi di provincia.
+
+    Uso:
+        matrice = MatriceDistanze([(1, 45.46, 9.19), (2, 41.90, 12.50)])
+        matrice.distanza(1, 2)
+    """
+
+    def __init__(self, province):
+        province = list(province)
+        self.indice = {provincia_id: i for i, (provincia_id, _lat, _lon) in enumerate(province)}
+        self.righe = [
+            [
+                int(calcola_distanza_haversine(lat_a, lon_a, lat_b, lon_b))
+                for _id_b, lat_b, lon_b in province
+            ]
+            for _id_a, lat_a, lon_a in province
+        ]
+
+    def __len__(self):
+        return len(self.indice)
+
+    def distanza(self, provincia_a, provincia_b):
+        """Distanza tra due province (0 se coincidono, DISTANZA_SCONOSCIUTA se manca una provincia)"""
+        if provincia_a is None or provincia_b is None:
+            return DISTANZA_SCONOSCIUTA
+        if provincia_a == provincia_b:
+            return 0
+        i = self.indice.get(provincia_a)
+        j = self.indice.get(provincia_b)
+        if i is None or j is None:
+            return DISTANZA_SCONOSCIUTA
+        return self.righe[i][j]
+
+    def distanze(self, coppie):
+        """Distanze per una lista di coppie (provincia_a, provincia_b), nello stesso ordine"""
+        indice = self.indice
+        righe = self.righe
+        risultato = []
+        for provincia_a, provincia_b in coppie:
+            if provincia_a is not None and provincia_a == provincia_b:
+                risultato.append(0)
+                continue
+            i = indice.get(provincia_a)
+            j = indice.get(provincia_b)
+            risultato.append(DISTANZA_SCONOSCIUTA if i is None or j is None else righe[i][j])
+        return risultato
+
+    def province_entro(self, provincia, distanza_max):
+        """Id delle province entro distanza_max km dalla provincia indicata (inclusa)"""
+        i = self.indice.get(provincia)
+        if i is None:
+            return set()
+        riga = self.righe[i]
+        return {provincia_id for provincia_id, j in self.indice.items() if riga[j] <= distanza_max}
+
+
+def _versione_province():
+    from .models import VersioneDati
+
+    return VersioneDati.get_versione(CHIAVE_VERSIONE)
+
+
+def get_matrice_distanze():
+    """
+    Matrice delle distanze del processo, costruita al primo utilizzo e
+    ricostruita se un altro processo ha modificato le province
+    """
+    global _MATRICE, _VERSIONE, _ULTIMO_CONTROLLO
+    adesso = time.monotonic()
+
+    if _MATRICE is not None and adesso - _ULTIMO_CONTROLLO >= INTERVALLO_CONTROLLO_VERSIONE:
+        _ULTIMO_CONTROLLO = adesso
+        if _versione_province() != _VERSIONE:
+            _MATRICE = None
+
+    if _MATRICE is None:
+        from .models import Provincia
+
+        _VERSIONE = _versione_province()
+        _ULTIMO_CONTROLLO = adesso
+        province = Provincia.objects.order_by('id').values_list('id', 'latitudine', 'longitudine')
+        _MATRICE = MatriceDistanze(province)
+        print(f"[{datetime.now()}] 🗺️ Matrice distanze costruita: {len(_MATRICE)} province (versione {_VERSIONE})")
+    return _MATRICE
+
+
+def invalida_matrice_distanze():
+    """Scarta la matrice del processo: verrà ricostruita alla prossima richiesta"""
+    global _MATRICE
+    _MATRICE = None
+
+
+def segnala_modifica_province():
+    """
+    Province modificate: scarta la matrice del processo e incrementa la versione
+    nel DB, così anche gli altri processi la ricostruiscono
+    """
+    from .models import VersioneDati
+
+    VersioneDati.incrementa(CHIAVE_VERSIONE)
+    invalida_matrice_distanze()
+
+
+def distanza_per_cicli(distanza_km):
+    """Distanza da usare nel calcolo cicli (DISTANZA_SCONOSCIUTA_CICLI se sconosciuta)"""
+    if distanza_km is None or distanza_km >= DISTANZA_SCONOSCIUTA:
+        return DISTANZA_SCONOSCIUTA_CICLI
+    return distanza_km
+
+
+def distanza_province(provincia_a, provincia_b):
+    """Distanza in km tra due province (id)"""
+    return get_matrice_distanze().distanza(provincia_a, provincia_b)
+
+
+def distanze_province(coppie):
+    """Distanze in km per una lista di coppie di id provincia"""
+    return get_matrice_distanze().distanze(coppie)
@@ -0,0 +1,240 @@
+"""
+Indice invertito per la costruzione del grafo delle compatibilità.
+
+Invece di confrontare ogni offerta con ogni richiesta, le richieste ("cerco")
+vengono indicizzate per parola chiave, per termine sinonimo espanso e per
+categoria (solo annunci con cerca_per_categoria). Per ogni offerta si valutano
+con tipo_match_da_parole solo le richieste candidate, cioè quelle che
+condividono almeno un token, un sinonimo, una sottostringa (match parziale)
+oppure la categoria.
+
+I match parziali (una parola contenuta nell'altra, entrambe > 3 caratteri) non
+richiedono il confronto di ogni parola con tutto il vocabolario: TrigramIndex
+restituisce per lookup i token che contengono una parola (intersezione delle
+liste dei trigrammi) o che vi sono contenuti (sottostringhe della parola).
+
+Il risultato è identico al confronto esaustivo con oggetti_compatibili_con_tipo:
+le coppie escluse dall'indice non possono produrre nessun tipo di match.
+"""
+from collections import defaultdict
+
+from .matching import get_parole_chiave, get_sinonimi_chiave, tipo_match_da_parole
+
+
+# Lunghezza minima (esclusa) delle parole per il match parziale
+LUNGHEZZA_MIN_PARZIALE = 3
+
+# Lunghezza degli n-grammi di caratteri dell'indice delle sottostringhe
+LUNGHEZZA_NGRAMMA = 3
+
+
+class TrigramIndex:
+    """
+    Indice n-grammi di caratteri su un vocabolario di token.
+
+    Uso:
+        indice = TrigramIndex(['iphone', 'phone', 'smartphone'])
+        indice.parziali('phone')   # {'iphone', 'phone', 'smartphone'}
+    """
+
+    def __init__(self, token=()):
+        self.vocabolario = set()
+        self.per_ngramma = defaultdict(set)   # trigramma -> token che lo contengono
+
+        for t in token:
+            self.aggiungi(t)
+
+    def __contains__(self, token):
+        return token in self.vocabolario
+
+    def __len__(self):
+        return len(self.vocabolario)
+
+    @staticmethod
+    def ngrammi(token):
+        """Insieme dei trigrammi del token"""
+        return {token[i:i + LUNGHEZZA_NGRAMMA] for i in range(len(token) - LUNGHEZZA_NGRAMMA + 1)}
+
+    def aggiungi(self, token):
+        """Aggiunge un token al vocabolario"""
+        if token in self.vocabolario:
+            return
+        self.vocabolario.add(token)
+        for ngramma in self.ngrammi(token):
+            self.per_ngramma[ngramma].add(token)
+
+    def contenenti(self, parola):
+        """Token del vocabolario che contengono la parola"""
+        if len(parola) < LUNGHEZZA_NGRAMMA:
+            return {t for t in self.vocabolario if parola in t}
+
+        # Intersezione delle liste, partendo dalla più corta
+        liste = sorted((self.per_ngramma.get(n, set()) for n in self.ngrammi(parola)), key=len)
+        if not liste[0]:
+            return set()
+        candidati = set(liste[0])
+        for lista in liste[1:]:
+            candidati &= lista
+            if not candidati:
+                return candidati
+
+        # Gli n-grammi in comune non garantiscono la contiguità: verifica finale
+        return {t for t in candidati if parola in t}
+
+    def contenuti(self, parola, lunghezza_min=1):
+        """Token del vocabolario contenuti nella parola (lunghi almeno lunghezza_min)"""
+        trovati = set()
+        for inizio in range(len(parola)):
+            for fine in range(inizio + lunghezza_min, len(parola) + 1):
+                sottostringa = parola[inizio:fine]
+                if sottostringa in self.vocabolario:
+                    trovati.add(sottostringa)
+        return trovati
+
+    def parziali(self, parola):
+        """
+        Token del vocabolario parzialmente compatibili con la parola
+        (la contengono o sono contenuti in essa), con la stessa soglia
+        di lunghezza del match parziale di tipo_match_da_parole.
+        """
+        if len(parola) <= LUNGHEZZA_MIN_PARZIALE:
+            return set()
+        return self.contenenti(parola) | self.contenuti(parola, LUNGHEZZA_MIN_PARZIALE + 1)
+
+
+class KeywordIndex:
+    """
+    Indice parola chiave → richieste, costruito una volta per calcolo.
+
+    Uso:
+        indice = KeywordIndex(richieste)
+        for offerta, richiesta, tipo_match in indice.coppie_compatibili(offerte):
+            ...
+    """
+
+    def __init__(self, richieste=()):
+        self.richieste = {}                       # richiesta_id -> Annuncio
+        self.parole = {}                          # annuncio_id -> set di parole chiave
+        self.sinonimi = {}                        # annuncio_id -> set di sinonimi significativi
+        self.per_token = defaultdict(set)         # token -> richiesta_id
+        self.per_sinonimo = defaultdict(set)      # termine espanso -> richiesta_id
+        self.per_categoria = defaultdict(set)     # categoria_id -> richiesta_id (cerca_per_categoria)
+        self.vocabolario_parziale = defaultdict(set)  # token > 3 caratteri -> richiesta_id
+        self.trigrammi = TrigramIndex()               # indice sottostringhe su vocabolario_parziale
+
+        # Cache dei token parzialmente compatibili per ogni token / annuncio offerto
+        self._cache_parziali = {}
+        self._parziali_annuncio = {}
+
+        for richiesta in richieste:
+            self.aggiungi_richiesta(richiesta)
+
+    def parole_chiave(self, annuncio):
+        """Parole chiave dell'annuncio (memorizzate su Annuncio o estratte una volta per calcolo)"""
+        parole = self.parole.get(annuncio.id)
+        if parole is None:
+            parole = get_parole_chiave(annuncio)
+            self.parole[annuncio.id] = parole
+        return parole
+
+    def sinonimi_chiave(self, annuncio):
+        """Espansione sinonimi significativa dell'annuncio, calcolata una volta per calcolo"""
+        sinonimi = self.sinonimi.get(annuncio.id)
+        if sinonimi is None:
+            sinonimi = get_sinonimi_chiave(annuncio, self.parole_chiave(annuncio))
+            self.sinonimi[annuncio.id] = sinonimi
+        return sinonimi
+
+    def aggiungi_richiesta(self, richiesta):
+        """Indicizza un annuncio 'cerco'"""
+        self.richieste[richiesta.id] = richiesta
+
+        # cerca_per_categoria: accetta SOLO match per categoria (vedi oggetti_compatibili_con_tipo)
+        if richiesta.cerca_per_categoria:
+            if richiesta.categoria_id:
+                self.per_categoria[richiesta.categoria_id].add(richiesta.id)
+            return
+
+        parole = self.parole_chiave(richiesta)
+        if not parole:
+            # Senza parole chiave valide una richiesta non matcha mai
+            return
+
+        for parola in parole:
+            self.per_token[parola].add(richiesta.id)
+            if len(parola) > LUNGHEZZA_MIN_PARZIALE:
+                self.vocabolario_parziale[parola].add(richiesta.id)
+                self.trigrammi.aggiungi(parola)
+
+        for termine in self.sinonimi_chiave(richiesta):
+            self.per_sinonimo[termine].add(richiesta.id)
+
+    def candidati(self, offerta):
+        """
+        Restituisce gli id delle richieste che possono essere compatibili con l'offerta
+        """
+        candidati = set()
+
+        if offerta.categoria_id:
+            candidati |= self.per_categoria.get(offerta.categoria_id, set())
+
+        for parola in self.parole_chiave(offerta):
+            candidati |= self.per_token.get(parola, set())
+
+        for token in self.token_parziali_annuncio(offerta):
+            candidati |= self.vocabolario_parziale[token]
+
+        for termine in self.sinonimi_chiave(offerta):
+            candidati |= self.per_sinonimo.get(termine, set())
+
+        return candidati
+
+    def _token_parziali(self, parola):
+        """Token del vocabolario che contengono la parola o sono contenuti in essa"""
+        token = self._cache_parziali.get(parola)
+        if token is None:
+            token = self.trigrammi.parziali(parola)
+            self._cache_parziali[parola] = token
+        return token
+
+    def token_parziali_annuncio(self, offerta):
+        """Token delle richieste parzialmente compatibili con almeno una parola dell'offerta"""
+        token = self._parziali_annuncio.get(offerta.id)
+        if token is None:
+            token = set()
+            for parola in self.parole_chiave(offerta):
+                token |= self._token_parziali(parola)
+            token = frozenset(token)
+            self._parziali_annuncio[offerta.id] = token
+        return token
+
+    def tipo_match(self, offerta, richiesta):
+        """Stesso risultato di oggetti_compatibili_con_tipo, senza ri-tokenizzare i titoli"""
+        if richiesta.cerca_per_categoria:
+            if offerta.categoria_id and offerta.categoria_id == richiesta.categoria_id:
+                return True, "categoria"
+            return False, None
+
+        return tipo_match_da_parole(
+            self.parole_chiave(offerta),
+            self.parole_chiave(richiesta),
+            self.sinonimi_chiave(offerta),
+            self.sinonimi_chiave(richiesta),
+            self.token_parziali_annuncio(offerta),
+        )
+
+    def coppie_compatibili(self, offerte):
+        """
+        Genera le coppie (offerta, richiesta, tipo_match) compatibili.
+        Le coppie dello stesso utente vengono saltate.
+        """
+        for offerta in offerte:
+            for richiesta_id in sorted(self.candidati(offerta)):
+                richiesta = self.richieste[richiesta_id]
+                if richiesta.utente_id == offerta.utente_id:
+                    continue
+
+                compatible, tipo_match = self.tipo_match(offerta, richiesta)
+                if compatible:
+                    yield offerta, richiesta, tipo_match
+
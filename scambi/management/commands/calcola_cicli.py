@@ -13,12 +13,22 @@ if __name__ == "__main__":
     django.setup()
 
 from scambi.models import CicloScambio, CalcoloMetadata
-from scambi.matching import CycleFinder
+from scambi.matching import CycleFinder, MODALITA_FASCE, FASCE_IGNORA
+from scambi.cycle_engine import MOTORI_CICLI, MOTORE_DFS, MOTORE_TOPK, archi_del_grafo
 
 
 class Command(BaseCommand):
     help = 'Calcola tutti i cicli di scambio e li salva nel database'
 
+    # Impostato da --da-compatibilita (vedi handle)
+    da_compatibilita = False
+
+    # CycleFinder dell'ultimo calcolo: il suo grafo diventa lo snapshot per il prossimo incrementale
+    finder = None
+
+    # Impostato da --fasce: vincolo sulle fasce di prezzo dei cicli (vedi CycleFinder.modalita_fasce)
+    fasce = FASCE_IGNORA
+
     def add_arguments(self, parser):
         parser.add_argument(
             '--max-length',
@@ -29,8 +39,8 @@ class Command(BaseCommand):
         parser.add_argument(
             '--commit-batch-size',
             type=int,
-            default=100,
-            help='Numero di cicli da committare per volta (default: 100)'
+            default=1000,
+            help='Numero di cicli da committare per volta (default: 1000)'
         )
         parser.add_argument(
             '--cleanup-old',
@@ -47,6 +57,57 @@ class Command(BaseCommand):
             action='store_true',
             help='Forza calcolo completo anche se ci sono poche modifiche'
         )
+        parser.add_argument(
+            '--engine',
+            choices=MOTORI_CICLI,
+            default=MOTORE_DFS,
+            help='Motore di ricerca cicli per il calcolo completo: dfs (ricorsivo, default), '
+                 'canonico (iterativo, ogni ciclo trovato una volta sola), '
+                 'topk (solo i cicli migliori entro un budget) '
+                 'o multigrafo (canonico con gli annunci sugli archi, senza secondo matching per i dettagli)'
+        )
+        parser.add_argument(
+            '--da-compatibilita',
+            action='store_true',
+            help='Costruisce il grafo dalla tabella CompatibilitaAnnunci invece del matching a coppie'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Processi paralleli per i motori canonico e multigrafo (default: 1)'
+        )
+        parser.add_argument(
+            '--fasce',
+            choices=MODALITA_FASCE,
+            default=FASCE_IGNORA,
+            help='Fasce di prezzo: ignora (default, calcola solo il flag fasce_pari), '
+                 'preferisci (prima i cicli alla pari) o solo_pari (cerca solo cicli alla pari)'
+        )
+        parser.add_argument(
+            '--top-k-utente',
+            type=int,
+            default=20,
+            help='Motore topk: cicli massimi per utente (default: 20)'
+        )
+        parser.add_argument(
+            '--top-k',
+            type=int,
+            default=0,
+            help='Motore topk: cicli massimi in totale (default: 0 = nessun limite)'
+        )
+        parser.add_argument(
+            '--max-espansioni',
+            type=int,
+            default=200000,
+            help='Motore topk: budget di percorsi parziali espansi (default: 200000)'
+        )
+        parser.add_argument(
+            '--tempo-max',
+            type=int,
+            default=300,
+            help='Motore topk: budget di tempo in secondi (default: 300, 0 = nessun limite)'
+        )
 
     def handle(self, *args, **options):
         """
@@ -60,6 +121,16 @@ class Command(BaseCommand):
         cleanup_old = options['cleanup_old']
         incremental = options['incremental']
         force_full = options['force_full']
+        engine = options['engine']
+        workers = max(1, options['workers'])
+        self.da_compatibilita = options['da_compatibilita']
+        self.fasce = options['fasce']
+        budget_topk = {
+            'k_per_utente': options['top_k_utente'],
+            'k_globale': options['top_k'] or None,
+            'max_espansioni': options['max_espansioni'],
+            'tempo_max': options['tempo_max'] or None,
+        }
 
         self.stdout.write(
             self.style.SUCCESS(f"[{datetime.now()}] 🚀 Avvio calcolo cicli...")
@@ -79,17 +150,23 @@ class Command(BaseCommand):
 
             if incremental and not force_full:
                 finder = CycleFinder()
+                finder.modalita_fasce = self.fasce
 
-                # Trova annunci modificati dall'ultimo calcolo
+                # Trova annunci modificati dall'ultimo calcolo (e utenti con annunci eliminati o
+                # nuova provincia, che non cambiano nessun last_modified)
                 annunci_modificati = finder.get_annunci_modificati(metadata.ultimo_calcolo_completo)
                 count_modificati = annunci_modificati.count()
+                utenti_modificati = finder.get_utenti_modificati(metadata.ultimo_calcolo_completo)
 
                 self.stdout.write(
-                    self.style.HTTP_INFO(f"[{datetime.now()}] 📋 Annunci modificati: {count_modificati}")
+                    self.style.HTTP_INFO(
+                        f"[{datetime.now()}] 📋 Annunci modificati: {count_modificati} "
+                        f"(utenti coinvolti: {len(utenti_modificati)})"
+                    )
                 )
 
                 # Se ci sono modifiche, usa calcolo incrementale
-                if count_modificati > 0:
+                if count_modificati > 0 or utenti_modificati:
                     # Se ci sono TROPPI annunci modificati (>30% del totale), meglio fare calcolo completo
                     from scambi.models import Annuncio
                     totale_annunci = Annuncio.objects.filter(attivo=True).count()
@@ -102,6 +179,13 @@ class Command(BaseCommand):
                                 f"uso calcolo completo invece di incrementale"
                             )
                         )
+                    elif metadata.get_archi_grafo() is None:
+                        self.stdout.write(
+                            self.style.WARNING(
+                                f"[{datetime.now()}] ⚠️ Nessuno snapshot del grafo dall'ultimo calcolo, "
+                                f"uso calcolo completo"
+                            )
+                        )
                     else:
                         usa_incrementale = True
                         self.stdout.write(
@@ -117,14 +201,20 @@ class Command(BaseCommand):
 
             # Step 3: Calcola cicli (incrementale o completo)
             if usa_incrementale:
-                cicli = self._calcolo_incrementale(finder, annunci_modificati, max_length)
+                cicli = self._calcolo_incrementale(
+                    finder, metadata.ultimo_calcolo_completo, max_length, metadata.get_archi_grafo()
+                )
             else:
-                cicli = self._calcolo_completo(max_length)
+                cicli = self._calcolo_completo(max_length, engine, workers, budget_topk)
 
             # Step 4: Salva i cicli nel database
-            if cicli:
-                self._salva_cicli_batch(cicli, batch_size)
+            if usa_incrementale:
+                # A blocchi, sopra i cicli già presenti
+                salvati = self._salva_cicli_batch(cicli, batch_size)
             else:
+                # Solo le differenze rispetto ai cicli validi, in una transazione
+                salvati = self._salva_differenze(cicli, batch_size)
+            if not salvati:
                 self.stdout.write(
                     self.style.WARNING(f"[{datetime.now()}] ⚠️ Nessun ciclo trovato")
                 )
@@ -132,7 +222,8 @@ class Command(BaseCommand):
             # Step 5: Aggiorna metadata e statistiche finali
             elapsed = time.time() - start_time
             cicli_validi = CicloScambio.objects.filter(valido=True).count()
-            CalcoloMetadata.aggiorna_calcolo(cicli_validi, elapsed)
+            archi = archi_del_grafo(self.finder.grafo) if self.finder else None
+            CalcoloMetadata.aggiorna_calcolo(cicli_validi, elapsed, archi)
 
             self.stdout.write(
                 self.style.SUCCESS(
@@ -149,56 +240,54 @@ class Command(BaseCommand):
             traceback.print_exc()
             sys.exit(1)
 
-    def _calcolo_completo(self, max_length):
+    def _calcolo_completo(self, max_length, engine=MOTORE_DFS, workers=1, budget_topk=None):
         """
-        Esegue calcolo completo di tutti i cicli
+        Esegue calcolo completo di tutti i cicli.
+        Restituisce un generatore (CycleFinder.itera_cicli): _salva_differenze lo
+        consuma confrontando ogni ciclo con quelli validi, senza tenere in memoria
+        i cicli invariati. Il motore topk restituisce la lista dei migliori, già
+        limitata dal budget.
+        I cicli esistenti restano validi (e visibili) finché non viene applicato il risultato.
         """
         self.stdout.write(
             self.style.HTTP_INFO(f"[{datetime.now()}] 🔄 Calcolo completo di tutti i cicli...")
         )
 
-        # Marca tutti i cicli esistenti come non validi
-        existing_count = CicloScambio.objects.filter(valido=True).count()
-        CicloScambio.objects.filter(valido=True).update(valido=False)
-        self.stdout.write(
-            self.style.WARNING(f"[{datetime.now()}] 🔄 Marcati {existing_count} cicli come non validi")
-        )
-
         # Calcola nuovi cicli
-        finder = CycleFinder()
-        finder.costruisci_grafo()
-        cicli = finder.trova_tutti_cicli(max_length=max_length)
-
-        # Stats
-        scambi_diretti = [c for c in cicli if c['lunghezza'] == 2]
-        catene_lunghe = [c for c in cicli if c['lunghezza'] > 2]
-
-        self.stdout.write(
-            self.style.HTTP_INFO(
-                f"[{datetime.now()}] 📊 Trovati {len(scambi_diretti)} scambi diretti + "
-                f"{len(catene_lunghe)} catene lunghe = {len(cicli)} totali"
-            )
-        )
-
-        return cicli
-
-    def _calcolo_incrementale(self, finder, annunci_modificati, max_length):
+        finder = self.finder = CycleFinder()
+        finder.modalita_fasce = self.fasce
+        finder.costruisci_grafo(da_compatibilita=self.da_compatibilita)
+        if engine == MOTORE_TOPK:
+            return finder.trova_cicli_migliori(max_length=max_length, **(budget_topk or {}))
+        return finder.itera_cicli(max_length=max_length, engine=engine, workers=workers)
+
+    def _calcolo_incrementale(self, finder, ultimo_calcolo, max_length, archi_precedenti):
         """
-        Esegue calcolo incrementale solo per gli utenti impattati
+        Esegue calcolo incrementale guidato dalle differenze del grafo:
+        - lo snapshot degli archi dell'ultimo calcolo viene aggiornato solo attorno ai
+          proprietari degli annunci modificati (CycleFinder.aggiorna_grafo), senza ricostruire il grafo
+        - archi aggiunti: cerca solo i cicli che li usano
+        - archi rimossi: invalida solo i cicli che li usavano
+        - annunci modificati senza cambi di archi: aggiorna i dettagli dei cicli dei proprietari
         """
         self.stdout.write(
             self.style.HTTP_INFO(f"[{datetime.now()}] ⚡ Calcolo incrementale...")
         )
+        self.finder = finder
 
-        # Step 1: Identifica utenti impattati
-        utenti_impattati = finder.get_utenti_impattati(annunci_modificati)
+        # Step 1: Aggiorna lo snapshot dell'ultimo calcolo con gli archi dei proprietari modificati
+        proprietari = finder.get_utenti_modificati(ultimo_calcolo)
+        aggiunti, rimossi = finder.aggiorna_grafo(
+            archi_precedenti, proprietari, da_compatibilita=self.da_compatibilita
+        )
+        finder.trova_cicli_da_delta(aggiunti, max_length)
 
-        # Step 2: Invalida solo i cicli che coinvolgono questi utenti
-        count_invalidati = finder.invalida_cicli_con_utenti(utenti_impattati)
+        # Step 2: Invalida solo i cicli che usano archi rimossi
+        count_invalidati = finder.invalida_cicli_con_archi(rimossi)
 
-        # Step 3: Costruisci grafo e trova nuovi cicli per questi utenti
-        finder.costruisci_grafo()
-        cicli = finder.trova_cicli_per_utenti(utenti_impattati, max_length)
+        # Step 3: Aggiorna i dettagli dei cicli dei proprietari degli annunci modificati
+        finder.aggiorna_cicli_utenti(proprietari)
+        cicli = finder.cicli_trovati
 
         # Stats
         scambi_diretti = [c for c in cicli if c['lunghezza'] == 2]
@@ -207,7 +296,8 @@ class Command(BaseCommand):
         self.stdout.write(
             self.style.HTTP_INFO(
                 f"[{datetime.now()}] 📊 Ricalcolati {len(scambi_diretti)} scambi diretti + "
-                f"{len(catene_lunghe)} catene lunghe = {len(cicli)} totali per {len(utenti_impattati)} utenti"
+                f"{len(catene_lunghe)} catene lunghe = {len(cicli)} totali "
+                f"(+{len(aggiunti)}/-{len(rimossi)} archi, {count_invalidati} cicli invalidati)"
             )
         )
 
@@ -215,83 +305,171 @@ class Command(BaseCommand):
 
     def _salva_cicli_batch(self, cicli, batch_size):
         """
-        Salva i cicli nel database a batch usando upsert intelligente
+        Salva i cicli nel database a batch usando upsert in blocco (CicloScambio.salva_batch)
         - Se il ciclo esiste già (stesso hash_ciclo), lo riattiva e aggiorna i dettagli
         - Se il ciclo è nuovo, lo crea
         - Questo preserva gli ID dei cicli esistenti e le PropostaCatena collegate!
+
+        Usato dal calcolo incrementale (lista dei cicli nuovi o aggiornati; il calcolo
+        completo passa da _salva_differenze): vengono letti batch_size cicli alla
+        volta e ogni blocco è visibile nel DB appena committato.
+
+        Returns:
+            int: Numero di cicli letti
         """
-        total_cicli = len(cicli)
+        from itertools import islice
+
+        cicli = iter(cicli)
+        totale = 0
+        scambi_diretti = 0
         creati = 0
         aggiornati = 0
         errori = 0
 
         self.stdout.write(
-            self.style.HTTP_INFO(f"[{datetime.now()}] 💾 Inizio salvataggio/aggiornamento {total_cicli} cicli...")
+            self.style.HTTP_INFO(f"[{datetime.now()}] 💾 Inizio salvataggio/aggiornamento cicli (blocchi da {batch_size})...")
         )
 
-        for i in range(0, total_cicli, batch_size):
-            batch = cicli[i:i + batch_size]
+        while True:
+            batch = list(islice(cicli, batch_size))
+            if not batch:
+                break
+            totale += len(batch)
+            scambi_diretti += sum(1 for ciclo_data in batch if ciclo_data['lunghezza'] == 2)
 
             try:
+                # Upsert del blocco in pochi statement (vedi CicloScambio.salva_batch)
                 with transaction.atomic():
-                    for ciclo_data in batch:
-                        try:
-                            hash_ciclo = ciclo_data['hash_ciclo']
-
-                            # Cerca se esiste già un ciclo con questo hash
-                            ciclo_esistente = CicloScambio.objects.filter(hash_ciclo=hash_ciclo).first()
-
-                            if ciclo_esistente:
-                                # AGGIORNA il ciclo esistente (preserva ID e PropostaCatena!)
-                                ciclo_esistente.users = ciclo_data['users']
-                                ciclo_esistente.lunghezza = ciclo_data['lunghezza']
-                                ciclo_esistente.dettagli = ciclo_data['dettagli']
-                                ciclo_esistente.valido = True  # Riattiva
-                                ciclo_esistente.save()
-                                aggiornati += 1
-                            else:
-                                # CREA nuovo ciclo
-                                CicloScambio.objects.create(
-                                    users=ciclo_data['users'],
-                                    lunghezza=ciclo_data['lunghezza'],
-                                    dettagli=ciclo_data['dettagli'],
-                                    hash_ciclo=hash_ciclo,
-                                    valido=True
-                                )
-                                creati += 1
-
-                        except Exception as e:
-                            errori += 1
-                            self.stdout.write(
-                                self.style.WARNING(
-                                    f"[{datetime.now()}] ⚠️ Errore salvando ciclo {ciclo_data.get('hash_ciclo', 'unknown')}: {type(e).__name__}: {e}"
-                                )
-                            )
+                    creati_batch, aggiornati_batch = CicloScambio.salva_batch(batch)
+                creati += creati_batch
+                aggiornati += aggiornati_batch
 
-                # Progress update ogni batch
-                progresso = (i + len(batch)) / total_cicli * 100
+                # Progress update ogni batch (il totale non è noto finché la ricerca non termina)
                 self.stdout.write(
                     self.style.HTTP_INFO(
-                        f"[{datetime.now()}] 📊 Progresso: {progresso:.1f}% "
+                        f"[{datetime.now()}] 📊 Progresso: {totale} cicli "
                         f"({creati} nuovi, {aggiornati} aggiornati, {errori} errori)"
                     )
                 )
 
             except Exception as e:
                 self.stdout.write(
-                    self.style.ERROR(f"[{datetime.now()}] ❌ Errore nel batch {i}-{i+len(batch)}: {e}")
+                    self.style.ERROR(f"[{datetime.now()}] ❌ Errore nel batch {totale - len(batch)}-{totale}: {e}")
                 )
                 errori += len(batch)
 
+        if not totale:
+            return 0
+
         self.stdout.write(
             self.style.SUCCESS(
-                f"[{datetime.now()}] 💾 Salvataggio completato: "
+                f"[{datetime.now()}] 💾 Salvataggio completato: {scambi_diretti} scambi diretti + "
+                f"{totale - scambi_diretti} catene lunghe = {totale} totali; "
                 f"{creati} cicli nuovi creati, {aggiornati} cicli esistenti aggiornati, {errori} errori"
             )
         )
 
-        # Cleanup cicli che non sono più validi (non trovati nel nuovo calcolo)
-        # Ma SOLO se non hanno proposte attive!
+        self._rimuovi_cicli_non_validi()
+
+        return totale
+
+    def _salva_differenze(self, cicli, batch_size):
+        """
+        Applica il risultato di un calcolo completo toccando solo le righe cambiate:
+        - confronta ogni ciclo trovato con l'impronta del ciclo valido con lo stesso hash
+        - scrive a blocchi di batch_size, mentre la ricerca prosegue, i cicli nuovi
+          (non validi, quindi ancora invisibili)
+        - in una transazione breve (CicloScambio.attiva_differenze) riscrive i cicli
+          cambiati, rende validi i nuovi e invalida quelli non più trovati
+        I cicli invariati non vengono riscritti. In memoria restano gli hash, un
+        blocco di cicli nuovi e i cicli cambiati: questi ultimi hanno la stessa riga
+        (hash_ciclo) del ciclo valido, quindi non possono essere scritti prima del
+        passaggio finale senza mostrare un misto di vecchio e nuovo; sono di solito
+        pochi rispetto ai cicli trovati.
+
+        Returns:
+            int: Numero di cicli letti
+        """
+        impronte = CicloScambio.impronte_validi()
+        self.stdout.write(
+            self.style.HTTP_INFO(f"[{datetime.now()}] 🔎 Confronto con {len(impronte)} cicli validi nel DB...")
+        )
+
+        trovati = set()
+        nuovi = []  # hash dei cicli nuovi, da rendere validi alla fine
+        cambiati = []  # cicli validi con contenuto cambiato, riscritti alla fine
+        blocco = []
+        scambi_diretti = 0
+        creati = 0
+
+        for ciclo_data in cicli:
+            hash_ciclo = ciclo_data['hash_ciclo']
+            if hash_ciclo in trovati:
+                continue
+            trovati.add(hash_ciclo)
+            if ciclo_data['lunghezza'] == 2:
+                scambi_diretti += 1
+
+            impronta = impronte.get(hash_ciclo)
+            if impronta is None:
+                nuovi.append(hash_ciclo)
+                blocco.append(ciclo_data)
+            elif impronta != CicloScambio.impronta(ciclo_data):
+                cambiati.append(ciclo_data)
+
+            if len(blocco) >= batch_size:
+                creati += self._scrivi_blocco(blocco)
+                blocco = []
+
+            # Progress update (il totale non è noto finché la ricerca non termina)
+            if len(trovati) % batch_size == 0:
+                self.stdout.write(
+                    self.style.HTTP_INFO(
+                        f"[{datetime.now()}] 📊 Progresso: {len(trovati)} cicli "
+                        f"({len(nuovi)} nuovi, {len(cambiati)} cambiati)"
+                    )
+                )
+
+        if blocco:
+            creati += self._scrivi_blocco(blocco)
+
+        totale = len(trovati)
+        spariti = impronte.keys() - trovati
+
+        _attivati, invalidati = CicloScambio.attiva_differenze(nuovi, spariti, batch_size, cambiati=cambiati)
+        aggiornati = len(cambiati) + len(nuovi) - creati
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"[{datetime.now()}] 💾 Salvataggio completato: {scambi_diretti} scambi diretti + "
+                f"{totale - scambi_diretti} catene lunghe = {totale} totali; "
+                f"{creati} cicli nuovi creati, {aggiornati} cicli aggiornati, "
+                f"{totale - creati - aggiornati} invariati, {invalidati} invalidati"
+            )
+        )
+
+        if totale:
+            self._rimuovi_cicli_non_validi()
+
+        return totale
+
+    def _scrivi_blocco(self, blocco):
+        """
+        Scrive un blocco di cicli nuovi come non validi (visibili solo dopo attiva_differenze)
+
+        Returns:
+            int: Righe create (un ciclo nuovo può riusare la riga di un ciclo
+                 non valido con lo stesso hash)
+        """
+        with transaction.atomic():
+            creati, _aggiornati = CicloScambio.salva_batch(blocco, valido=False)
+        return creati
+
+    def _rimuovi_cicli_non_validi(self):
+        """
+        Cleanup cicli che non sono più validi (non trovati nel nuovo calcolo)
+        Ma SOLO se non hanno proposte attive!
+        """
         cicli_da_rimuovere = CicloScambio.objects.filter(
             valido=False
         ).exclude(
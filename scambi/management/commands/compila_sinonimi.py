@@ -0,0 +1,66 @@
+"""
+Comando Django per compilare la tabella dei sinonimi italiani usata dal matching.
+
+Legge WordNet (NLTK) una volta sola e salva su disco la tabella
+token → classi di sinonimi (scambi/data/sinonimi_ita.json). A runtime ogni worker
+carica la tabella invece di inizializzare WordNet, e il match per sinonimi
+diventa un'intersezione di insiemi di interi.
+
+Uso: python manage.py compila_sinonimi [--solo-annunci] [--output percorso]
+"""
+
+import json
+import os
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from scambi import synonym_matcher
+from scambi.models import Annuncio
+
+
+class Command(BaseCommand):
+    help = 'Compila la tabella token → classi di sinonimi da WordNet italiano'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default=synonym_matcher.PERCORSO_TABELLA_SINONIMI,
+            help='File di destinazione (default: scambi/data/sinonimi_ita.json)',
+        )
+        parser.add_argument(
+            '--solo-annunci',
+            action='store_true',
+            help='Include solo i token degli annunci esistenti e dei termini composti (tabella più piccola)',
+        )
+
+    def handle(self, *args, **options):
+        if not synonym_matcher.initialize_wordnet():
+            raise CommandError('WordNet italiano non disponibile: impossibile compilare la tabella')
+
+        from nltk.corpus import wordnet as wn
+        from scambi.matching import get_parole_chiave
+
+        token = set(synonym_matcher.COMPOUND_TERMS)
+
+        # Token degli annunci esistenti
+        for annuncio in Annuncio.objects.only('id', 'titolo', 'parole_chiave').iterator():
+            token.update(get_parole_chiave(annuncio))
+        self.stdout.write(f'📋 Token dagli annunci e termini composti: {len(token)}')
+
+        if not options['solo_annunci']:
+            # Tutti i lemmi italiani di WordNet, nella forma in cui arrivano dal matching
+            for lemma in wn.all_lemma_names(lang='ita'):
+                token.add(lemma.replace('_', ' ').lower())
+            self.stdout.write(f'📚 Token totali con i lemmi WordNet: {len(token)}')
+
+        tabella = synonym_matcher.compila_tabella_sinonimi(token)
+
+        output = options['output']
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(tabella, f, ensure_ascii=False, separators=(',', ':'))
+
+        dimensione_kb = os.path.getsize(output) / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f'[{datetime.now()}] ✅ Tabella sinonimi salvata in {output}: '
+            f'{len(tabella["token"])} token, {len(tabella["lemmi"])} classi ({dimensione_kb:.0f} KB)'
+        ))
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from scambi.models import Citta, DistanzaCitta
-import math
+from scambi.geo_distance import calcola_distanza_haversine
 
 
 class Command(BaseCommand):
@@ -191,7 +191,7 @@ class Command(BaseCommand):
 
         for i, citta_a in enumerate(tutte_citta):
             for citta_b in tutte_citta[i+1:]:  # Solo coppie uniche
-                distanza_km = self._calcola_distanza_haversine(
+                distanza_km = calcola_distanza_haversine(
                     citta_a.latitudine, citta_a.longitudine,
                     citta_b.latitudine, citta_b.longitudine
                 )
@@ -216,20 +216,3 @@ class Command(BaseCommand):
             f"\n🎉 Completato! {len(tutte_citta)} province italiane disponibili"
         ))
 
-    def _calcola_distanza_haversine(self, lat1, lon1, lat2, lon2):
-        """Calcola distanza in km tra due punti usando la formula di Haversine"""
-        R = 6371  # Raggio della Terra in km
-
-        lat1_rad = math.radians(lat1)
-        lon1_rad = math.radians(lon1)
-        lat2_rad = math.radians(lat2)
-        lon2_rad = math.radians(lon2)
-
-        dlat = lat2_rad - lat1_rad
-        dlon = lon2_rad - lon1_rad
-
-        a = (math.sin(dlat/2)**2 +
-             math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2)
-        c = 2 * math.asin(math.sqrt(a))
-
-        return R * c
@@ -0,0 +1,92 @@
+"""
+Comando Django per popolare i token di matching (parole chiave, termini composti,
+sinonimi) degli annunci esistenti.
+
+Da rieseguire con --tutti dopo modifiche a estrai_parole_chiave, ai termini
+composti o al dizionario dei sinonimi.
+
+Uso: python manage.py popola_token_matching [--tutti] [--dry-run]
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import models
+from scambi.models import Annuncio
+
+
+class Command(BaseCommand):
+    help = 'Popola parole_chiave, termini_composti e sinonimi_chiave degli annunci esistenti'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Mostra cosa verrebbe fatto senza salvare modifiche',
+        )
+        parser.add_argument(
+            '--tutti',
+            action='store_true',
+            help='Ricalcola i token di TUTTI gli annunci (non solo quelli senza token)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Numero di annunci aggiornati per query (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = options['batch_size']
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('🔍 Modalità DRY-RUN: nessuna modifica verrà salvata'))
+
+        annunci_da_aggiornare = Annuncio.objects.all()
+        if not options['tutti']:
+            # Solo annunci mai tokenizzati (o salvati quando WordNet non era disponibile)
+            annunci_da_aggiornare = annunci_da_aggiornare.filter(
+                models.Q(parole_chiave__isnull=True) | models.Q(sinonimi_chiave__isnull=True)
+            )
+
+        totale = annunci_da_aggiornare.count()
+
+        if totale == 0:
+            self.stdout.write(self.style.SUCCESS('✅ Nessun annuncio da aggiornare'))
+            return
+
+        self.stdout.write(f'\n📊 Trovati {totale} annunci da tokenizzare\n')
+
+        aggiornati = 0
+        senza_sinonimi = 0
+        batch = []
+
+        # bulk_update invece di save(): evita la logica di moderazione di Annuncio.save()
+        for annuncio in annunci_da_aggiornare.only('id', 'titolo').iterator(chunk_size=batch_size):
+            annuncio.aggiorna_token_matching()
+            if annuncio.sinonimi_chiave is None:
+                senza_sinonimi += 1
+
+            batch.append(annuncio)
+            aggiornati += 1
+
+            if len(batch) >= batch_size:
+                if not dry_run:
+                    Annuncio.objects.bulk_update(batch, Annuncio.CAMPI_TOKEN_MATCHING)
+                batch = []
+                self.stdout.write(f'   Processati {aggiornati}/{totale}...', ending='\r')
+
+        if batch and not dry_run:
+            Annuncio.objects.bulk_update(batch, Annuncio.CAMPI_TOKEN_MATCHING)
+
+        # Stampa risultati
+        self.stdout.write('\n')
+        self.stdout.write(self.style.SUCCESS(f'✅ {"Simulati" if dry_run else "Aggiornati"} {aggiornati} annunci\n'))
+
+        if senza_sinonimi:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️  {senza_sinonimi} annunci senza sinonimi (WordNet non disponibile): '
+                f'verranno calcolati al volo durante il matching'
+            ))
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('\n⚠️  Riesegui senza --dry-run per salvare le modifiche'))
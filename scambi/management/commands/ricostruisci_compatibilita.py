@@ -0,0 +1,42 @@
+"""
+Comando Django per ricostruire da zero la tabella CompatibilitaAnnunci.
+
+La tabella viene mantenuta in modo incrementale dai signals di Annuncio;
+questo comando serve per il primo popolamento e dopo modifiche che i signals
+non vedono (update() massivi, nuove regole di matching).
+
+Uso: python manage.py ricostruisci_compatibilita [--batch-size 1000]
+"""
+
+import time
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from scambi.matching import ricostruisci_compatibilita
+
+
+class Command(BaseCommand):
+    help = 'Ricostruisce da zero la tabella delle coppie di annunci compatibili'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Righe inserite per query (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+
+        self.stdout.write(
+            self.style.SUCCESS(f"[{datetime.now()}] 🔗 Ricostruzione tabella compatibilità...")
+        )
+
+        coppie = ricostruisci_compatibilita(batch_size=options['batch_size'])
+
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"[{datetime.now()}] ✅ Salvate {coppie} coppie compatibili in {elapsed:.1f}s"
+            )
+        )
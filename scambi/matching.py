@@ -5,6 +5,10 @@ from collections import defaultdict
 import re
 import math
 
+from .geo_distance import calcola_distanza_haversine, distanza_per_cicli, distanza_province, get_matrice_distanze
+from .dettagli_ciclo import annunci_ids_dettagli, comprimi_scambi, passaggi
+
+
 def trova_scambi_diretti():
     """Trova scambi diretti tra 2 persone (massima priorità) - VERSIONE OTTIMIZZATA"""
     print("\n🔄 === RICERCA SCAMBI DIRETTI OTTIMIZZATA (2 PERSONE) ===")
@@ -652,34 +656,66 @@ def normalizza_testo(testo):
 
 def estrai_parole_chiave(testo):
     """Estrae le parole chiave significative dal testo, preservando termini composti"""
-    print(f"🔧 ESTRAZIONE PAROLE da: '{testo}'")
-
     # NOVITÀ: Estrai termini composti PRIMA di normalizzare
     from .synonym_matcher import extract_compound_terms
     termini_composti = extract_compound_terms(testo)
-    print(f"🔧 Termini composti trovati: {termini_composti}")
 
     testo_normalizzato = normalizza_testo(testo)
-    print(f"🔧 Testo normalizzato: '{testo_normalizzato}'")
 
     # Stop words ridotte (solo le più comuni)
     stop_words = {'di', 'da', 'per', 'con', 'in', 'su', 'a', 'il', 'la', 'lo', 'e', 'o', 'del', 'della'}
 
     parole_base = set(testo_normalizzato.split())
-    print(f"🔧 Parole base: {parole_base}")
-
     parole_senza_stop = parole_base - stop_words
-    print(f"🔧 Senza stop words: {parole_senza_stop}")
 
     # Rimuovi parole troppo corte
     parole_singole = {p for p in parole_senza_stop if len(p) > 2}
-    print(f"🔧 Parole singole (>2 caratteri): {parole_singole}")
 
     # UNISCI parole singole + termini composti
-    parole_finali = parole_singole | termini_composti
-    print(f"🔧 Parole finali (singole + composti): {parole_finali}")
+    return parole_singole | termini_composti
+
+def calcola_token_annuncio(titolo):
+    """
+    Calcola i token di un titolo da memorizzare sull'annuncio (vedi Annuncio.save).
+
+    Returns:
+        dict: parole_chiave, termini_composti (liste ordinate) e sinonimi_chiave
+              (None se i sinonimi non sono disponibili: verranno calcolati al volo)
+    """
+    from .synonym_matcher import extract_compound_terms, sinonimi_disponibili, espandi_sinonimi_significativi
+
+    parole = estrai_parole_chiave(titolo)
+
+    sinonimi = None
+    try:
+        if sinonimi_disponibili():
+            sinonimi = sorted(espandi_sinonimi_significativi(parole))
+    except Exception:
+        pass
+
+    return {
+        'parole_chiave': sorted(parole),
+        'termini_composti': sorted(extract_compound_terms(titolo)),
+        'sinonimi_chiave': sinonimi,
+    }
 
-    return parole_finali
+def get_parole_chiave(annuncio):
+    """Parole chiave memorizzate sull'annuncio, o estratte dal titolo se mancanti"""
+    parole = getattr(annuncio, 'parole_chiave', None)
+    if parole is not None:
+        return set(parole)
+    return estrai_parole_chiave(annuncio.titolo)
+
+def get_sinonimi_chiave(annuncio, parole=None):
+    """Sinonimi significativi memorizzati sull'annuncio, o calcolati se mancanti"""
+    sinonimi = getattr(annuncio, 'sinonimi_chiave', None)
+    if sinonimi is not None:
+        return set(sinonimi)
+    try:
+        from .synonym_matcher import espandi_sinonimi_significativi
+        return espandi_sinonimi_significativi(parole if parole is not None else get_parole_chiave(annuncio))
+    except Exception:
+        return set()
 
 def oggetti_compatibili_con_tipo(annuncio_offerto, annuncio_cercato):
     """Matching avanzato che restituisce anche il tipo di match"""
@@ -701,12 +737,30 @@ def oggetti_compatibili_con_tipo(annuncio_offerto, annuncio_cercato):
             return False, None
 
     # 1. MATCH SPECIFICO OTTIMIZZATO: Usa solo i titoli per velocità
-    testo_offerto = annuncio_offerto.titolo
-    testo_cercato = annuncio_cercato.titolo
+    # Usa i token memorizzati sull'annuncio se disponibili (vedi Annuncio.save)
+    parole_offerto = get_parole_chiave(annuncio_offerto)
+    parole_cercato = get_parole_chiave(annuncio_cercato)
+
+    sinonimi_offerto = getattr(annuncio_offerto, 'sinonimi_chiave', None)
+    sinonimi_cercato = getattr(annuncio_cercato, 'sinonimi_chiave', None)
+    if sinonimi_offerto is not None and sinonimi_cercato is not None:
+        return tipo_match_da_parole(parole_offerto, parole_cercato, set(sinonimi_offerto), set(sinonimi_cercato))
 
-    parole_offerto = estrai_parole_chiave(testo_offerto)
-    parole_cercato = estrai_parole_chiave(testo_cercato)
+    return tipo_match_da_parole(parole_offerto, parole_cercato)
 
+def tipo_match_da_parole(parole_offerto, parole_cercato, sinonimi_offerto=None, sinonimi_cercato=None,
+                         token_parziali_offerto=None):
+    """
+    Matching sui titoli a partire dalle parole chiave già estratte.
+    Usato da oggetti_compatibili_con_tipo e dall'indice del grafo (keyword_index)
+    per non ri-tokenizzare lo stesso titolo a ogni confronto.
+
+    sinonimi_offerto/sinonimi_cercato: espansioni sinonimi già calcolate
+    (vedi get_sinonimi_chiave); se assenti si usa check_synonym_match.
+    token_parziali_offerto: token del vocabolario delle richieste parzialmente
+    compatibili con l'offerta (vedi KeywordIndex.token_parziali_annuncio); se
+    presente il match parziale è un'intersezione invece del confronto a coppie.
+    """
     # BUG FIX: Se parole_cercato è vuoto (es. titolo troppo corto come "bo"),
     # NON deve matchare con tutto. Richiede almeno una parola chiave valida.
     if not parole_cercato:
@@ -720,17 +774,24 @@ def oggetti_compatibili_con_tipo(annuncio_offerto, annuncio_cercato):
         return True, "specifico"
 
     # 2. MATCH PARZIALE: Alcune parole dell'offerta sono contenute nella ricerca
-    for parola_offerta in parole_offerto:
-        for parola_cercata in parole_cercato:
-            if ((parola_offerta in parola_cercata or parola_cercata in parola_offerta) and
-                len(parola_offerta) > 3 and len(parola_cercata) > 3):
-                return True, "parziale"
+    if token_parziali_offerto is not None:
+        if not token_parziali_offerto.isdisjoint(parole_cercato):
+            return True, "parziale"
+    else:
+        for parola_offerta in parole_offerto:
+            for parola_cercata in parole_cercato:
+                if ((parola_offerta in parola_cercata or parola_cercata in parola_offerta) and
+                    len(parola_offerta) > 3 and len(parola_cercata) > 3):
+                    return True, "parziale"
 
     # 2.5 MATCH CON SINONIMI: Priorità ALTA - Prima della categoria
     # I sinonimi sono match semantici forti, devono avere priorità sulla categoria
     try:
-        from .synonym_matcher import check_synonym_match
-        compatibile_sinonimo, tipo = check_synonym_match(parole_offerto, parole_cercato)
+        if sinonimi_offerto is not None and sinonimi_cercato is not None:
+            compatibile_sinonimo = bool(sinonimi_offerto & sinonimi_cercato)
+        else:
+            from .synonym_matcher import check_synonym_match
+            compatibile_sinonimo, tipo = check_synonym_match(parole_offerto, parole_cercato)
         if compatibile_sinonimo:
             return True, "sinonimo"  # Marcato come 'sinonimo' per consentire filtraggio
     except Exception as e:
@@ -805,13 +866,19 @@ def verifica_compatibilita_distanza(annuncio_a, annuncio_b, distanza_km):
 
     return False, f"distanza_eccessiva_{distanza_km:.0f}km_limite_{distanza_massima_accettabile}km"
 
-def calcola_punteggio_qualita_avanzato(annuncio_offerto, annuncio_cercato, distanza_km):
-    """Calcola punteggio di qualità considerando tutti i nuovi criteri"""
+def calcola_punteggio_qualita_avanzato(annuncio_offerto, annuncio_cercato, distanza_km, tipo_match=None):
+    """
+    Calcola punteggio di qualità considerando tutti i nuovi criteri
+    (tipo_match: tipo di match già noto, per non rifare il matching dei titoli)
+    """
     punteggio = 0
     dettagli = []
 
     # 1. Compatibilità contenuto (peso: 40%)
-    compatible, tipo_match = oggetti_compatibili_con_tipo(annuncio_offerto, annuncio_cercato)
+    if tipo_match is None:
+        compatible, tipo_match = oggetti_compatibili_con_tipo(annuncio_offerto, annuncio_cercato)
+    else:
+        compatible = True
     if compatible:
         if "specifico" in tipo_match:
             punteggio += 40
@@ -895,43 +962,27 @@ def oggetti_compatibili_avanzato(annuncio_offerto, annuncio_cercato, distanza_km
     return True, punteggio, dettagli
 
 def calcola_distanza_geografica(utente_a, utente_b):
-    """Calcola distanza geografica tra due utenti usando il database città"""
-    try:
-        profile_a = UserProfile.objects.get(user=utente_a)
-        profile_b = UserProfile.objects.get(user=utente_b)
-
-        # Usa il nuovo metodo del profilo
-        distanza_km = profile_a.get_distanza_km(profile_b)
-
-        if distanza_km == 0:
-            return 0, "stessa_citta"
-        elif distanza_km >= 9999:
-            return 9999, "posizione_sconosciuta"
-        elif distanza_km <= 50:
-            return distanza_km, "province_vicine"
-        else:
-            return distanza_km, "province_lontane"
+    """Calcola distanza geografica tra due utenti dalla matrice distanze delle province"""
+    user_id_a = getattr(utente_a, 'pk', utente_a)
+    user_id_b = getattr(utente_b, 'pk', utente_b)
 
-    except UserProfile.DoesNotExist:
+    # Solo le province dei due profili, in una query
+    province = dict(
+        UserProfile.objects.filter(user_id__in=[user_id_a, user_id_b]).values_list('user_id', 'provincia_obj_id')
+    )
+    if user_id_a not in province or user_id_b not in province:
         return 9999, "profilo_mancante"
 
-def calcola_distanza_haversine(lat1, lon1, lat2, lon2):
-    """Calcola distanza in km tra due punti usando la formula di Haversine"""
-    R = 6371  # Raggio della Terra in km
-
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-
-    a = (math.sin(dlat/2)**2 +
-         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2)
-    c = 2 * math.asin(math.sqrt(a))
+    distanza_km = distanza_province(province[user_id_a], province[user_id_b])
 
-    return R * c
+    if distanza_km == 0:
+        return 0, "stessa_citta"
+    elif distanza_km >= 9999:
+        return 9999, "posizione_sconosciuta"
+    elif distanza_km <= 50:
+        return distanza_km, "province_vicine"
+    else:
+        return distanza_km, "province_lontane"
 
 def classifica_distanza(distanza_km):
     """Classifica la distanza geografica"""
@@ -956,6 +1007,300 @@ import json
 from datetime import datetime
 
 
+def filtro_annunci_validi(prefisso=''):
+    """
+    Filtro Q per gli annunci che partecipano al calcolo cicli:
+    annunci attivi + annunci disattivati da meno di 3 minuti
+
+    Args:
+        prefisso: percorso della relazione verso Annuncio (es. 'offerta__')
+    """
+    from django.utils import timezone
+    from datetime import timedelta
+
+    tre_minuti_fa = timezone.now() - timedelta(minutes=3)
+    return Q(**{f'{prefisso}attivo': True}) | Q(**{
+        f'{prefisso}attivo': False,
+        f'{prefisso}disattivato_at__isnull': False,
+        f'{prefisso}disattivato_at__gte': tre_minuti_fa,
+    })
+
+
+# === TABELLA COMPATIBILITÀ ANNUNCI ===
+
+def provincia_annuncio(annuncio):
+    """Id della provincia del proprietario dell'annuncio (None se non ha profilo)"""
+    try:
+        return annuncio.utente.userprofile.provincia_obj_id
+    except Exception:
+        return None
+
+
+def distanza_tra_annunci(annuncio_a, annuncio_b):
+    """
+    Distanza in km tra le province dei proprietari, per tabella e cicli
+    (DISTANZA_SCONOSCIUTA_CICLI se una provincia non è nota, vedi geo_distance)
+    """
+    return distanza_per_cicli(distanza_province(provincia_annuncio(annuncio_a), provincia_annuncio(annuncio_b)))
+
+
+def crea_riga_compatibilita(offerta, richiesta, tipo_match, distanza_km):
+    """Riga CompatibilitaAnnunci (non salvata) per una coppia compatibile"""
+    from .models import CompatibilitaAnnunci
+
+    punteggio, _ = calcola_punteggio_qualita_avanzato(offerta, richiesta, distanza_km, tipo_match)
+    return CompatibilitaAnnunci(
+        offerta=offerta,
+        richiesta=richiesta,
+        tipo_match=tipo_match,
+        punteggio=int(punteggio),
+        distanza_km=distanza_km,
+    )
+
+
+def aggiorna_compatibilita_annuncio(annuncio):
+    """
+    Ricalcola SOLO le righe di CompatibilitaAnnunci dell'annuncio
+    (come offerta se 'offro', come richiesta se 'cerco').
+
+    Il confronto avviene con tutti gli annunci di tipo opposto, anche non attivi:
+    lo stato attivo viene filtrato al momento della query, così una
+    riattivazione non richiede ricalcoli. Le coppie vengono dal kernel a bitmask
+    (KeywordIndex + CompatibilityKernel) invece che da un matching per coppia,
+    le distanze da una sola query sulle province dei proprietari.
+
+    Returns:
+        int: numero di coppie compatibili salvate
+    """
+    from django.db import transaction
+    from .models import CompatibilitaAnnunci
+    from .keyword_index import KeywordIndex
+    from .compatibility_kernel import CompatibilityKernel
+
+    tipo_opposto = 'cerco' if annuncio.tipo == 'offro' else 'offro'
+    altri = list(
+        Annuncio.objects.filter(tipo=tipo_opposto).exclude(
+            utente_id=annuncio.utente_id
+        ).order_by('id')
+    )
+
+    # L'indice è sempre sulle richieste: quelle degli altri utenti, o solo l'annuncio se 'cerco'
+    if annuncio.tipo == 'offro':
+        indice, offerte = KeywordIndex(altri), [annuncio]
+    else:
+        indice, offerte = KeywordIndex([annuncio]), altri
+    coppie = list(CompatibilityKernel(indice).coppie_compatibili(offerte))
+
+    utenti_ids = {offerta.utente_id for offerta, _r, _t in coppie} | {richiesta.utente_id for _o, richiesta, _t in coppie}
+    province = dict(
+        UserProfile.objects.filter(user_id__in=utenti_ids).values_list('user_id', 'provincia_obj_id')
+    )
+    righe = [
+        crea_riga_compatibilita(
+            offerta, richiesta, tipo_match,
+            distanza_per_cicli(distanza_province(province.get(offerta.utente_id), province.get(richiesta.utente_id)))
+        )
+        for offerta, richiesta, tipo_match in coppie
+    ]
+
+    with transaction.atomic():
+        CompatibilitaAnnunci.objects.filter(Q(offerta=annuncio) | Q(richiesta=annuncio)).delete()
+        CompatibilitaAnnunci.objects.bulk_create(righe)
+
+    return len(righe)
+
+
+def aggiorna_distanze_utente(user_id):
+    """
+    Ricalcola distanza_km (e il punteggio, che ne dipende) delle righe di
+    CompatibilitaAnnunci di un utente che ha cambiato provincia
+    (vedi signals di UserProfile), senza rifare il matching dei titoli.
+
+    Returns:
+        int: numero di righe aggiornate
+    """
+    from django.utils import timezone
+    from .models import CompatibilitaAnnunci
+
+    righe = list(
+        CompatibilitaAnnunci.objects.filter(
+            Q(offerta__utente_id=user_id) | Q(richiesta__utente_id=user_id)
+        ).select_related(
+            'offerta__utente__userprofile', 'richiesta__utente__userprofile'
+        )
+    )
+
+    adesso = timezone.now()
+    for riga in righe:
+        riga.distanza_km = distanza_tra_annunci(riga.offerta, riga.richiesta)
+        punteggio, _ = calcola_punteggio_qualita_avanzato(riga.offerta, riga.richiesta, riga.distanza_km, riga.tipo_match)
+        riga.punteggio = int(punteggio)
+        riga.calcolato_at = adesso
+
+    CompatibilitaAnnunci.objects.bulk_update(righe, ['distanza_km', 'punteggio', 'calcolato_at'], batch_size=1000)
+    return len(righe)
+
+
+def ricostruisci_compatibilita(batch_size=1000):
+    """
+    Ricostruisce da zero l'intera tabella CompatibilitaAnnunci usando
+    l'indice invertito (KeywordIndex) e il kernel a bitmask (CompatibilityKernel).
+
+    Returns:
+        int: numero di coppie compatibili salvate
+    """
+    from django.db import transaction
+    from .models import CompatibilitaAnnunci
+    from .keyword_index import KeywordIndex
+    from .compatibility_kernel import CompatibilityKernel
+
+    annunci = list(
+        Annuncio.objects.select_related(
+            'utente__userprofile__provincia_obj', 'categoria'
+        ).order_by('id')
+    )
+    indice = KeywordIndex(a for a in annunci if a.tipo == 'cerco')
+    offerte = [a for a in annunci if a.tipo == 'offro']
+
+    distanze = {}
+    righe = []
+    for offerta, richiesta, tipo_match in CompatibilityKernel(indice).coppie_compatibili(offerte):
+        chiave = (offerta.utente_id, richiesta.utente_id)
+        if chiave not in distanze:
+            distanze[chiave] = distanza_tra_annunci(offerta, richiesta)
+        righe.append(crea_riga_compatibilita(offerta, richiesta, tipo_match, distanze[chiave]))
+
+    with transaction.atomic():
+        CompatibilitaAnnunci.objects.all().delete()
+        CompatibilitaAnnunci.objects.bulk_create(righe, batch_size=batch_size)
+
+    return len(righe)
+
+
+# === AMMISSIBILITÀ DEGLI SCAMBI ===
+# Un unico predicato decide se una coppia offerta/richiesta può diventare un arco
+# del grafo: lo stesso usato per i dettagli dei cicli, così un ciclo trovato ha
+# sempre tutti gli scambi visualizzabili (niente cicli "incompleti" in lettura).
+
+def annuncio_visibile(annuncio):
+    """
+    Annuncio attivo e approvato (o senza immagine, che non richiede moderazione).
+    Versione in memoria di filtro_annunci_visibili.
+    """
+    return annuncio.attivo and (annuncio.moderation_status == 'approved' or not annuncio.immagine)
+
+
+def filtro_annunci_visibili(prefisso=''):
+    """
+    Filtro Q equivalente ad annuncio_visibile
+
+    Args:
+        prefisso: percorso della relazione verso Annuncio (es. 'offerta__')
+    """
+    return Q(**{f'{prefisso}attivo': True}) & (
+        Q(**{f'{prefisso}moderation_status': 'approved'}) |
+        Q(**{f'{prefisso}immagine': ''}) |
+        Q(**{f'{prefisso}immagine__isnull': True})
+    )
+
+
+def coppia_ammissibile(offerta, richiesta, distanza_km):
+    """
+    Predicato di ammissibilità di uno scambio offerta → richiesta (titoli già compatibili):
+    entrambi gli annunci visibili, metodo di scambio compatibile e distanza entro
+    il limite di entrambi (se lo scambio non è per spedizione; distanza sconosciuta =
+    DISTANZA_SCONOSCIUTA_CICLI, vedi geo_distance).
+    """
+    if not (annuncio_visibile(offerta) and annuncio_visibile(richiesta)):
+        return False
+    if not verifica_compatibilita_metodo_scambio(offerta, richiesta)[0]:
+        return False
+    return verifica_compatibilita_distanza(offerta, richiesta, distanza_per_cicli(distanza_km))[0]
+
+
+def filtro_compatibilita_ammissibili():
+    """
+    Filtro Q su CompatibilitaAnnunci equivalente a coppia_ammissibile
+    (usa la distanza_km memorizzata sulla riga)
+    """
+    from django.db.models import F
+
+    metodo_incompatibile = (
+        Q(offerta__metodo_scambio='mano', richiesta__metodo_scambio='spedizione') |
+        Q(offerta__metodo_scambio='spedizione', richiesta__metodo_scambio='mano')
+    )
+    spedizione = Q(offerta__metodo_scambio='spedizione') | Q(richiesta__metodo_scambio='spedizione')
+
+    def limite_rispettato(prefisso):
+        # distanza_massima_km vuota (o 0) = nessun limite
+        return (
+            Q(**{f'{prefisso}distanza_massima_km__isnull': True}) |
+            Q(**{f'{prefisso}distanza_massima_km': 0}) |
+            Q(**{f'{prefisso}distanza_massima_km__gte': F('distanza_km')})
+        )
+
+    return (
+        filtro_annunci_visibili('offerta__') &
+        filtro_annunci_visibili('richiesta__') &
+        ~metodo_incompatibile &
+        (spedizione | (limite_rispettato('offerta__') & limite_rispettato('richiesta__')))
+    )
+
+
+# === FASCE DI PREZZO ===
+# Ogni arco porta la maschera delle fasce in cui almeno una sua coppia di annunci
+# è "alla pari"; un ciclo è alla pari se l'AND delle maschere dei suoi archi non è zero.
+
+FASCE_IGNORA = 'ignora'          # nessun vincolo (il flag viene comunque calcolato)
+FASCE_PREFERISCI = 'preferisci'  # cicli alla pari per primi
+FASCE_SOLO_PARI = 'solo_pari'    # solo cicli alla pari
+MODALITA_FASCE = (FASCE_IGNORA, FASCE_PREFERISCI, FASCE_SOLO_PARI)
+
+FASCE_PREZZO = ('economico', 'basso', 'medio', 'alto', 'premium')
+_BIT_FASCIA = {fascia: 1 << i for i, fascia in enumerate(FASCE_PREZZO)}
+TUTTE_LE_FASCE = (1 << len(FASCE_PREZZO)) - 1
+
+
+def maschera_fasce_coppia(offerta, richiesta):
+    """
+    Fasce in cui lo scambio offerta → richiesta è alla pari: la fascia comune,
+    tutte se nessuno dei due annunci ha una fascia, nessuna se le fasce sono diverse
+    """
+    fasce = {f for f in (offerta.fascia_prezzo, richiesta.fascia_prezzo) if f}
+    if not fasce:
+        return TUTTE_LE_FASCE
+    if len(fasce) > 1:
+        return 0
+    return _BIT_FASCIA.get(fasce.pop(), 0)
+
+
+# Snapshot degli archi dell'ultimo calcolo tenuto in memoria dal processo
+# (timestamp del calcolo, set di archi), vedi get_snapshot_archi
+_SNAPSHOT_ARCHI = None
+
+
+def get_snapshot_archi():
+    """
+    Archi del grafo all'ultimo calcolo (CalcoloMetadata.archi_grafo), caricati una
+    volta per processo e ricaricati solo quando cambia il timestamp del calcolo.
+
+    Returns:
+        set di (user_da, user_a), o None se non c'è ancora uno snapshot
+    """
+    global _SNAPSHOT_ARCHI
+    from .models import CalcoloMetadata
+
+    metadati = CalcoloMetadata.objects.filter(singleton_id=1)
+    ultimo_calcolo = metadati.values_list('ultimo_calcolo_completo', flat=True).first()
+    if ultimo_calcolo is None:
+        return None
+
+    if _SNAPSHOT_ARCHI is None or _SNAPSHOT_ARCHI[0] != ultimo_calcolo:
+        metadata = metadati.only('archi_grafo').first()
+        _SNAPSHOT_ARCHI = (ultimo_calcolo, metadata.get_archi_grafo() if metadata else None)
+    return _SNAPSHOT_ARCHI[1]
+
+
 class CycleFinder:
     """
     Classe per trovare cicli di scambio usando algoritmo DFS
@@ -968,6 +1313,69 @@ class CycleFinder:
         self.cicli_trovati = []
         self.cicli_hash_set = set()  # Per evitare duplicati
 
+        # Stato del caricamento annunci (vedi carica_annunci)
+        self.annunci = None  # dict: annuncio_id -> Annuncio
+        self.offerte_per_utente = {}  # dict: user_id -> [Annuncio 'offro']
+        self.richieste_per_utente = {}  # dict: user_id -> [Annuncio 'cerco']
+        self.indice = None  # KeywordIndex sulle richieste caricate
+
+        # Coppie di annunci dietro ogni arco (vedi costruisci_grafo)
+        self.archi_annunci = {}  # dict: (user_da, user_a) -> [(offerta, richiesta, tipo_match)]
+        self._grafo_inverso = None  # dict: user_id -> [predecessori], vedi get_grafo_inverso
+        self.punteggi_archi = None  # dict: (user_da, user_a) -> punteggio, se il grafo viene da CompatibilitaAnnunci
+        self._maschere_fasce = None  # dict: (user_da, user_a) -> maschera fasce alla pari, vedi get_maschere_fasce
+        self.modalita_fasce = FASCE_IGNORA  # vedi MODALITA_FASCE
+        self._punteggi_scambi = {}  # dict: (offerta_id, richiesta_id) -> punteggio qualità, vedi _attributi_ciclo
+
+    def carica_annunci(self, utenti_ids=None):
+        """
+        Carica in una sola query tutti gli annunci validi per il calcolo
+        (attivi + disattivati da meno di 3 minuti) con utente, profilo,
+        provincia e categoria, e li raggruppa in offerte/richieste per utente.
+        Tutti gli altri metodi lavorano su questi array invece di interrogare il DB.
+
+        Args:
+            utenti_ids: se indicato, solo gli annunci di questi utenti
+                        (es. i dettagli dei cicli di un ricalcolo su richiesta)
+        """
+        from .keyword_index import KeywordIndex
+
+        annunci_validi = Annuncio.objects.filter(filtro_annunci_validi())
+        if utenti_ids is not None:
+            annunci_validi = annunci_validi.filter(utente_id__in=list(utenti_ids))
+        annunci_validi = list(
+            annunci_validi.select_related(
+                'utente',
+                'utente__userprofile',
+                'utente__userprofile__provincia_obj',
+                'categoria',
+            ).order_by('id')
+        )
+
+        self.annunci = {a.id: a for a in annunci_validi}
+        self._punteggi_scambi = {}
+        self.offerte_per_utente = defaultdict(list)
+        self.richieste_per_utente = defaultdict(list)
+
+        for annuncio in annunci_validi:
+            if annuncio.tipo == 'offro':
+                self.offerte_per_utente[annuncio.utente_id].append(annuncio)
+            elif annuncio.tipo == 'cerco':
+                self.richieste_per_utente[annuncio.utente_id].append(annuncio)
+
+        # Le richieste non visibili non possono formare archi (vedi coppia_ammissibile)
+        self.indice = KeywordIndex(
+            r for richieste in self.richieste_per_utente.values() for r in richieste
+            if annuncio_visibile(r)
+        )
+
+        print(f"[{datetime.now()}] 📊 Annunci validi caricati: {len(self.annunci)} (inclusi disattivati <3 min)")
+        return self.annunci
+
+    def _assicura_annunci_caricati(self):
+        if self.annunci is None:
+            self.carica_annunci()
+
     def get_annunci_modificati(self, timestamp_ultimo_calcolo):
         """
         Trova gli annunci modificati dall'ultimo calcolo
@@ -980,128 +1388,255 @@ class CycleFinder:
             QuerySet di Annuncio modificati
         """
         from .models import Annuncio
-        from django.db.models import Q
-        from django.utils import timezone
-        from datetime import timedelta
-
-        tre_minuti_fa = timezone.now() - timedelta(minutes=3)
-
-        # Filtro per annunci validi
-        filtro_validi = Q(attivo=True) | Q(attivo=False, disattivato_at__isnull=False, disattivato_at__gte=tre_minuti_fa)
 
         annunci_modificati = Annuncio.objects.filter(
             last_modified__gt=timestamp_ultimo_calcolo
-        ).filter(filtro_validi)
+        ).filter(filtro_annunci_validi())
 
         print(f"[{datetime.now()}] 📋 Trovati {annunci_modificati.count()} annunci modificati dal {timestamp_ultimo_calcolo}")
         return annunci_modificati
 
-    def get_utenti_impattati(self, annunci_modificati):
+    def get_utenti_modificati(self, timestamp_ultimo_calcolo):
         """
-        Trova tutti gli utenti che potrebbero essere impattati dalle modifiche
-        Include:
-        - Utenti proprietari degli annunci modificati
-        - Utenti che hanno annunci compatibili con quelli modificati
+        Utenti i cui archi del grafo possono essere cambiati dall'ultimo calcolo:
+        - proprietari degli annunci modificati, in qualsiasi stato (anche gli
+          annunci disattivati da più di 3 minuti cambiano gli archi del grafo)
+        - proprietari degli annunci usciti dalla finestra dei 3 minuti dopo la
+          disattivazione: l'ultimo calcolo li includeva ancora
+        - utenti registrati dai signals (annuncio eliminato, cambio di provincia),
+          vedi UtenteModificato
+
+        Returns:
+            set di user_id
+        """
+        from datetime import timedelta
+        from .models import Annuncio, UtenteModificato
+
+        annunci_cambiati = Q(last_modified__gt=timestamp_ultimo_calcolo) | Q(
+            attivo=False,
+            disattivato_at__gt=timestamp_ultimo_calcolo - timedelta(minutes=3),
+        )
+        utenti = set(
+            Annuncio.objects.filter(annunci_cambiati).values_list('utente_id', flat=True).order_by().distinct()
+        )
+        return utenti | UtenteModificato.modificati_dal(timestamp_ultimo_calcolo)
+
+    def invalida_cicli_con_utenti(self, utenti_ids):
+        """
+        Marca come non validi tutti i cicli che coinvolgono gli utenti specificati
 
         Args:
-            annunci_modificati: QuerySet di annunci modificati
+            utenti_ids: set/list di user_id impattati
 
         Returns:
-            set di user_id impattati
+            int: Numero di cicli invalidati
         """
-        utenti_impattati = set()
+        from .models import CicloScambio, CicloUtente
 
-        # 1. Utenti proprietari degli annunci modificati
-        for annuncio in annunci_modificati:
-            utenti_impattati.add(annuncio.utente.id)
+        utenti_ids = list(utenti_ids)
+        if not utenti_ids:
+            return 0
 
-        # 2. Utenti che potrebbero scambiare con questi annunci
-        # (annunci compatibili)
-        from django.db.models import Q
-        from django.utils import timezone
-        from datetime import timedelta
+        # Un solo UPDATE ... WHERE id IN (cicli degli utenti da CicloUtente)
+        count_invalidati = CicloScambio.objects.filter(
+            valido=True,
+            id__in=CicloUtente.objects.filter(utente_id__in=utenti_ids).values('ciclo_id')
+        ).update(valido=False)
 
-        tre_minuti_fa = timezone.now() - timedelta(minutes=3)
-        filtro_validi = Q(attivo=True) | Q(attivo=False, disattivato_at__isnull=False, disattivato_at__gte=tre_minuti_fa)
+        print(f"[{datetime.now()}] ❌ Invalidati {count_invalidati} cicli impattati")
+        return count_invalidati
 
-        for annuncio_mod in annunci_modificati:
-            annunci_tutti_validi = Annuncio.objects.filter(filtro_validi)
-            utenti_tutti = User.objects.filter(annuncio__in=annunci_tutti_validi).distinct()
+    def invalida_cicli_con_archi(self, archi):
+        """
+        Marca come non validi SOLO i cicli che percorrono uno degli archi indicati
+        (archi rimossi dal grafo dall'ultimo calcolo)
 
-            for utente in utenti_tutti:
-                if utente.id == annuncio_mod.utente.id:
-                    continue
+        Args:
+            archi: set di (user_da, user_a)
 
-                # Controlla se c'è match tra questo utente e l'annuncio modificato
-                if self._utente_compatibile_con_annuncio(utente, annuncio_mod):
-                    utenti_impattati.add(utente.id)
+        Returns:
+            int: Numero di cicli invalidati
+        """
+        from .models import CicloScambio, CicloUtente
+        from .cycle_engine import ciclo_usa_archi
+
+        archi = set(archi)
+        if not archi:
+            return 0
+
+        # Candidati: i cicli che contengono l'utente di partenza di un arco (da CicloUtente),
+        # poi in Python solo quelli che percorrono davvero uno degli archi
+        utenti_partenza = sorted({user_da for user_da, _user_a in archi})
+        cicli_candidati = CicloScambio.objects.filter(
+            valido=True,
+            id__in=CicloUtente.objects.filter(utente_id__in=utenti_partenza).values('ciclo_id')
+        ).only('id', 'users')
+        candidati_ids = {
+            c.id for c in cicli_candidati.iterator() if ciclo_usa_archi(c.users, archi)
+        }
+
+        count_invalidati = CicloScambio.objects.filter(id__in=candidati_ids).update(valido=False) if candidati_ids else 0
 
-        print(f"[{datetime.now()}] 👥 Identificati {len(utenti_impattati)} utenti impattati dalle modifiche")
-        return utenti_impattati
+        print(f"[{datetime.now()}] ❌ Invalidati {count_invalidati} cicli che usavano {len(archi)} archi rimossi")
+        return count_invalidati
 
-    def _utente_compatibile_con_annuncio(self, utente, annuncio):
+    def archi_utenti(self, utenti_ids, da_compatibilita=False):
         """
-        Verifica se un utente ha annunci compatibili con l'annuncio dato
-        Include annunci disattivati da meno di 3 minuti
+        Archi attuali del grafo con almeno un estremo tra gli utenti indicati,
+        calcolati solo a partire dai loro annunci (stesso predicato di costruisci_grafo):
+        - da_compatibilita: righe di CompatibilitaAnnunci delle loro offerte e richieste
+        - altrimenti: righe del kernel per le loro offerte (su tutte le richieste)
+          e colonne per le loro richieste (indice sulle sole loro richieste)
+
+        Returns:
+            set di (user_da, user_a)
         """
-        from django.db.models import Q
-        from django.utils import timezone
-        from datetime import timedelta
+        utenti_ids = set(utenti_ids)
+        if not utenti_ids:
+            return set()
+
+        if da_compatibilita:
+            from .models import CompatibilitaAnnunci
+
+            return set(
+                CompatibilitaAnnunci.objects.filter(
+                    filtro_compatibilita_ammissibili(),
+                    Q(offerta__utente_id__in=utenti_ids) | Q(richiesta__utente_id__in=utenti_ids),
+                ).values_list('offerta__utente_id', 'richiesta__utente_id').order_by().distinct()
+            )
 
-        tre_minuti_fa = timezone.now() - timedelta(minutes=3)
-        filtro_validi = Q(attivo=True) | Q(attivo=False, disattivato_at__isnull=False, disattivato_at__gte=tre_minuti_fa)
+        from itertools import chain
+        from .compatibility_kernel import CompatibilityKernel
+        from .keyword_index import KeywordIndex
 
-        if annuncio.tipo == 'offro':
-            # L'annuncio offre qualcosa, cerchiamo chi lo cerca
-            richieste_utente = Annuncio.objects.filter(utente=utente, tipo='cerco').filter(filtro_validi)
-            for richiesta in richieste_utente:
-                compatible, tipo_match = oggetti_compatibili_con_tipo(annuncio, richiesta)
-                if compatible and tipo_match in ['specifico', 'parziale']:
-                    return True
-        else:
-            # L'annuncio cerca qualcosa, cerchiamo chi lo offre
-            offerte_utente = Annuncio.objects.filter(utente=utente, tipo='offro').filter(filtro_validi)
-            for offerta in offerte_utente:
-                compatible, tipo_match = oggetti_compatibili_con_tipo(offerta, annuncio)
-                if compatible and tipo_match in ['specifico', 'parziale']:
-                    return True
+        self._assicura_annunci_caricati()
+        offerte = [o for offerte in self.offerte_per_utente.values() for o in offerte if annuncio_visibile(o)]
+        offerte_utenti = [o for o in offerte if o.utente_id in utenti_ids]
+        indice_utenti = KeywordIndex(
+            r for user_id in sorted(utenti_ids) for r in self.richieste_per_utente.get(user_id, [])
+            if annuncio_visibile(r)
+        )
 
-        return False
+        coppie = chain(
+            CompatibilityKernel(self.indice).coppie_compatibili(offerte_utenti),
+            CompatibilityKernel(indice_utenti).coppie_compatibili(offerte),
+        )
+        archi = set()
+        for offerta, richiesta, _tipo_match in coppie:
+            arco = (offerta.utente_id, richiesta.utente_id)
+            if arco not in archi and coppia_ammissibile(offerta, richiesta, self._distanza_tra_utenti(*arco)):
+                archi.add(arco)
+        return archi
+
+    def aggiorna_grafo(self, archi_precedenti, utenti_ids, da_compatibilita=False):
+        """
+        Grafo attuale ottenuto aggiornando lo snapshot dell'ultimo calcolo invece di
+        ricostruirlo: gli archi con un estremo tra gli utenti indicati (proprietari
+        degli annunci modificati) vengono sostituiti da quelli di archi_utenti,
+        tutti gli altri restano quelli dello snapshot.
 
-    def invalida_cicli_con_utenti(self, utenti_ids):
+        Args:
+            archi_precedenti: set di (user_da, user_a) dell'ultimo calcolo
+            utenti_ids: utenti i cui annunci sono cambiati
+            da_compatibilita: vedi archi_utenti
+
+        Returns:
+            tuple: (archi aggiunti, archi rimossi)
         """
-        Marca come non validi tutti i cicli che coinvolgono gli utenti specificati
+        utenti_ids = set(utenti_ids)
+        prima = {arco for arco in archi_precedenti if arco[0] in utenti_ids or arco[1] in utenti_ids}
+        dopo = self.archi_utenti(utenti_ids, da_compatibilita)
+        aggiunti = dopo - prima
+        rimossi = prima - dopo
+
+        archi = defaultdict(set)
+        for user_da, user_a in (archi_precedenti - rimossi) | aggiunti:
+            archi[user_da].add(user_a)
+
+        # Solo nodi con collegamenti, in ordine deterministico
+        self.grafo = {
+            user_id: sorted(archi[user_id])
+            for user_id in sorted(archi)
+        }
+        self._grafo_inverso = None
+        self.archi_annunci = {}
+        self.punteggi_archi = None
+        self._maschere_fasce = {}  # calcolate solo per gli archi dei cicli, vedi _maschera_fasce_ciclo
+
+        print(f"[{datetime.now()}] 🔀 Grafo aggiornato attorno a {len(utenti_ids)} utenti: "
+              f"+{len(aggiunti)} archi, -{len(rimossi)} archi")
+        return aggiunti, rimossi
+
+    def trova_cicli_da_delta(self, archi_aggiunti, max_length=6):
+        """
+        Calcolo incrementale guidato dalle differenze del grafo rispetto all'ultimo calcolo
+        (vedi aggiorna_grafo): per ogni arco aggiunto u→v cerca solo i percorsi v→…→u
+        (cicli nuovi). Il costo cresce con la dimensione della modifica, non con quella del grafo.
 
         Args:
-            utenti_ids: set/list di user_id impattati
+            archi_aggiunti: set di (user_da, user_a) nuovi rispetto all'ultimo calcolo
+            max_length: Lunghezza massima dei cicli
 
         Returns:
-            int: Numero di cicli invalidati
+            list: cicli nuovi
         """
-        from .models import CicloScambio
-        from django.conf import settings
+        from .cycle_engine import cicli_con_arco
+
+        self.cicli_trovati.clear()
+        self.cicli_hash_set.clear()
 
-        count_invalidati = 0
+        inverso = self.get_grafo_inverso()
+        for user_da, user_a in sorted(archi_aggiunti):
+            for ciclo in cicli_con_arco(self.grafo, inverso, user_da, user_a, max_length):
+                self._registra_ciclo(ciclo)
 
-        # Controlla quale database stiamo usando
-        is_postgres = 'postgresql' in settings.DATABASES['default']['ENGINE']
+        print(f"[{datetime.now()}] ✅ Trovati {len(self.cicli_trovati)} cicli con archi nuovi")
+        return self.cicli_trovati
 
-        for user_id in utenti_ids:
-            if is_postgres:
-                # PostgreSQL: usa __contains nativo per JSON
-                cicli = CicloScambio.objects.filter(valido=True, users__contains=user_id)
-            else:
-                # SQLite: usa __icontains come fallback (meno efficiente ma funziona)
-                cicli = CicloScambio.objects.filter(valido=True, users__icontains=f'"{user_id}"')
+    def aggiorna_cicli_utenti(self, utenti_ids):
+        """
+        Ricalcola i dettagli dei cicli validi esistenti che coinvolgono gli utenti
+        indicati (es. proprietari di annunci modificati senza cambi di archi)
+        e li aggiunge ai cicli trovati. I cicli con archi non più presenti vengono saltati.
 
-            count = cicli.count()
+        Returns:
+            int: Numero di cicli aggiornati
+        """
+        from .models import CicloScambio, CicloUtente
+        from .cycle_engine import archi_del_ciclo
+
+        utenti_ids = set(utenti_ids)
+        if not utenti_ids:
+            return 0
+
+        cicli = CicloScambio.objects.filter(
+            valido=True,
+            id__in=CicloUtente.objects.filter(utente_id__in=utenti_ids).values('ciclo_id')
+        ).only('users')
+
+        aggiornati = 0
+        fuori_fascia = []
+        incompleti = []
+        for ciclo in cicli.iterator():
+            users = ciclo.users
+            if all(v in self.grafo.get(u, ()) for u, v in archi_del_ciclo(users)):
+                if self.modalita_fasce == FASCE_SOLO_PARI and not self._maschera_fasce_ciclo(users):
+                    # Archi invariati ma fasce di prezzo cambiate: il ciclo non è più alla pari
+                    fuori_fascia.append(ciclo.id)
+                elif self._hash_ciclo(users) in self.cicli_hash_set:
+                    continue  # già ritrovato dagli archi nuovi
+                elif self._registra_ciclo(users):
+                    aggiornati += 1
+                else:
+                    # Un passaggio non ha più coppie di annunci ammissibili
+                    incompleti.append(ciclo.id)
 
-            if count > 0:
-                cicli.update(valido=False)
-                count_invalidati += count
+        if fuori_fascia or incompleti:
+            CicloScambio.objects.filter(id__in=fuori_fascia + incompleti).update(valido=False)
 
-        print(f"[{datetime.now()}] ❌ Invalidati {count_invalidati} cicli impattati")
-        return count_invalidati
+        print(f"[{datetime.now()}] 🔄 Aggiornati i dettagli di {aggiornati} cicli esistenti "
+              f"({len(fuori_fascia)} invalidati perché non più alla pari, {len(incompleti)} perché incompleti)")
+        return aggiornati
 
     def trova_cicli_per_utenti(self, utenti_ids, max_length=6):
         """
@@ -1120,80 +1655,257 @@ class CycleFinder:
         self.cicli_hash_set.clear()
 
         if not self.grafo:
-            print(f"[{datetime.now()}] ⚠️ Grafo vuoto, costruisco il grafo completo")
-            self.costruisci_grafo()
+            print(f"[{datetime.now()}] ⚠️ Grafo vuoto, nessun ciclo possibile")
+            return self.cicli_trovati
+
+        # Cicli che passano per ciascuno degli utenti impattati (meet-in-the-middle)
+        from .cycle_engine import cicli_per_utente
+
+        inverso = self.get_grafo_inverso()
+        percorsi = [
+            ciclo
+            for user_id in sorted(utenti_ids)
+            for ciclo in cicli_per_utente(self.grafo, inverso, user_id, max_length)
+        ]
 
-        # Trova cicli che iniziano da ciascuno degli utenti impattati
-        for user_id in utenti_ids:
-            if user_id in self.grafo:
-                self._trova_cicli_da_nodo(user_id, [user_id], max_length)
+        # Per i dettagli bastano gli annunci degli utenti dei cicli trovati
+        if self.annunci is None:
+            self.carica_annunci(utenti_ids={user_id for ciclo in percorsi for user_id in ciclo})
+
+        for ciclo in percorsi:
+            self._registra_ciclo(ciclo)
 
         print(f"[{datetime.now()}] ✅ Calcolo incrementale: trovati {len(self.cicli_trovati)} nuovi cicli")
         return self.cicli_trovati
 
-    def costruisci_grafo(self):
+    def get_archi_etichettati(self):
         """
-        Costruisce il grafo delle compatibilità dagli annunci attivi
-        + annunci disattivati da meno di 3 minuti
+        Multigrafo etichettato: per ogni arco del grafo le coppie
+        (offerta_id, richiesta_id, tipo_match) che lo generano
         """
-        from django.db.models import Q
-        from django.utils import timezone
-        from datetime import timedelta
+        if not self.archi_annunci and self.grafo:
+            self._carica_archi_da_compatibilita()
 
-        print(f"[{datetime.now()}] 🔨 Costruzione grafo compatibilità (inclusi recenti disattivati)...")
+        return {
+            arco: [(offerta.id, richiesta.id, tipo_match) for offerta, richiesta, tipo_match in coppie]
+            for arco, coppie in self.archi_annunci.items()
+        }
 
-        self.grafo.clear()
+    def _carica_archi_da_compatibilita(self):
+        """Coppie di annunci degli archi dalla tabella CompatibilitaAnnunci (grafo costruito da tabella)"""
+        from .models import CompatibilitaAnnunci
 
-        # Includi annunci attivi + disattivati da meno di 3 minuti
-        tre_minuti_fa = timezone.now() - timedelta(minutes=3)
+        self._assicura_annunci_caricati()
+        self.archi_annunci = defaultdict(list)
+        self._maschere_fasce = None
 
-        annunci_validi = Annuncio.objects.filter(
-            Q(attivo=True) |
-            Q(attivo=False, disattivato_at__isnull=False, disattivato_at__gte=tre_minuti_fa)
-        )
+        righe = CompatibilitaAnnunci.objects.filter(
+            filtro_compatibilita_ammissibili()
+        ).values_list('offerta_id', 'richiesta_id', 'tipo_match').order_by('offerta_id', 'richiesta_id')
 
-        utenti = User.objects.filter(annuncio__in=annunci_validi).distinct()
+        for offerta_id, richiesta_id, tipo_match in righe:
+            offerta = self.annunci.get(offerta_id)
+            richiesta = self.annunci.get(richiesta_id)
+            if offerta and richiesta:
+                self.archi_annunci[(offerta.utente_id, richiesta.utente_id)].append(
+                    (offerta, richiesta, tipo_match)
+                )
 
-        print(f"[{datetime.now()}] 📊 Annunci validi: {annunci_validi.count()} (inclusi disattivati <3 min)")
+    def get_maschere_fasce(self):
+        """
+        Maschera delle fasce di prezzo alla pari di ogni arco (OR sulle sue coppie
+        di annunci, vedi maschera_fasce_coppia), calcolata una volta per grafo
+        """
+        if self._maschere_fasce is None:
+            if not self.archi_annunci and self.punteggi_archi is not None:
+                # Grafo costruito da CompatibilitaAnnunci: coppie di annunci dalla tabella
+                self._carica_archi_da_compatibilita()
+
+            maschere = {}
+            for arco, coppie in self.archi_annunci.items():
+                maschera = 0
+                for offerta, richiesta, _tipo in coppie:
+                    maschera |= maschera_fasce_coppia(offerta, richiesta)
+                maschere[arco] = maschera
+            self._maschere_fasce = maschere
+        return self._maschere_fasce
+
+    def _maschera_fasce_ciclo(self, ciclo):
+        """Fasce in cui tutto il ciclo è alla pari (0 = nessuna)"""
+        maschere = self.get_maschere_fasce()
+        maschera = TUTTE_LE_FASCE
+        for i, user_da in enumerate(ciclo):
+            arco = (user_da, ciclo[(i + 1) % len(ciclo)])
+            if arco not in maschere:
+                # Grafo aggiornato da snapshot (aggiorna_grafo): maschera del solo arco usato
+                maschere[arco] = self._maschera_fasce_arco(*arco)
+            maschera &= maschere[arco]
+            if not maschera:
+                break
+        return maschera
 
-        for utente_a in utenti:
-            if utente_a.id not in self.grafo:
-                self.grafo[utente_a.id] = []
+    def _maschera_fasce_arco(self, user_id_da, user_id_a):
+        """Maschera fasce di un arco dalle sue coppie di annunci (vedi _coppie_arco)"""
+        maschera = 0
+        for offerta, richiesta, _tipo in self._coppie_arco(user_id_da, user_id_a):
+            maschera |= maschera_fasce_coppia(offerta, richiesta)
+        return maschera
 
-            for utente_b in utenti:
-                if utente_a.id != utente_b.id:
-                    # Verifica se A può scambiare con B
-                    if self._c_e_match_tra_utenti(utente_a, utente_b):
-                        self.grafo[utente_a.id].append(utente_b.id)
+    def _sottografi_per_fascia(self):
+        """
+        Per ogni fascia, il sottografo degli archi alla pari in quella fascia:
+        un ciclo è alla pari se e solo se è un ciclo di almeno uno di questi sottografi
+        """
+        maschere = self.get_maschere_fasce()
+        for bit in _BIT_FASCIA.values():
+            yield bit, {
+                user_da: [user_a for user_a in vicini if maschere.get((user_da, user_a), 0) & bit]
+                for user_da, vicini in self.grafo.items()
+            }
 
-        # Rimuovi nodi senza collegamenti
-        self.grafo = {k: v for k, v in self.grafo.items() if v}
+    def get_grafo_inverso(self):
+        """Grafo con archi invertiti, calcolato una volta per grafo"""
+        if self._grafo_inverso is None:
+            from .cycle_engine import grafo_inverso
+            self._grafo_inverso = grafo_inverso(self.grafo)
+        return self._grafo_inverso
+
+    def costruisci_grafo(self, da_compatibilita=False):
+        """
+        Costruisce il grafo delle compatibilità dagli annunci visibili.
+        Ogni coppia compatibile per titolo deve superare coppia_ammissibile
+        (moderazione, attivo, metodo di scambio, distanza massima): lo stesso
+        predicato dei dettagli, quindi ogni ciclo trovato è visualizzabile.
+
+        Usa un indice invertito (KeywordIndex) sulle richieste e calcola la
+        matrice offerta × richiesta a righe di bitmask (CompatibilityKernel),
+        invece di chiamare oggetti_compatibili_con_tipo su ogni coppia.
+
+        Args:
+            da_compatibilita: se True legge gli archi dalla tabella CompatibilitaAnnunci
+                              (vedi costruisci_grafo_da_compatibilita)
+        """
+        if da_compatibilita:
+            return self.costruisci_grafo_da_compatibilita()
+
+        print(f"[{datetime.now()}] 🔨 Costruzione grafo compatibilità (inclusi recenti disattivati)...")
+
+        self.grafo.clear()
+        self._grafo_inverso = None
+        self._maschere_fasce = None
+        self.punteggi_archi = None
+        self.carica_annunci()
+
+        offerte = [o for offerte in self.offerte_per_utente.values() for o in offerte if annuncio_visibile(o)]
+        archi = defaultdict(set)
+        self.archi_annunci = defaultdict(list)
+        scartate = 0
+
+        from .compatibility_kernel import CompatibilityKernel
+
+        for offerta, richiesta, tipo_match in CompatibilityKernel(self.indice).coppie_compatibili(offerte):
+            # Stesso predicato dei dettagli del ciclo: metodo di scambio e distanza
+            distanza = self._distanza_tra_utenti(offerta.utente_id, richiesta.utente_id)
+            if not coppia_ammissibile(offerta, richiesta, distanza):
+                scartate += 1
+                continue
+
+            # Accetta match specifico, parziale, sinonimo o categoria (se flag attivo)
+            if tipo_match in ['specifico', 'parziale', 'sinonimo', 'categoria']:
+                archi[offerta.utente_id].add(richiesta.utente_id)
+                self.archi_annunci[(offerta.utente_id, richiesta.utente_id)].append(
+                    (offerta, richiesta, tipo_match)
+                )
+
+        # Solo nodi con collegamenti, in ordine deterministico
+        self.grafo = {
+            user_id: sorted(archi[user_id])
+            for user_id in sorted(archi)
+        }
+
+        print(f"[{datetime.now()}] ✅ Grafo costruito: {len(self.grafo)} utenti, "
+              f"{sum(len(v) for v in self.grafo.values())} collegamenti "
+              f"({scartate} coppie escluse per metodo/distanza)")
+
+    def costruisci_grafo_da_compatibilita(self):
+        """
+        Costruisce il grafo degli utenti con UNA query aggregata sulla tabella
+        CompatibilitaAnnunci (mantenuta incrementalmente dai signals),
+        senza matching a coppie. Registra anche il punteggio migliore di ogni arco.
+        """
+        from django.db.models import Max
+        from .models import CompatibilitaAnnunci
+
+        print(f"[{datetime.now()}] 🔨 Costruzione grafo da tabella compatibilità...")
+
+        self.grafo.clear()
+        self._grafo_inverso = None
+        self._maschere_fasce = None
+        self.archi_annunci = {}
+
+        archi_utenti = CompatibilitaAnnunci.objects.filter(
+            filtro_compatibilita_ammissibili()
+        ).values(
+            'offerta__utente_id', 'richiesta__utente_id'
+        ).annotate(
+            punteggio_max=Max('punteggio')
+        ).order_by()
+
+        archi = defaultdict(set)
+        self.punteggi_archi = {}
+        for arco in archi_utenti:
+            user_da = arco['offerta__utente_id']
+            user_a = arco['richiesta__utente_id']
+            archi[user_da].add(user_a)
+            self.punteggi_archi[(user_da, user_a)] = arco['punteggio_max']
+
+        # Solo nodi con collegamenti, in ordine deterministico
+        self.grafo = {
+            user_id: sorted(archi[user_id])
+            for user_id in sorted(archi)
+        }
 
         print(f"[{datetime.now()}] ✅ Grafo costruito: {len(self.grafo)} utenti, "
               f"{sum(len(v) for v in self.grafo.values())} collegamenti")
 
+    def costruisci_grafo_per_utenti(self, utenti_ids):
+        """
+        Grafo per un ricalcolo su richiesta (es. dalla vista catene): lo snapshot
+        dell'ultimo calcolo (get_snapshot_archi) aggiornato solo attorno agli utenti
+        indicati con le loro righe di CompatibilitaAnnunci (vedi aggiorna_grafo).
+        Senza snapshot, una sola query aggregata sulla tabella.
+
+        Se la tabella è vuota (mai popolata con ricostruisci_compatibilita) gli
+        archi vengono dal matching sulle parole chiave, come nel calcolo completo:
+        altrimenti il ricalcolo toglierebbe all'utente tutti i suoi archi.
+        """
+        from .models import CompatibilitaAnnunci
+
+        da_compatibilita = CompatibilitaAnnunci.objects.exists()
+        if not da_compatibilita:
+            print(f"[{datetime.now()}] ⚠️ Tabella compatibilità vuota, uso il matching sulle parole chiave")
+
+        archi_precedenti = get_snapshot_archi()
+        if archi_precedenti is None:
+            self.costruisci_grafo(da_compatibilita=da_compatibilita)
+            return
+        self.aggiorna_grafo(archi_precedenti, utenti_ids, da_compatibilita=da_compatibilita)
+
     def _c_e_match_tra_utenti(self, utente_a, utente_b):
         """
         Verifica se due utenti possono scambiare direttamente.
         Usa solo matching titoli (senza considerare prezzo/distanza) per costruire il grafo.
         Include annunci disattivati da meno di 3 minuti.
         """
-        from django.db.models import Q
-        from django.utils import timezone
-        from datetime import timedelta
+        self._assicura_annunci_caricati()
 
-        tre_minuti_fa = timezone.now() - timedelta(minutes=3)
+        user_id_a = getattr(utente_a, 'id', utente_a)
+        user_id_b = getattr(utente_b, 'id', utente_b)
 
-        # Filtro per annunci validi (attivi + disattivati da <3 min)
-        filtro_validi = Q(attivo=True) | Q(attivo=False, disattivato_at__isnull=False, disattivato_at__gte=tre_minuti_fa)
-
-        offerte_a = Annuncio.objects.filter(utente=utente_a, tipo='offro').filter(filtro_validi)
-        richieste_b = Annuncio.objects.filter(utente=utente_b, tipo='cerco').filter(filtro_validi)
-
-        for offerta in offerte_a:
-            for richiesta in richieste_b:
+        for offerta in self.offerte_per_utente.get(user_id_a, []):
+            for richiesta in self.richieste_per_utente.get(user_id_b, []):
                 # Usa solo compatibilità titoli (non algoritmo avanzato)
-                compatible, tipo_match = oggetti_compatibili_con_tipo(offerta, richiesta)
+                compatible, tipo_match = self.indice.tipo_match(offerta, richiesta)
 
                 # Accetta match specifico, parziale, sinonimo o categoria (se flag attivo)
                 if compatible and tipo_match in ['specifico', 'parziale', 'sinonimo', 'categoria']:
@@ -1201,11 +1913,132 @@ class CycleFinder:
 
         return False
 
-    def trova_tutti_cicli(self, max_length=6):
+    def trova_tutti_cicli(self, max_length=6, engine='dfs', workers=1, fasce=None):
         """
-        Trova tutti i cicli possibili fino a max_length utenti
+        Trova tutti i cicli possibili fino a max_length utenti e li accumula in
+        self.cicli_trovati (per il calcolo completo a flusso vedi itera_cicli)
+
+        Args:
+            max_length: Lunghezza massima dei cicli
+            engine: 'dfs' (DFS ricorsiva da ogni nodo), 'canonico'
+                    (DFS iterativa da partenza canonica, vedi cycle_engine)
+                    oppure 'multigrafo' (come canonico, con le coppie di annunci
+                    sugli archi: niente secondo matching per i dettagli)
+            workers: Processi per i motori canonico/multigrafo (1 = nessun parallelismo)
+            fasce: modalità fasce di prezzo (vedi MODALITA_FASCE); None = self.modalita_fasce.
+                   Con 'solo_pari' la ricerca avviene sui sottografi delle singole fasce.
+        """
+        self.cicli_trovati.clear()
+        self.cicli_trovati.extend(self.itera_cicli(max_length, engine, workers, fasce))
+
+        if self.modalita_fasce == FASCE_PREFERISCI:
+            # Ordinamento stabile: prima i cicli alla pari
+            self.cicli_trovati.sort(key=lambda ciclo: not ciclo['fasce_pari'])
+
+        return self.cicli_trovati
+
+    def itera_cicli(self, max_length=6, engine='dfs', workers=1, fasce=None):
+        """
+        Pipeline a flusso: enumera i cicli e genera ognuno con i suoi dettagli
+        appena trovato, senza accumularli (la memoria resta quella del solo
+        insieme degli hash per i duplicati). Stessi argomenti di trova_tutti_cicli;
+        con 'preferisci' l'ordine è quello di enumerazione (nessun ordinamento globale).
+
+        Yields:
+            dict: ciclo nel formato di self.cicli_trovati
+        """
+        if fasce is not None:
+            self.modalita_fasce = fasce
+
+        print(f"[{datetime.now()}] 🔍 Ricerca cicli (max lunghezza: {max_length}, motore: {engine}, "
+              f"workers: {workers}, fasce: {self.modalita_fasce})...")
+
+        self.cicli_hash_set.clear()
+
+        if not self.grafo:
+            print(f"[{datetime.now()}] ⚠️ Grafo vuoto, nessun ciclo possibile")
+            return
+
+        trovati = 0
+        pari = 0
+        for path, etichette in self._percorsi_cicli(max_length, engine, workers):
+            ciclo = self._prepara_ciclo(path, etichette)
+            if ciclo is None:
+                continue
+            trovati += 1
+            pari += ciclo['fasce_pari']
+            yield ciclo
+
+        print(f"[{datetime.now()}] ✅ Trovati {trovati} cicli unici ({pari} alla pari)")
+
+    def _percorsi_cicli(self, max_length, engine, workers):
+        """Cicli grezzi (path, etichette o None) del grafo, per la modalità fasce corrente"""
+        if self.modalita_fasce != FASCE_SOLO_PARI:
+            yield from self._enumera_cicli(self.grafo, max_length, engine, workers)
+            return
+
+        # Un ciclo alla pari vive tutto nel sottografo di una fascia:
+        # gli archi fuori fascia non vengono mai esplorati
+        archi_etichettati = self.get_archi_etichettati() if engine == 'multigrafo' else None
+        for bit, sottografo in self._sottografi_per_fascia():
+            etichette_fascia = None
+            if archi_etichettati is not None:
+                etichette_fascia = {
+                    arco: [e for e in etichette if self._maschera_fasce_etichetta(e) & bit]
+                    for arco, etichette in archi_etichettati.items()
+                    if arco[1] in sottografo.get(arco[0], ())
+                }
+            yield from self._enumera_cicli(sottografo, max_length, engine, workers, etichette_fascia)
+
+    def _enumera_cicli(self, grafo, max_length, engine, workers, archi_etichettati=None):
+        """Enumera i cicli di un grafo con il motore richiesto: genera (path, etichette o None)"""
+        if engine == 'canonico':
+            from .cycle_engine import enumera_cicli
+            for ciclo in enumera_cicli(grafo, max_length, workers=workers):
+                yield ciclo, None
+        elif engine == 'multigrafo':
+            # Gli archi portano le coppie di annunci: i dettagli escono dalla ricerca
+            from .cycle_engine import cicli_multigrafo
+            if archi_etichettati is None:
+                archi_etichettati = self.get_archi_etichettati()
+            yield from cicli_multigrafo(archi_etichettati, max_length, workers=workers)
+        else:
+            # Per ogni nodo, cerca cicli che iniziano da quel nodo
+            for start_node in grafo.keys():
+                for ciclo in self._trova_cicli_da_nodo(start_node, [start_node], max_length, grafo):
+                    yield ciclo, None
+
+    def _maschera_fasce_etichetta(self, etichetta):
+        """Maschera fasce di una coppia (offerta_id, richiesta_id, tipo_match) del multigrafo"""
+        offerta = self.annunci.get(etichetta[0])
+        richiesta = self.annunci.get(etichetta[1])
+        if not (offerta and richiesta):
+            return 0
+        return maschera_fasce_coppia(offerta, richiesta)
+
+    def trova_cicli_migliori(self, max_length=6, k_per_utente=20, k_globale=None,
+                             max_espansioni=200000, tempo_max=None, fasce=None):
         """
-        print(f"[{datetime.now()}] 🔍 Ricerca cicli (max lunghezza: {max_length})...")
+        Trova solo i cicli migliori (top-K per utente e globali) entro un budget.
+        I cicli più corti e con archi di qualità più alta vengono trovati per primi
+        (vedi cycle_engine.cicli_migliori).
+
+        Args:
+            max_length: Lunghezza massima dei cicli
+            k_per_utente: Cicli massimi per utente
+            k_globale: Cicli massimi in totale (None = nessun limite)
+            max_espansioni: Budget di percorsi parziali espansi
+            tempo_max: Budget di tempo in secondi (None = nessun limite)
+            fasce: modalità fasce di prezzo (vedi MODALITA_FASCE); None = self.modalita_fasce.
+                   Con 'solo_pari' i cicli fuori fascia vengono scartati alla registrazione.
+        """
+        from .cycle_engine import cicli_migliori
+
+        if fasce is not None:
+            self.modalita_fasce = fasce
+
+        print(f"[{datetime.now()}] 🏆 Ricerca top-K cicli (max lunghezza: {max_length}, "
+              f"K utente: {k_per_utente}, K globale: {k_globale or '∞'})...")
 
         self.cicli_trovati.clear()
         self.cicli_hash_set.clear()
@@ -1214,13 +2047,78 @@ class CycleFinder:
             print(f"[{datetime.now()}] ⚠️ Grafo vuoto, nessun ciclo possibile")
             return []
 
-        # Per ogni nodo, cerca cicli che iniziano da quel nodo
-        for start_node in self.grafo.keys():
-            self._trova_cicli_da_nodo(start_node, [start_node], max_length)
+        punteggi = self.calcola_punteggi_archi()
+        cicli, statistiche = cicli_migliori(
+            self.grafo, punteggi, max_length,
+            k_per_utente=k_per_utente,
+            k_globale=k_globale,
+            max_espansioni=max_espansioni,
+            tempo_max=tempo_max,
+        )
+
+        for ciclo, _costo in cicli:
+            self._registra_ciclo(ciclo)
+
+        if self.modalita_fasce == FASCE_PREFERISCI:
+            self.cicli_trovati.sort(key=lambda ciclo: not ciclo['fasce_pari'])
 
-        print(f"[{datetime.now()}] ✅ Trovati {len(self.cicli_trovati)} cicli unici")
+        if statistiche['interrotto'] in ('espansioni', 'tempo'):
+            print(f"[{datetime.now()}] ⏰ Budget {statistiche['interrotto']} esaurito "
+                  f"dopo {statistiche['espansioni']} espansioni")
+
+        print(f"[{datetime.now()}] ✅ Trovati {len(self.cicli_trovati)} cicli migliori "
+              f"({statistiche['espansioni']} espansioni, {statistiche['scartati']} scartati per K utente)")
         return self.cicli_trovati
 
+    def calcola_punteggi_archi(self):
+        """
+        Punteggio di qualità di ogni arco del grafo: il migliore
+        calcola_punteggio_qualita_avanzato tra le coppie di annunci dell'arco.
+
+        Returns:
+            dict: (user_da, user_a) -> punteggio (0-100)
+        """
+        if self.punteggi_archi is not None:
+            # Grafo costruito da CompatibilitaAnnunci: punteggi già aggregati
+            return self.punteggi_archi
+
+        distanze = self.distanze_archi(self.archi_annunci)
+        punteggi = {}
+        for (user_da, user_a), coppie in self.archi_annunci.items():
+            distanza = distanze[(user_da, user_a)]
+            punteggi[(user_da, user_a)] = max(
+                calcola_punteggio_qualita_avanzato(offerta, richiesta, distanza)[0]
+                for offerta, richiesta, _tipo in coppie
+            )
+        return punteggi
+
+    def distanze_archi(self, coppie_utenti):
+        """
+        Distanze in km per un insieme di coppie di utenti, in un solo passaggio
+        sulla matrice delle province.
+
+        Returns:
+            dict: (user_id_a, user_id_b) -> distanza km (DISTANZA_SCONOSCIUTA_CICLI se sconosciuta)
+        """
+        coppie_utenti = list(coppie_utenti)
+        province = [
+            (self._provincia_utente(user_id_a), self._provincia_utente(user_id_b))
+            for user_id_a, user_id_b in coppie_utenti
+        ]
+        distanze = get_matrice_distanze().distanze(province)
+        return {coppia: distanza_per_cicli(distanza) for coppia, distanza in zip(coppie_utenti, distanze)}
+
+    def _distanza_tra_utenti(self, user_id_a, user_id_b):
+        """Distanza in km tra le province di due utenti (DISTANZA_SCONOSCIUTA_CICLI se sconosciuta)"""
+        return distanza_per_cicli(distanza_province(self._provincia_utente(user_id_a), self._provincia_utente(user_id_b)))
+
+    def _provincia_utente(self, user_id):
+        """Id provincia dell'utente dagli annunci caricati (select_related), o None"""
+        annunci = self.offerte_per_utente.get(user_id) or self.richieste_per_utente.get(user_id)
+        if not annunci:
+            return None
+        return provincia_annuncio(annunci[0])
+
     def trova_scambi_diretti(self):
         """
         Trova tutti gli scambi diretti (lunghezza 2) usando il grafo
@@ -1259,38 +2157,177 @@ class CycleFinder:
         print(f"[{datetime.now()}] ✅ Trovati {len(scambi_diretti)} scambi diretti unici")
         return scambi_diretti
 
-    def _trova_cicli_da_nodo(self, current_node, path, max_length):
+    def _trova_cicli_da_nodo(self, current_node, path, max_length, grafo=None):
         """
         DFS ricorsivo per trovare cicli da un nodo specifico
+        (sul grafo indicato, di default self.grafo): genera i percorsi chiusi,
+        la normalizzazione e i duplicati sono gestiti da _prepara_ciclo
         """
+        if grafo is None:
+            grafo = self.grafo
+
         if len(path) > max_length:
             return
 
         # Se siamo tornati al nodo di partenza e abbiamo almeno 2 utenti (include scambi diretti)
-        if len(path) >= 2 and current_node in self.grafo:
-            if path[0] in self.grafo[current_node]:
-                # Ciclo trovato! Normalizza e aggiungi se unico
-                ciclo_normalizzato = self._normalizza_ciclo(path)
-                ciclo_hash = self._hash_ciclo(ciclo_normalizzato)
-
-                if ciclo_hash not in self.cicli_hash_set:
-                    self.cicli_hash_set.add(ciclo_hash)
-
-                    dettagli = self._get_dettagli_ciclo(ciclo_normalizzato)
-                    ciclo_completo = {
-                        'users': ciclo_normalizzato,
-                        'lunghezza': len(ciclo_normalizzato),
-                        'dettagli': dettagli,
-                        'hash_ciclo': ciclo_hash
-                    }
-                    self.cicli_trovati.append(ciclo_completo)
+        if len(path) >= 2 and current_node in grafo:
+            if path[0] in grafo[current_node]:
+                # Ciclo trovato!
+                yield path
                 # NON fare return qui - continua a cercare cicli più lunghi
 
         # Continua la ricerca
-        if current_node in self.grafo:
-            for next_node in self.grafo[current_node]:
+        if current_node in grafo:
+            for next_node in grafo[current_node]:
                 if next_node not in path:  # Evita cicli interni
-                    self._trova_cicli_da_nodo(next_node, path + [next_node], max_length)
+                    yield from self._trova_cicli_da_nodo(next_node, path + [next_node], max_length, grafo)
+
+    def _registra_ciclo(self, path, etichette=None):
+        """
+        Normalizza il ciclo e lo aggiunge ai cicli trovati se non già presente
+        (stesso insieme di utenti = stesso hash)
+
+        Returns:
+            bool: True se il ciclo è stato aggiunto
+        """
+        ciclo = self._prepara_ciclo(path, etichette)
+        if ciclo is None:
+            return False
+        self.cicli_trovati.append(ciclo)
+        return True
+
+    def _prepara_ciclo(self, path, etichette=None):
+        """
+        Normalizza il ciclo e ne calcola i dettagli, se non già visto
+        (stesso insieme di utenti = stesso hash)
+
+        Args:
+            path: utenti del ciclo
+            etichette: per ogni passaggio path[i] → path[i+1], le coppie
+                       (offerta_id, richiesta_id, tipo_match) del multigrafo
+
+        Returns:
+            dict o None: il ciclo (users, lunghezza, dettagli, hash_ciclo, attributi
+                         derivati), None se duplicato, scartato dalla modalità fasce
+                         o con un passaggio senza coppie di annunci ammissibili
+        """
+        ciclo_normalizzato = self._normalizza_ciclo(path)
+        ciclo_hash = self._hash_ciclo(ciclo_normalizzato)
+
+        if ciclo_hash in self.cicli_hash_set:
+            return None
+
+        maschera_fasce = self._maschera_fasce_ciclo(ciclo_normalizzato)
+        if self.modalita_fasce == FASCE_SOLO_PARI and not maschera_fasce:
+            return None
+
+        n = len(ciclo_normalizzato)
+        if etichette is not None:
+            # Ruota le etichette come il ciclo normalizzato
+            inizio = path.index(ciclo_normalizzato[0])
+            etichette = etichette[inizio:] + etichette[:inizio]
+            scambi = [
+                self._scambio_da_etichette(ciclo_normalizzato[i], ciclo_normalizzato[(i + 1) % n], etichette[i])
+                for i in range(n)
+            ]
+        else:
+            scambi = [
+                self._trova_oggetto_scambiato(ciclo_normalizzato[i], ciclo_normalizzato[(i + 1) % n])
+                for i in range(n)
+            ]
+
+        if not all(scambi):
+            # Un passaggio senza coppie ammissibili (arco dello snapshot non più valido):
+            # il ciclo sarebbe incompleto in lettura. L'hash resta libero per l'altro verso
+            return None
+
+        self.cicli_hash_set.add(ciclo_hash)
+
+        if maschera_fasce:
+            # Gli oggetti mostrati per ogni passaggio sono gli ultimi: mette in fondo
+            # quelli della fascia comune, così la catena visualizzata è alla pari
+            bit = maschera_fasce & -maschera_fasce
+            scambi = [self._ordina_oggetti_per_fascia(scambio, bit) for scambio in scambi]
+
+        dettagli = self._get_dettagli_ciclo(ciclo_normalizzato, scambi)
+        return {
+            'users': ciclo_normalizzato,
+            'lunghezza': n,
+            'dettagli': dettagli,
+            'hash_ciclo': ciclo_hash,
+            'fasce_pari': bool(maschera_fasce),
+            **self._attributi_ciclo(scambi, dettagli),
+        }
+
+    def _attributi_ciclo(self, scambi, dettagli):
+        """
+        Attributi derivati salvati come colonne di CicloScambio (vedi CAMPI_DERIVATI),
+        calcolati una volta qui invece che a ogni lettura.
+
+        Stessa semantica delle letture: per ogni passaggio lo scambio mostrato è
+        l'ultimo oggetto (come in converti_ciclo_db_a_view_format), il punteggio è
+        quello di calcola_qualita_ciclo, i flag sinonimi/parziali guardano tutti
+        gli oggetti.
+        """
+        annunci_ids = set()
+        usa_sinonimi = False
+        ha_match_parziali = False
+        ha_match_categoria = False
+        punteggio_totale = 0
+        num_scambi = 0
+
+        for scambio in scambi:
+            if not scambio or not scambio.get('oggetti'):
+                continue
+
+            for oggetto in scambio['oggetti']:
+                annunci_ids.add(oggetto['offerto']['id'])
+                annunci_ids.add(oggetto['richiesto']['id'])
+                if oggetto['tipo_match'] == 'sinonimo':
+                    usa_sinonimi = True
+                elif oggetto['tipo_match'] == 'parziale':
+                    ha_match_parziali = True
+
+            mostrato = scambio['oggetti'][-1]
+            if mostrato['tipo_match'] in ['categoria', 'generico']:
+                ha_match_categoria = True
+            punteggio_totale += self._punteggio_scambio(mostrato['offerto']['id'], mostrato['richiesto']['id'])
+            num_scambi += 1
+
+        return {
+            'punteggio_qualita': int(punteggio_totale // max(1, num_scambi)),
+            'categoria_qualita': calcola_categoria_qualita_da_dettagli(dettagli),
+            'usa_sinonimi': usa_sinonimi,
+            'ha_match_parziali': ha_match_parziali,
+            'ha_match_categoria': ha_match_categoria,
+            'annunci_ids': sorted(annunci_ids),
+        }
+
+    def _punteggio_scambio(self, offerta_id, richiesta_id):
+        """Punteggio di qualità di una coppia offerta/richiesta (come calcola_qualita_ciclo), in cache"""
+        chiave = (offerta_id, richiesta_id)
+        punteggio = self._punteggi_scambi.get(chiave)
+        if punteggio is None:
+            punteggio = 0
+            offerta = self.annunci.get(offerta_id) if self.annunci else None
+            richiesta = self.annunci.get(richiesta_id) if self.annunci else None
+            if offerta and richiesta:
+                compatible, punteggio_coppia, _ = oggetti_compatibili_avanzato(offerta, richiesta, distanza_km=50)
+                if compatible:
+                    punteggio = punteggio_coppia
+            self._punteggi_scambi[chiave] = punteggio
+        return punteggio
+
+    def _ordina_oggetti_per_fascia(self, scambio, bit):
+        """Scambio con gli oggetti alla pari nella fascia indicata in fondo (ordinamento stabile)"""
+        if not scambio:
+            return scambio
+
+        def alla_pari(oggetto):
+            etichetta = (oggetto['offerto']['id'], oggetto['richiesto']['id'])
+            return bool(self._maschera_fasce_etichetta(etichetta) & bit)
+
+        return dict(scambio, oggetti=sorted(scambio['oggetti'], key=alla_pari))
 
     def _normalizza_ciclo(self, ciclo):
         """
@@ -1313,124 +2350,99 @@ class CycleFinder:
         ciclo_str = ','.join(map(str, sorted(ciclo)))
         return hashlib.md5(ciclo_str.encode()).hexdigest()
 
-    def _get_dettagli_ciclo(self, user_ids):
+    def _get_dettagli_ciclo(self, user_ids, scambi=None):
         """
-        Ottiene i dettagli completi del ciclo (oggetti scambiati, etc.)
-        """
-        dettagli = {
-            'scambi': [],
-            'oggetti': [],
-            'utenti': [],
-            'timestamp': datetime.now().isoformat()
-        }
-
-        # Costruisci la lista utenti con le informazioni di ogni utente
-        for i in range(len(user_ids)):
-            user_id = user_ids[i]
-            user_da = user_ids[i]
-            user_a = user_ids[(i + 1) % len(user_ids)]
-
-            # Trova gli annunci per questo utente
-            scambio = self._trova_oggetto_scambiato(user_da, user_a)
-
-            # Determina annuncio offerta e richiesta per questo utente
-            offerta_info = None
-            richiesta_info = None
-
-            if scambio and scambio.get('oggetti'):
-                for obj in scambio['oggetti']:
-                    if 'offerto' in obj:
-                        offerta_info = obj['offerto']
-                    if 'richiesto' in obj:
-                        richiesta_info = obj['richiesto']
+        Ottiene i dettagli del ciclo (oggetti scambiati, etc.) nel formato
+        compatto v2: solo id e codici di match, vedi scambi/dettagli_ciclo.py
 
-            dettagli['utenti'].append({
-                'user': {'id': user_id},
-                'offerta': offerta_info,
-                'richiede': richiesta_info
-            })
-
-            # Aggiungi scambi come prima
-            if scambio:
-                dettagli['scambi'].append(scambio)
-                dettagli['oggetti'].extend(scambio['oggetti'])
+        Args:
+            user_ids: utenti del ciclo (normalizzato)
+            scambi: scambi già noti per ogni passaggio (motore multigrafo);
+                    se None vengono ricavati con _trova_oggetto_scambiato
+        """
+        n = len(user_ids)
+        if scambi is None:
+            scambi = [self._trova_oggetto_scambiato(user_ids[i], user_ids[(i + 1) % n]) for i in range(n)]
 
-        return dettagli
+        return comprimi_scambi(scambi)
 
     def _trova_oggetto_scambiato(self, user_id_da, user_id_a):
         """
         Trova TUTTI gli oggetti che user_da può dare a user_a
         Include categoria solo se flag cerca_per_categoria è attivo
         """
-        try:
-            utente_da = User.objects.get(id=user_id_da)
-            utente_a = User.objects.get(id=user_id_a)
+        return self._formatta_scambio(user_id_da, user_id_a, self._coppie_arco(user_id_da, user_id_a))
 
-            offerte_da = Annuncio.objects.filter(
-                utente=utente_da, tipo='offro', attivo=True
-            ).filter(Q(moderation_status='approved') | Q(immagine='') | Q(immagine__isnull=True))
-            richieste_a = Annuncio.objects.filter(
-                utente=utente_a, tipo='cerco', attivo=True
-            ).filter(Q(moderation_status='approved') | Q(immagine='') | Q(immagine__isnull=True))
+    def _coppie_arco(self, user_id_da, user_id_a):
+        """Coppie (offerta, richiesta, tipo_match) ammissibili tra user_da e user_a"""
+        self._assicura_annunci_caricati()
 
-            # Calcola distanza per usare logica avanzata
-            try:
-                profile_da = utente_da.userprofile
-                profile_a = utente_a.userprofile
+        # Solo annunci attivi e approvati (o senza immagine)
+        offerte_da = [o for o in self.offerte_per_utente.get(user_id_da, []) if annuncio_visibile(o)]
+        richieste_a = [r for r in self.richieste_per_utente.get(user_id_a, []) if annuncio_visibile(r)]
+        distanza = self._distanza_tra_utenti(user_id_da, user_id_a)
 
-                if profile_da.latitudine and profile_da.longitudine and profile_a.latitudine and profile_a.longitudine:
-                    from math import radians, sin, cos, sqrt, atan2
+        # Trova TUTTI i match validi
+        coppie = []
 
-                    lat1, lon1 = radians(profile_da.latitudine), radians(profile_da.longitudine)
-                    lat2, lon2 = radians(profile_a.latitudine), radians(profile_a.longitudine)
+        for offerta in offerte_da:
+            for richiesta in richieste_a:
+                if not coppia_ammissibile(offerta, richiesta, distanza):
+                    continue
 
-                    dlat = lat2 - lat1
-                    dlon = lon2 - lon1
-                    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-                    c = 2 * atan2(sqrt(a), sqrt(1-a))
-                    distanza_km = 6371 * c
-                else:
-                    distanza_km = 50
-            except:
-                distanza_km = 50
-
-            # Trova TUTTI i match validi
-            tutti_oggetti = []
-
-            for offerta in offerte_da:
-                for richiesta in richieste_a:
-                    # Controlla il tipo di match
-                    compatible, tipo_match = oggetti_compatibili_con_tipo(offerta, richiesta)
-
-                    # Accetta specifici/sinonimi/parziali + categoria (se flag attivo)
-                    if compatible and tipo_match in ['specifico', 'sinonimo', 'parziale', 'categoria']:
-                        tutti_oggetti.append({
-                            'offerto': {
-                                'id': offerta.id,
-                                'titolo': offerta.titolo,
-                                'categoria': offerta.categoria.nome
-                            },
-                            'richiesto': {
-                                'id': richiesta.id,
-                                'titolo': richiesta.titolo,
-                                'categoria': richiesta.categoria.nome
-                            },
-                            'tipo_match': tipo_match  # Per info aggiuntiva
-                        })
-
-            # Se ci sono match validi, ritorna tutti
-            if tutti_oggetti:
-                return {
-                    'da_user': user_id_da,
-                    'a_user': user_id_a,
-                    'oggetti': tutti_oggetti
-                }
+                # Controlla il tipo di match
+                compatible, tipo_match = self.indice.tipo_match(offerta, richiesta)
+
+                # Accetta specifici/sinonimi/parziali + categoria (se flag attivo)
+                if compatible and tipo_match in ['specifico', 'sinonimo', 'parziale', 'categoria']:
+                    coppie.append((offerta, richiesta, tipo_match))
+
+        return coppie
 
+    def _scambio_da_etichette(self, user_id_da, user_id_a, etichette):
+        """
+        Scambio di un passaggio a partire dalle etichette dell'arco del multigrafo
+        [(offerta_id, richiesta_id, tipo_match)], senza rifare il matching
+        """
+        coppie = []
+        distanza = self._distanza_tra_utenti(user_id_da, user_id_a)
+        for offerta_id, richiesta_id, tipo_match in etichette:
+            offerta = self.annunci.get(offerta_id)
+            richiesta = self.annunci.get(richiesta_id)
+            # Stesso predicato usato per costruire il grafo
+            if offerta and richiesta and coppia_ammissibile(offerta, richiesta, distanza):
+                coppie.append((offerta, richiesta, tipo_match))
+
+        return self._formatta_scambio(user_id_da, user_id_a, coppie)
+
+    def _formatta_scambio(self, user_id_da, user_id_a, coppie):
+        """
+        Formato dello scambio salvato nei dettagli del ciclo
+        (None se non ci sono coppie offerta/richiesta valide)
+        """
+        if not coppie:
             return None
-        except User.DoesNotExist:
-            pass
 
-        return None
+        return {
+            'da_user': user_id_da,
+            'a_user': user_id_a,
+            'oggetti': [
+                {
+                    'offerto': {
+                        'id': offerta.id,
+                        'titolo': offerta.titolo,
+                        'categoria': offerta.categoria.nome
+                    },
+                    'richiesto': {
+                        'id': richiesta.id,
+                        'titolo': richiesta.titolo,
+                        'categoria': richiesta.categoria.nome
+                    },
+                    'tipo_match': tipo_match  # Per info aggiuntiva
+                }
+                for offerta, richiesta, tipo_match in coppie
+            ]
+        }
 
 
 # === FUNZIONI HELPER PER IL CALCOLO CICLI ===
@@ -1454,11 +2466,18 @@ def get_dettagli_ciclo(user_ids):
 
 # ===== FUNZIONI OTTIMIZZATE CHE USANO CICLI PRE-CALCOLATI =====
 
-def get_cicli_precalcolati():
+def get_cicli_precalcolati(max_lunghezza=None, punteggio_min=None, annuncio_id=None):
     """
     Funzione ottimizzata che legge i cicli pre-calcolati dal database invece di fare brute-force.
     Sostituisce le vecchie funzioni trova_scambi_diretti() e trova_catene_scambio().
 
+    Args:
+        max_lunghezza: se indicato, solo cicli fino a questa lunghezza (filtro SQL)
+        punteggio_min: se indicato, solo cicli con punteggio_qualita salvato ≥ soglia
+                       (filtro SQL); i cicli senza punteggio salvato vengono inclusi
+                       e vanno filtrati dal chiamante con calcola_qualita_ciclo
+        annuncio_id: se indicato, solo i cicli che mostrano l'annuncio (join su CicloAnnuncio)
+
     Returns:
         dict: {
             'scambi_diretti': [],     # Cicli di lunghezza 2
@@ -1468,6 +2487,7 @@ def get_cicli_precalcolati():
         }
     """
     import time
+    from django.db.models import Q
     from .models import CicloScambio, Annuncio
 
     start_time = time.time()
@@ -1476,6 +2496,14 @@ def get_cicli_precalcolati():
 
     # Carica tutti i cicli validi
     cicli_db = CicloScambio.objects.filter(valido=True).order_by('-calcolato_at')
+    if max_lunghezza:
+        cicli_db = cicli_db.filter(lunghezza__lte=max_lunghezza)
+    if punteggio_min is not None:
+        cicli_db = cicli_db.filter(
+            Q(punteggio_qualita__gte=punteggio_min) | Q(punteggio_qualita__isnull=True)
+        )
+    if annuncio_id is not None:
+        cicli_db = cicli_db.filter(annunci_collegati__annuncio_id=annuncio_id)
 
     # ===== OTTIMIZZAZIONE: PRE-CARICAMENTO ANNUNCI =====
     # Estrai tutti gli ID degli annunci coinvolti nei cicli PRIMA di processarli
@@ -1483,16 +2511,12 @@ def get_cicli_precalcolati():
     annunci_ids = set()
 
     for ciclo_db in cicli_db:
-        dettagli = ciclo_db.dettagli
-        if 'scambi' in dettagli:
-            for scambio in dettagli['scambi']:
-                oggetti = scambio.get('oggetti', [])
-                for oggetto in oggetti:
-                    # Estrai ID da 'offerto' e 'richiesto'
-                    if 'offerto' in oggetto and 'id' in oggetto['offerto']:
-                        annunci_ids.add(oggetto['offerto']['id'])
-                    if 'richiesto' in oggetto and 'id' in oggetto['richiesto']:
-                        annunci_ids.add(oggetto['richiesto']['id'])
+        # Id salvati dal calcolo cicli; per i cicli più vecchi si leggono dai dettagli
+        if ciclo_db.annunci_ids is not None:
+            annunci_ids.update(ciclo_db.annunci_ids)
+            continue
+
+        annunci_ids.update(annunci_ids_dettagli(ciclo_db.dettagli))
 
     print(f"📦 Trovati {len(annunci_ids)} annunci unici coinvolti nei cicli")
 
@@ -1559,24 +2583,24 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
         # Crea un dizionario per accesso veloce agli utenti per ID
         utenti_dict = {u.id: u for u in utenti}
 
-        # Usa i dettagli già processati dal database
+        # Usa i dettagli già processati dal database (v1 o compatti v2: servono solo gli id)
         dettagli = ciclo_db.dettagli
+        scambi = passaggi(dettagli)
 
-        # Calcola categoria qualità basata sui dettagli
-        categoria_qualita = calcola_categoria_qualita_da_dettagli(dettagli)
+        # Attributi derivati salvati dal calcolo cicli (vedi CycleFinder._attributi_ciclo);
+        # per i cicli salvati prima delle colonne si ricalcolano dai dettagli
+        categoria_qualita = ciclo_db.categoria_qualita or calcola_categoria_qualita_da_dettagli(dettagli)
 
-        # Verifica se il ciclo usa sinonimi o match parziali controllando i tipi di match
-        usa_sinonimi = False
-        ha_match_parziali = False
-        if 'scambi' in dettagli:
-            for scambio in dettagli['scambi']:
-                oggetti = scambio.get('oggetti', [])
-                for oggetto in oggetti:
+        if ciclo_db.usa_sinonimi is not None:
+            usa_sinonimi = ciclo_db.usa_sinonimi
+            ha_match_parziali = bool(ciclo_db.ha_match_parziali)
+        else:
+            usa_sinonimi = False
+            ha_match_parziali = False
+            for _da_user, _a_user, oggetti in scambi:
+                for offerto_id, richiesto_id, _tipo_match in oggetti:
                     # Verifica se c'è un match tramite sinonimi o parziali ricalcolando
                     try:
-                        offerto_id = oggetto.get('offerto', {}).get('id')
-                        richiesto_id = oggetto.get('richiesto', {}).get('id')
-
                         if offerto_id and richiesto_id:
                             # OTTIMIZZAZIONE: Usa dizionario pre-caricato invece di query DB
                             if annunci_dict:
@@ -1602,15 +2626,12 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
         user_offers = {}
         user_requests = {}
 
-        if 'scambi' in dettagli:
+        if scambi:
             # Prima verifica che tutti gli scambi abbiano oggetti validi
+            # (passaggi() restituisce solo i passaggi con almeno un oggetto: quelli
+            # senza oggetti hanno fallito i controlli metodo/distanza)
             num_scambi_attesi = len(user_ids)
-            scambi_completi = 0
-
-            for scambio in dettagli['scambi']:
-                # Se lo scambio non ha oggetti, significa che ha fallito i controlli metodo/distanza
-                if scambio and scambio.get('oggetti'):
-                    scambi_completi += 1
+            scambi_completi = len(scambi)
 
             # Se mancano scambi, questo ciclo è incompleto → non visualizzare
             if scambi_completi < num_scambi_attesi:
@@ -1618,16 +2639,11 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
                 return None
 
             # Ora costruisci il mapping
-            for scambio in dettagli['scambi']:
-                da_user = scambio.get('da_user')
-                a_user = scambio.get('a_user')
-                oggetti = scambio.get('oggetti', [])
-
-                for oggetto in oggetti:
+            for da_user, a_user, oggetti in scambi:
+                for offerto_id, richiesto_id, _tipo_match in oggetti:
                     # L'utente da_user offre 'offerto' e l'utente a_user cerca 'richiesto'
-                    if 'offerto' in oggetto and da_user:
+                    if da_user:
                         try:
-                            offerto_id = oggetto['offerto']['id']
                             # OTTIMIZZAZIONE: Usa dizionario pre-caricato invece di query DB
                             if annunci_dict:
                                 offerta = annunci_dict.get(offerto_id)
@@ -1636,12 +2652,11 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
 
                             if offerta:
                                 user_offers[da_user] = offerta
-                        except (Annuncio.DoesNotExist, KeyError):
+                        except Annuncio.DoesNotExist:
                             pass
 
-                    if 'richiesto' in oggetto and a_user:
+                    if a_user:
                         try:
-                            richiesto_id = oggetto['richiesto']['id']
                             # OTTIMIZZAZIONE: Usa dizionario pre-caricato invece di query DB
                             if annunci_dict:
                                 richiesta = annunci_dict.get(richiesto_id)
@@ -1650,7 +2665,7 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
 
                             if richiesta:
                                 user_requests[a_user] = richiesta
-                        except (Annuncio.DoesNotExist, KeyError):
+                        except Annuncio.DoesNotExist:
                             pass
 
         # FILTRO: Verifica che tutti gli annunci coinvolti siano ancora attivi
@@ -1664,12 +2679,10 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
         # La sequenza corretta è: A offre a B, B offre a C, C offre a A
         # Quindi dobbiamo seguire i link da_user -> a_user
         utenti_ordinati = []
-        if 'scambi' in dettagli and dettagli['scambi']:
+        if scambi:
             # Crea una mappa da_user -> a_user per seguire la catena
             scambi_map = {}
-            for scambio in dettagli['scambi']:
-                da_user = scambio.get('da_user')
-                a_user = scambio.get('a_user')
+            for da_user, a_user, _oggetti in scambi:
                 if da_user and a_user:
                     scambi_map[da_user] = a_user
 
@@ -1732,13 +2745,18 @@ def converti_ciclo_db_a_view_format(ciclo_db, annunci_dict=None):
             'utenti': utenti_ordinati,
             'dettagli': dettagli,
             'categoria_qualita': categoria_qualita,
-            'punteggio_qualita': dettagli.get('punteggio_qualita', 0),
+            'punteggio_qualita': (
+                ciclo_db.punteggio_qualita if ciclo_db.punteggio_qualita is not None
+                else dettagli.get('punteggio_qualita', 0)
+            ),
+            'ha_match_categoria': ciclo_db.ha_match_categoria,  # None: calcola_qualita_ciclo ricalcola
             'lunghezza': ciclo_db.lunghezza,
             'id_ciclo': str(ciclo_db.id),
             'calcolato_at': ciclo_db.calcolato_at,
             'annunci_coinvolti': annunci_coinvolti,
             'usa_sinonimi': usa_sinonimi,  # Flag per filtraggio UI
             'ha_match_parziali': ha_match_parziali,  # Flag per filtraggio match esatti
+            'fasce_pari': ciclo_db.fasce_pari,  # None per i cicli salvati prima del flag
             'da_database': True  # Flag per identificare cicli pre-calcolati
         }
 
@@ -1789,7 +2807,7 @@ def trova_scambi_diretti_ottimizzato():
     Versione ottimizzata che sostituisce trova_scambi_diretti().
     Legge solo i cicli di lunghezza 2 dal database.
     """
-    risultato = get_cicli_precalcolati()
+    risultato = get_cicli_precalcolati(max_lunghezza=2)
     return risultato['scambi_diretti']
 
 
@@ -1807,6 +2825,13 @@ def calcola_qualita_ciclo(ciclo, return_tipo_match=False):
     if not ciclo.get('utenti'):
         return (0, True) if return_tipo_match else 0
 
+    # Valori salvati dal calcolo cicli (CicloScambio.punteggio_qualita / ha_match_categoria)
+    if ciclo.get('ha_match_categoria') is not None and ciclo.get('punteggio_qualita') is not None:
+        punteggio = ciclo['punteggio_qualita']
+        if return_tipo_match:
+            return punteggio, not ciclo['ha_match_categoria']
+        return punteggio
+
     punteggio_totale = 0
     num_scambi = 0
     ha_match_titoli = True  # Assume True inizialmente, diventa False se trova match generici
@@ -1862,17 +2887,14 @@ def trova_catene_scambio_ottimizzato(max_lunghezza=6, solo_alta_qualita=True, so
         solo_alta_qualita: Se True, mostra solo catene con parole in comune (≥soglia_qualita)
         soglia_qualita: Punteggio minimo per considerare una catena di alta qualità (default: 20)
     """
-    risultato = get_cicli_precalcolati()
+    # Lunghezza e punteggio salvato filtrati in SQL
+    risultato = get_cicli_precalcolati(
+        max_lunghezza=max_lunghezza,
+        punteggio_min=soglia_qualita if solo_alta_qualita else None,
+    )
     catene = risultato['catene']
 
-    # Filtra per lunghezza se specificata
-    if max_lunghezza:
-        catene = [
-            catena for catena in catene
-            if catena['lunghezza'] <= max_lunghezza
-        ]
-
-    # Filtra per qualità se richiesto
+    # Filtra per qualità se richiesto (ricalcolata solo per i cicli senza punteggio salvato)
     if solo_alta_qualita:
         catene_alta_qualita = []
         for catena in catene:
@@ -1912,6 +2934,8 @@ def trova_catene_per_annuncio_ottimizzato(annuncio, max_lunghezza=6, includi_gen
     """
     Versione ottimizzata che trova cicli pre-calcolati contenenti un annuncio specifico.
     Sostituisce trova_catene_per_annuncio() per evitare brute-force.
+    I cicli che mostrano l'annuncio si ottengono con un join su CicloAnnuncio,
+    senza caricare e convertire tutti i cicli validi.
 
     Args:
         annuncio: Istanza Annuncio per cui cercare catene
@@ -1926,63 +2950,26 @@ def trova_catene_per_annuncio_ottimizzato(annuncio, max_lunghezza=6, includi_gen
 
     print(f"🔍 Ricerca ottimizzata per annuncio: {annuncio.titolo} (ID: {annuncio.id})")
 
-    # Carica tutti i cicli pre-calcolati
-    risultato = get_cicli_precalcolati()
-    tutti_cicli = risultato['scambi_diretti'] + risultato['catene']
+    # Solo i cicli dell'annuncio (lunghezza e punteggio salvato filtrati in SQL)
+    risultato = get_cicli_precalcolati(
+        max_lunghezza=max_lunghezza,
+        punteggio_min=None if includi_generiche else 20,
+        annuncio_id=annuncio.id,
+    )
 
     cicli_per_annuncio = []
 
-    for ciclo in tutti_cicli:
-        # Controlla se l'utente dell'annuncio è nel ciclo
-        if any(u['user'].id == annuncio.utente.id for u in ciclo['utenti']):
-            # Verifica se l'annuncio è tra quelli del ciclo analizzando i dettagli
-            if controlla_annuncio_in_ciclo(annuncio, ciclo):
-                if max_lunghezza is None or ciclo['lunghezza'] <= max_lunghezza:
-                    # Filtra per qualità se richiesto
-                    if not includi_generiche:
-                        qualita = calcola_qualita_ciclo(ciclo)
-                        if qualita < 20:
-                            continue  # Salta catene generiche
-                        ciclo['punteggio_qualita'] = qualita
-
-                    cicli_per_annuncio.append(ciclo)
+    for ciclo in risultato['scambi_diretti'] + risultato['catene']:
+        # Filtra per qualità se richiesto (cicli senza punteggio salvato)
+        if not includi_generiche:
+            qualita = calcola_qualita_ciclo(ciclo)
+            if qualita < 20:
+                continue  # Salta catene generiche
+            ciclo['punteggio_qualita'] = qualita
+
+        cicli_per_annuncio.append(ciclo)
 
     elapsed = time.time() - start_time
     print(f"✅ Trovati {len(cicli_per_annuncio)} cicli per annuncio in {elapsed:.3f}s")
 
     return cicli_per_annuncio
-
-
-def controlla_annuncio_in_ciclo(annuncio, ciclo):
-    """
-    Controlla se un annuncio specifico è coinvolto in un ciclo pre-calcolato.
-
-    Args:
-        annuncio: Istanza Annuncio da cercare
-        ciclo: Ciclo convertito dal database
-
-    Returns:
-        bool: True se l'annuncio è coinvolto nel ciclo
-    """
-    try:
-        # Controlla nei dettagli del ciclo se c'è riferimento all'annuncio
-        dettagli = ciclo.get('dettagli', {})
-
-        # Cerca nelle informazioni degli annunci nel ciclo
-        if 'annunci' in dettagli:
-            for annuncio_info in dettagli['annunci']:
-                if annuncio_info.get('id') == annuncio.id:
-                    return True
-
-        # Fallback: se l'utente è nel ciclo e ha lo stesso tipo/categoria dell'annuncio
-        if any(u['user'].id == annuncio.utente.id for u in ciclo['utenti']):
-            # Controllo semplificato basato sulla presenza dell'utente
-            # In futuro si può migliorare analizzando meglio i dettagli
-            return True
-
-        return False
-
-    except Exception as e:
-        print(f"⚠️ Errore controllo annuncio in ciclo: {e}")
-        # In caso di errore, assume che l'annuncio sia coinvolto se l'utente è presente
-        return any(u['user'].id == annuncio.utente.id for u in ciclo['utenti'])
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0026_userprofile_newsletter_enabled_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annuncio',
+            name='parole_chiave',
+            field=models.JSONField(blank=True, editable=False, help_text='Parole chiave normalizzate del titolo (singole + termini composti)', null=True, verbose_name='Parole chiave'),
+        ),
+        migrations.AddField(
+            model_name='annuncio',
+            name='termini_composti',
+            field=models.JSONField(blank=True, editable=False, help_text='Termini composti riconosciuti nel titolo', null=True, verbose_name='Termini composti'),
+        ),
+        migrations.AddField(
+            model_name='annuncio',
+            name='sinonimi_chiave',
+            field=models.JSONField(blank=True, editable=False, help_text="Termini significativi dell'espansione sinonimi delle parole chiave", null=True, verbose_name='Sinonimi'),
+        ),
+    ]
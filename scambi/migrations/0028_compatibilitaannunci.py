@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0027_annuncio_token_matching'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompatibilitaAnnunci',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo_match', models.CharField(choices=[('specifico', 'Specifico'), ('parziale', 'Parziale'), ('sinonimo', 'Sinonimo'), ('categoria', 'Categoria')], max_length=20)),
+                ('punteggio', models.IntegerField(default=0, help_text='Punteggio qualità (calcola_punteggio_qualita_avanzato, 0-100)')),
+                ('distanza_km', models.IntegerField(blank=True, help_text='Distanza tra le province dei due utenti al momento del calcolo', null=True)),
+                ('calcolato_at', models.DateTimeField(auto_now=True)),
+                ('offerta', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compatibilita_come_offerta', to='scambi.annuncio')),
+                ('richiesta', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compatibilita_come_richiesta', to='scambi.annuncio')),
+            ],
+            options={
+                'verbose_name': 'Compatibilità Annunci',
+                'verbose_name_plural': 'Compatibilità Annunci',
+                'indexes': [models.Index(fields=['richiesta'], name='scambi_comp_richies_976ca8_idx')],
+                'unique_together': {('offerta', 'richiesta')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0028_compatibilitaannunci'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calcolometadata',
+            name='archi_grafo',
+            field=models.JSONField(blank=True, help_text="Archi del grafo utenti usati nell'ultimo calcolo", null=True),
+        ),
+    ]
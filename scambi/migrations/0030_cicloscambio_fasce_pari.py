@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0029_calcolometadata_archi_grafo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='fasce_pari',
+            field=models.BooleanField(blank=True, help_text='Tutti gli scambi del ciclo sono nella stessa fascia di prezzo', null=True),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.6 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0030_cicloscambio_fasce_pari'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='annunci_ids',
+            field=models.JSONField(blank=True, help_text='Id ordinati di tutti gli annunci citati nei dettagli del ciclo', null=True),
+        ),
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='categoria_qualita',
+            field=models.CharField(blank=True, help_text="Categoria di qualità del ciclo ('alta' o 'generica')", max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='ha_match_categoria',
+            field=models.BooleanField(blank=True, help_text='Almeno uno scambio mostrato è compatibile solo per categoria', null=True),
+        ),
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='ha_match_parziali',
+            field=models.BooleanField(blank=True, help_text='Almeno un oggetto del ciclo è compatibile con match parziale', null=True),
+        ),
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='punteggio_qualita',
+            field=models.IntegerField(blank=True, help_text='Media dei punteggi di qualità degli scambi mostrati', null=True),
+        ),
+        migrations.AddField(
+            model_name='cicloscambio',
+            name='usa_sinonimi',
+            field=models.BooleanField(blank=True, help_text='Almeno un oggetto del ciclo è compatibile tramite sinonimi', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cicloscambio',
+            index=models.Index(fields=['valido', 'punteggio_qualita'], name='scambi_cicl_valido_de2e0d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cicloscambio',
+            index=models.Index(fields=['valido', 'categoria_qualita', 'punteggio_qualita'], name='scambi_cicl_valido_fb49b0_idx'),
+        ),
+    ]
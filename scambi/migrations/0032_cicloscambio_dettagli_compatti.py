@@ -0,0 +1,153 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:00
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+# Conversioni v1 <-> v2 come scambi.dettagli_ciclo al momento della migrazione
+# (copiate qui perché la migrazione non cambi se il modulo evolve)
+VERSIONE_COMPATTA = 2
+CODICI_MATCH = {
+    'specifico': 's',
+    'parziale': 'p',
+    'sinonimo': 'n',
+    'categoria': 'c',
+}
+TIPI_MATCH = {codice: tipo for tipo, codice in CODICI_MATCH.items()}
+CHIAVI_RIDONDANTI = ('scambi', 'oggetti', 'utenti', 'timestamp')
+
+
+def _is_compatti(dettagli):
+    return bool(dettagli) and dettagli.get('v') == VERSIONE_COMPATTA
+
+
+def _comprimi_dettagli(dettagli):
+    compatti = {chiave: valore for chiave, valore in dettagli.items() if chiave not in CHIAVI_RIDONDANTI}
+    compatti['v'] = VERSIONE_COMPATTA
+    compatti['scambi'] = [
+        [
+            scambio.get('da_user'),
+            scambio.get('a_user'),
+            [
+                [
+                    oggetto.get('offerto', {}).get('id'),
+                    oggetto.get('richiesto', {}).get('id'),
+                    CODICI_MATCH.get(oggetto.get('tipo_match'), oggetto.get('tipo_match')),
+                ]
+                for oggetto in scambio.get('oggetti', [])
+            ],
+        ]
+        for scambio in dettagli.get('scambi', [])
+        if scambio and scambio.get('oggetti')
+    ]
+    return compatti
+
+
+def _passaggi_compatti(dettagli):
+    return [
+        (da_user, a_user, [(offerto_id, richiesto_id, TIPI_MATCH.get(codice, codice))
+                           for offerto_id, richiesto_id, codice in oggetti])
+        for da_user, a_user, oggetti in dettagli['scambi']
+        if oggetti
+    ]
+
+
+def _annunci_ids_dettagli(dettagli):
+    annunci_ids = set()
+    for _da_user, _a_user, oggetti in _passaggi_compatti(dettagli):
+        for offerto_id, richiesto_id, _tipo_match in oggetti:
+            annunci_ids.add(offerto_id)
+            annunci_ids.add(richiesto_id)
+    annunci_ids.discard(None)
+    return annunci_ids
+
+
+def _espandi_dettagli(dettagli, annunci, users):
+    def info(annuncio_id):
+        annuncio = annunci.get(annuncio_id)
+        return {
+            'id': annuncio_id,
+            'titolo': annuncio.titolo if annuncio else None,
+            'categoria': annuncio.categoria.nome if annuncio else None,
+        }
+
+    espansi = {chiave: valore for chiave, valore in dettagli.items() if chiave not in ('v', 'scambi')}
+    espansi.update({'scambi': [], 'oggetti': [], 'utenti': []})
+
+    per_utente = {}
+    for da_user, a_user, oggetti in _passaggi_compatti(dettagli):
+        scambio = {
+            'da_user': da_user,
+            'a_user': a_user,
+            'oggetti': [
+                {'offerto': info(offerto_id), 'richiesto': info(richiesto_id), 'tipo_match': tipo_match}
+                for offerto_id, richiesto_id, tipo_match in oggetti
+            ],
+        }
+        espansi['scambi'].append(scambio)
+        espansi['oggetti'].extend(scambio['oggetti'])
+        per_utente[da_user] = scambio['oggetti'][-1]
+
+    for user_id in users:
+        ultimo = per_utente.get(user_id)
+        espansi['utenti'].append({
+            'user': {'id': user_id},
+            'offerta': ultimo['offerto'] if ultimo else None,
+            'richiede': ultimo['richiesto'] if ultimo else None,
+        })
+
+    return espansi
+
+
+def _batch_cicli(CicloScambio):
+    """Cicli a blocchi di BATCH_SIZE in ordine di id (senza caricare tutta la tabella)"""
+    ultimo_id = 0
+    while True:
+        batch = list(
+            CicloScambio.objects.filter(id__gt=ultimo_id).order_by('id').only('id', 'users', 'dettagli')[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        yield batch
+        ultimo_id = batch[-1].id
+
+
+def comprimi(apps, schema_editor):
+    """Riscrive i dettagli v1 nel formato compatto v2"""
+    CicloScambio = apps.get_model('scambi', 'CicloScambio')
+
+    for batch in _batch_cicli(CicloScambio):
+        modificati = []
+        for ciclo in batch:
+            if isinstance(ciclo.dettagli, dict) and not _is_compatti(ciclo.dettagli):
+                ciclo.dettagli = _comprimi_dettagli(ciclo.dettagli)
+                modificati.append(ciclo)
+        CicloScambio.objects.bulk_update(modificati, ['dettagli'])
+
+
+def espandi(apps, schema_editor):
+    """Riporta i dettagli compatti al formato v1 (titoli e categorie dagli annunci)"""
+    CicloScambio = apps.get_model('scambi', 'CicloScambio')
+    Annuncio = apps.get_model('scambi', 'Annuncio')
+
+    for batch in _batch_cicli(CicloScambio):
+        compatti = [ciclo for ciclo in batch if _is_compatti(ciclo.dettagli)]
+        annunci_ids = set()
+        for ciclo in compatti:
+            annunci_ids.update(_annunci_ids_dettagli(ciclo.dettagli))
+        annunci = Annuncio.objects.filter(id__in=annunci_ids).select_related('categoria').in_bulk()
+
+        for ciclo in compatti:
+            ciclo.dettagli = _espandi_dettagli(ciclo.dettagli, annunci, ciclo.users)
+        CicloScambio.objects.bulk_update(compatti, ['dettagli'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0031_cicloscambio_attributi_derivati'),
+    ]
+
+    operations = [
+        migrations.RunPython(comprimi, espandi),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def _rank_score(ciclo):
+    # Come CicloUtente.calcola_rank_score al momento della migrazione
+    return (
+        (100000 if ciclo.categoria_qualita == 'alta' else 0)
+        + (100 - ciclo.lunghezza) * 1000
+        + (ciclo.punteggio_qualita or 0)
+    )
+
+
+def popola_utenti_cicli(apps, schema_editor):
+    """Una riga CicloUtente per ogni utente dei cicli già salvati, a blocchi in ordine di id"""
+    CicloScambio = apps.get_model('scambi', 'CicloScambio')
+    CicloUtente = apps.get_model('scambi', 'CicloUtente')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+
+    ultimo_id = 0
+    while True:
+        batch = list(
+            CicloScambio.objects.filter(id__gt=ultimo_id).order_by('id').only(
+                'id', 'users', 'lunghezza', 'punteggio_qualita', 'categoria_qualita'
+            )[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+
+        # Salta gli utenti non più esistenti (cicli vecchi non ancora ricalcolati)
+        utenti_ids = {user_id for ciclo in batch for user_id in ciclo.users}
+        utenti_esistenti = set(User.objects.filter(id__in=utenti_ids).values_list('id', flat=True))
+
+        CicloUtente.objects.bulk_create([
+            CicloUtente(ciclo_id=ciclo.id, utente_id=user_id, posizione=posizione, rank_score=_rank_score(ciclo))
+            for ciclo in batch
+            for posizione, user_id in enumerate(ciclo.users)
+            if user_id in utenti_esistenti
+        ], ignore_conflicts=True)
+        ultimo_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0032_cicloscambio_dettagli_compatti'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CicloUtente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('posizione', models.PositiveSmallIntegerField(help_text="Posizione dell'utente nel ciclo (0 = primo di users)")),
+                ('rank_score', models.IntegerField(default=0, help_text="Punteggio per ordinare i cicli dell'utente (più alto = migliore, vedi calcola_rank_score)")),
+                ('ciclo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='membri', to='scambi.cicloscambio')),
+                ('utente', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cicli_scambio', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Utente del Ciclo',
+                'verbose_name_plural': 'Utenti dei Cicli',
+                'indexes': [models.Index(fields=['utente', '-rank_score', 'ciclo'], name='scambi_cicl_utente__236d00_idx')],
+                'unique_together': {('ciclo', 'utente')},
+            },
+        ),
+        migrations.RunPython(popola_utenti_cicli, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# Versione del formato compatto dei dettagli (vedi 0032)
+VERSIONE_COMPATTA = 2
+
+
+def _annunci_mostrati(dettagli):
+    # Come dettagli_ciclo.annunci_mostrati al momento della migrazione:
+    # l'ultimo oggetto di ogni passaggio con almeno un oggetto
+    if not dettagli:
+        return set()
+    if dettagli.get('v') == VERSIONE_COMPATTA:
+        ultimi = [oggetti[-1][:2] for _da_user, _a_user, oggetti in dettagli['scambi'] if oggetti]
+    else:
+        ultimi = [
+            (scambio['oggetti'][-1].get('offerto', {}).get('id'), scambio['oggetti'][-1].get('richiesto', {}).get('id'))
+            for scambio in dettagli.get('scambi', [])
+            if scambio and scambio.get('oggetti')
+        ]
+    annunci_ids = {annuncio_id for coppia in ultimi for annuncio_id in coppia}
+    annunci_ids.discard(None)
+    return annunci_ids
+
+
+def popola_annunci_cicli(apps, schema_editor):
+    """Una riga CicloAnnuncio per ogni annuncio mostrato nei cicli già salvati, a blocchi in ordine di id"""
+    CicloScambio = apps.get_model('scambi', 'CicloScambio')
+    CicloAnnuncio = apps.get_model('scambi', 'CicloAnnuncio')
+    Annuncio = apps.get_model('scambi', 'Annuncio')
+
+    ultimo_id = 0
+    while True:
+        batch = list(
+            CicloScambio.objects.filter(id__gt=ultimo_id).order_by('id').only('id', 'dettagli')[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+
+        mostrati = {ciclo.id: _annunci_mostrati(ciclo.dettagli) for ciclo in batch}
+
+        # Salta gli annunci non più esistenti (cicli vecchi non ancora ricalcolati)
+        annunci_ids = set().union(*mostrati.values())
+        annunci_esistenti = set(Annuncio.objects.filter(id__in=annunci_ids).values_list('id', flat=True))
+
+        CicloAnnuncio.objects.bulk_create([
+            CicloAnnuncio(ciclo_id=ciclo_id, annuncio_id=annuncio_id)
+            for ciclo_id, annunci_ciclo in mostrati.items()
+            for annuncio_id in sorted(annunci_ciclo)
+            if annuncio_id in annunci_esistenti
+        ], ignore_conflicts=True)
+        ultimo_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0033_cicloutente'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CicloAnnuncio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('annuncio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cicli_collegati', to='scambi.annuncio')),
+                ('ciclo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='annunci_collegati', to='scambi.cicloscambio')),
+            ],
+            options={
+                'verbose_name': 'Annuncio del Ciclo',
+                'verbose_name_plural': 'Annunci dei Cicli',
+                'unique_together': {('ciclo', 'annuncio')},
+            },
+        ),
+        migrations.RunPython(popola_annunci_cicli, migrations.RunPython.noop),
+    ]
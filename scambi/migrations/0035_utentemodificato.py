@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0034_cicloannuncio'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UtenteModificato',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('utente_id', models.IntegerField(unique=True)),
+                ('modificato_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Utente Modificato',
+                'verbose_name_plural': 'Utenti Modificati',
+            },
+        ),
+    ]
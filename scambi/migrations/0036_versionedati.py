@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scambi', '0035_utentemodificato'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersioneDati',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chiave', models.CharField(max_length=50, unique=True)),
+                ('versione', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Versione Dati',
+                'verbose_name_plural': 'Versioni Dati',
+            },
+        ),
+    ]
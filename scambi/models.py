@@ -136,12 +136,48 @@ class Annuncio(models.Model):
         help_text="Quando è stata completata la moderazione automatica"
     )
 
+    # Token del titolo pre-calcolati per il matching (aggiornati in save())
+    # Se None l'annuncio non è ancora stato processato: il matching li ricalcola al volo
+    parole_chiave = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Parole chiave",
+        help_text="Parole chiave normalizzate del titolo (singole + termini composti)"
+    )
+    termini_composti = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Termini composti",
+        help_text="Termini composti riconosciuti nel titolo"
+    )
+    sinonimi_chiave = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Sinonimi",
+        help_text="Termini significativi dell'espansione sinonimi delle parole chiave"
+    )
+
     data_creazione = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True, verbose_name="Ultima modifica")
 
+    # Campi scritti da aggiorna_token_matching()
+    CAMPI_TOKEN_MATCHING = ['parole_chiave', 'termini_composti', 'sinonimi_chiave']
+
     def __str__(self):
         return f"{self.utente.username} - {self.tipo}: {self.titolo}"
 
+    def aggiorna_token_matching(self):
+        """Calcola parole chiave, termini composti e sinonimi del titolo per il matching"""
+        from .matching import calcola_token_annuncio
+
+        token = calcola_token_annuncio(self.titolo or '')
+        self.parole_chiave = token['parole_chiave']
+        self.termini_composti = token['termini_composti']
+        self.sinonimi_chiave = token['sinonimi_chiave']
+
     def get_condizione_icon(self):
         """Restituisce l'icona corrispondente alla condizione dell'oggetto"""
         icons = {
@@ -249,9 +285,15 @@ class Annuncio(models.Model):
                 'titolo': 'Il titolo deve contenere almeno 3 caratteri per permettere il matching con altri annunci.'
             })
 
+        # Tokenizza il titolo una volta sola qui, invece che a ogni confronto nel matching
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'titolo' in update_fields:
+            self.aggiorna_token_matching()
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = list(update_fields) + self.CAMPI_TOKEN_MATCHING
+
         # Verifica se è un'approvazione/rifiuto manuale dall'admin
         # L'admin usa save(update_fields=['moderation_status', ...])
-        update_fields = kwargs.get('update_fields')
         is_admin_action = update_fields and 'moderation_status' in update_fields
 
         # Verifica se è un nuovo annuncio o se l'immagine è cambiata
@@ -656,6 +698,38 @@ class Provincia(models.Model):
         return f"{self.nome} ({self.sigla})"
 
 
+class VersioneDati(models.Model):
+    """
+    Contatore di versione di dati che i processi tengono in memoria
+    (es. la matrice delle distanze tra province, vedi geo_distance).
+
+    Chi modifica i dati incrementa la versione; ogni processo la rilegge
+    periodicamente e ricostruisce la sua copia se è cambiata. A differenza della
+    cache locale (LocMemCache) vale per tutti i worker gunicorn e per i processi
+    del calcolo cicli.
+    """
+    chiave = models.CharField(max_length=50, unique=True)
+    versione = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Versione Dati"
+        verbose_name_plural = "Versioni Dati"
+
+    def __str__(self):
+        return f"{self.chiave} v{self.versione}"
+
+    @classmethod
+    def get_versione(cls, chiave):
+        """Versione corrente dei dati (0 se mai modificati)"""
+        return cls.objects.filter(chiave=chiave).values_list('versione', flat=True).first() or 0
+
+    @classmethod
+    def incrementa(cls, chiave):
+        """Segna i dati come modificati (UPDATE atomico, sicuro tra processi)"""
+        obj, _created = cls.objects.get_or_create(chiave=chiave)
+        cls.objects.filter(pk=obj.pk).update(versione=models.F('versione') + 1)
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
@@ -724,33 +798,14 @@ class UserProfile(models.Model):
         return f"{self.citta}, {self.provincia_obj.nome} ({self.provincia_obj.sigla})"
 
     def get_distanza_km(self, altro_profilo):
-        """Calcola la distanza tra due province usando le coordinate GPS (formula di Haversine)"""
-        from math import radians, sin, cos, sqrt, atan2
-
-        if not self.provincia_obj or not altro_profilo.provincia_obj:
-            return 9999  # Distanza default se manca la provincia
-
-        if self.provincia_obj == altro_profilo.provincia_obj:
-            return 0  # Stessa provincia
-
-        # Coordinate del capoluogo provincia 1
-        lat1 = radians(self.provincia_obj.latitudine)
-        lon1 = radians(self.provincia_obj.longitudine)
-
-        # Coordinate del capoluogo provincia 2
-        lat2 = radians(altro_profilo.provincia_obj.latitudine)
-        lon2 = radians(altro_profilo.provincia_obj.longitudine)
-
-        # Formula di Haversine
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-
-        # Raggio della Terra in km
-        r = 6371
+        """
+        Distanza in km tra le province dei due profili (formula di Haversine sui capoluoghi),
+        letta dalla matrice delle distanze del processo (vedi geo_distance): 0 se stessa
+        provincia, 9999 se manca la provincia
+        """
+        from .geo_distance import distanza_province
 
-        return int(r * c)  # Distanza in km (arrotondata)
+        return distanza_province(self.provincia_obj_id, altro_profilo.provincia_obj_id)
 
     # === SISTEMA LIMITI ANNUNCI ===
 
@@ -1128,6 +1183,8 @@ class CicloScambio(models.Model):
     )
 
     # Dettagli completi del ciclo (annunci coinvolti, oggetti scambiati, etc.)
+    # nel formato compatto v2 (solo id, vedi scambi/dettagli_ciclo.py): per titoli
+    # e categorie usare get_dettagli()
     dettagli = models.JSONField(
         help_text="Dettagli completi del ciclo: annunci, oggetti, compatibilità"
     )
@@ -1151,6 +1208,62 @@ class CicloScambio(models.Model):
         help_text="Hash MD5 del ciclo per rilevare duplicati"
     )
 
+    # Scambi "alla pari": tutti gli annunci mostrati nella stessa fascia di prezzo
+    # (calcolato dal CycleFinder; None per i cicli salvati prima del campo)
+    fasce_pari = models.BooleanField(
+        null=True,
+        blank=True,
+        help_text="Tutti gli scambi del ciclo sono nella stessa fascia di prezzo"
+    )
+
+    # Attributi derivati calcolati una volta dal CycleFinder (None per i cicli
+    # salvati prima dei campi: le letture ricadono sul calcolo dai dettagli)
+    punteggio_qualita = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="Media dei punteggi di qualità degli scambi mostrati"
+    )
+
+    categoria_qualita = models.CharField(
+        max_length=20,
+        null=True,
+        blank=True,
+        help_text="Categoria di qualità del ciclo ('alta' o 'generica')"
+    )
+
+    usa_sinonimi = models.BooleanField(
+        null=True,
+        blank=True,
+        help_text="Almeno un oggetto del ciclo è compatibile tramite sinonimi"
+    )
+
+    ha_match_parziali = models.BooleanField(
+        null=True,
+        blank=True,
+        help_text="Almeno un oggetto del ciclo è compatibile con match parziale"
+    )
+
+    ha_match_categoria = models.BooleanField(
+        null=True,
+        blank=True,
+        help_text="Almeno uno scambio mostrato è compatibile solo per categoria"
+    )
+
+    annunci_ids = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Id ordinati di tutti gli annunci citati nei dettagli del ciclo"
+    )
+
+    # Campi scritti dal calcolo cicli insieme a users/lunghezza/dettagli
+    CAMPI_DERIVATI = [
+        'fasce_pari', 'punteggio_qualita', 'categoria_qualita',
+        'usa_sinonimi', 'ha_match_parziali', 'ha_match_categoria', 'annunci_ids',
+    ]
+
+    # Campi confrontati dal calcolo completo per capire se un ciclo è cambiato
+    CAMPI_CONFRONTO = ['users', 'lunghezza', 'dettagli'] + CAMPI_DERIVATI
+
     class Meta:
         verbose_name = "Ciclo di Scambio"
         verbose_name_plural = "Cicli di Scambio"
@@ -1161,21 +1274,24 @@ class CicloScambio(models.Model):
             models.Index(fields=['valido', 'lunghezza']),
             models.Index(fields=['calcolato_at']),
             models.Index(fields=['hash_ciclo']),
+            models.Index(fields=['valido', 'punteggio_qualita']),
+            models.Index(fields=['valido', 'categoria_qualita', 'punteggio_qualita']),
         ]
 
     def __str__(self):
         users_str = " → ".join([f"User({uid})" for uid in self.users])
         return f"Ciclo {self.lunghezza} utenti: {users_str}"
 
-    def to_dict(self):
+    def to_dict(self, annunci=None):
         """
         Serializza il ciclo per l'API JSON
+        (dettagli sempre nel formato completo, vedi get_dettagli)
         """
         return {
             'id': self.id,
             'users': self.users,
             'lunghezza': self.lunghezza,
-            'dettagli': self.dettagli,
+            'dettagli': self.get_dettagli(annunci),
             'calcolato_at': self.calcolato_at.isoformat(),
             'valido': self.valido,
             'hash_ciclo': self.hash_ciclo
@@ -1187,26 +1303,231 @@ class CicloScambio(models.Model):
         """
         return user_id in self.users
 
+    def get_annunci_ids(self):
+        """Id di tutti gli annunci del ciclo (colonna salvata o, per i cicli più vecchi, dai dettagli)"""
+        from .dettagli_ciclo import annunci_ids_dettagli
+
+        if self.annunci_ids is not None:
+            return set(self.annunci_ids)
+        return annunci_ids_dettagli(self.dettagli)
+
+    def get_dettagli(self, annunci=None):
+        """
+        Dettagli nel formato completo (scambi/oggetti/utenti con titoli e categorie),
+        anche se salvati nel formato compatto v2 (vedi scambi/dettagli_ciclo.py).
+
+        Args:
+            annunci: dict {annuncio_id: Annuncio} già caricato (es. da annunci_dei_cicli);
+                     se None gli annunci del ciclo vengono letti con una query
+        """
+        from .dettagli_ciclo import espandi_dettagli, is_compatti
+
+        if not is_compatti(self.dettagli):
+            return self.dettagli
+        if annunci is None:
+            annunci = CicloScambio.annunci_dei_cicli([self])
+        return espandi_dettagli(self.dettagli, annunci, self.users)
+
+    @classmethod
+    def annunci_dei_cicli(cls, cicli):
+        """Annunci (con categoria) di tutti i cicli indicati in una sola query: {id: Annuncio}"""
+        annunci_ids = set()
+        for ciclo in cicli:
+            annunci_ids.update(ciclo.get_annunci_ids())
+        if not annunci_ids:
+            return {}
+        return Annuncio.objects.filter(id__in=annunci_ids).select_related('categoria').in_bulk()
+
     @classmethod
-    def find_for_user(cls, user_id, limit=50):
+    def find_for_user(cls, user_id, limit=50, offset=0):
         """
-        Query ottimizzata per trovare cicli contenenti un utente specifico
+        Cicli validi che contengono un utente, migliori prima (CicloUtente.rank_score), a pagine.
+        Scansione dell'indice (utente, -rank_score, ciclo) di CicloUtente, uguale su PostgreSQL e SQLite.
         """
-        from django.db.models import Q
-
-        # Costruisce query JSON per PostgreSQL o fallback per SQLite
-        if 'postgresql' in settings.DATABASES['default']['ENGINE']:
-            # PostgreSQL: usa operatori JSON nativi
-            return cls.objects.filter(
-                valido=True,
-                users__contains=user_id
-            ).order_by('lunghezza', '-calcolato_at')[:limit]
-        else:
-            # SQLite: usa icontains come fallback (meno efficiente ma funziona)
-            return cls.objects.filter(
-                valido=True,
-                users__icontains=f'"{user_id}"'
-            ).order_by('lunghezza', '-calcolato_at')[:limit]
+        return cls.objects.filter(
+            valido=True,
+            membri__utente_id=user_id
+        ).order_by('-membri__rank_score', 'membri__ciclo_id')[offset:offset + limit]
+
+    @classmethod
+    def salva_batch(cls, cicli, valido=True):
+        """
+        Upsert di un blocco di cicli calcolati (dict del CycleFinder) in pochi statement:
+        - una query per gli id dei cicli già presenti (per hash_ciclo)
+        - bulk_update per aggiornare e riattivare quelli esistenti: l'id non cambia,
+          quindi le PropostaCatena collegate restano valide
+        - bulk_create per i nuovi, con ON CONFLICT (hash_ciclo) DO UPDATE dove il
+          database lo supporta (PostgreSQL, SQLite ≥ 3.24): un ciclo inserito nel
+          frattempo da un altro processo viene aggiornato invece di fallire
+        - DELETE + INSERT in blocco delle righe CicloUtente e CicloAnnuncio dei cicli del blocco
+
+        Args:
+            cicli: dict del CycleFinder
+            valido: stato con cui vengono scritti i cicli (False = non ancora visibili,
+                    vedi attiva_differenze)
+
+        Returns:
+            tuple: (creati, aggiornati)
+        """
+        from django.db import connection
+
+        # Un hash per ciclo (l'ultimo vince, come con gli upsert riga per riga)
+        cicli = list({ciclo['hash_ciclo']: ciclo for ciclo in cicli}.values())
+        if not cicli:
+            return 0, 0
+
+        campi = ['users', 'lunghezza', 'dettagli', 'valido', 'calcolato_at'] + cls.CAMPI_DERIVATI
+        ids_esistenti = dict(
+            cls.objects.filter(hash_ciclo__in=[ciclo['hash_ciclo'] for ciclo in cicli]).values_list('hash_ciclo', 'id')
+        )
+
+        # auto_now non viene applicato da bulk_update: calcolato_at esplicito per tutti
+        adesso = timezone.now()
+        esistenti = []
+        nuovi = []
+        for ciclo in cicli:
+            istanza = cls(
+                id=ids_esistenti.get(ciclo['hash_ciclo']),
+                hash_ciclo=ciclo['hash_ciclo'],
+                users=ciclo['users'],
+                lunghezza=ciclo['lunghezza'],
+                dettagli=ciclo['dettagli'],
+                valido=valido,
+                calcolato_at=adesso,
+                **{campo: ciclo.get(campo) for campo in cls.CAMPI_DERIVATI}
+            )
+            (nuovi if istanza.id is None else esistenti).append(istanza)
+
+        if esistenti:
+            cls.objects.bulk_update(esistenti, campi)
+
+        if nuovi:
+            if connection.features.supports_update_conflicts_with_target:
+                cls.objects.bulk_create(
+                    nuovi,
+                    update_conflicts=True,
+                    unique_fields=['hash_ciclo'],
+                    update_fields=campi,
+                )
+            else:
+                cls.objects.bulk_create(nuovi)
+
+            # Non tutti i database restituiscono gli id da bulk_create
+            if any(istanza.id is None for istanza in nuovi):
+                ids_creati = dict(
+                    cls.objects.filter(hash_ciclo__in=[istanza.hash_ciclo for istanza in nuovi]).values_list('hash_ciclo', 'id')
+                )
+                for istanza in nuovi:
+                    istanza.id = ids_creati.get(istanza.hash_ciclo)
+
+        # Utenti dei cicli (CicloUtente), con il rank aggiornato, e annunci mostrati (CicloAnnuncio)
+        CicloUtente.sostituisci_per_cicli(esistenti + nuovi)
+        CicloAnnuncio.sostituisci_per_cicli(esistenti + nuovi)
+
+        return len(nuovi), len(esistenti)
+
+    @classmethod
+    def impronta(cls, valori):
+        """
+        Impronta (md5) dei CAMPI_CONFRONTO di un ciclo, per confrontare un ciclo
+        calcolato (dict del CycleFinder) con quello salvato (dict di values())
+        """
+        import hashlib
+        import json
+
+        contenuto = json.dumps([valori.get(campo) for campo in cls.CAMPI_CONFRONTO], sort_keys=True)
+        return hashlib.md5(contenuto.encode()).hexdigest()
+
+    @classmethod
+    def impronte_validi(cls):
+        """{hash_ciclo: impronta} dei cicli validi, letti a blocchi senza istanziare i modelli"""
+        cicli = cls.objects.filter(valido=True).values('hash_ciclo', *cls.CAMPI_CONFRONTO)
+        return {
+            valori['hash_ciclo']: cls.impronta(valori)
+            for valori in cicli.iterator(chunk_size=2000)
+        }
+
+    @classmethod
+    def attiva_differenze(cls, nuovi, spariti, batch_size=1000, cambiati=()):
+        """
+        Passaggio finale di un calcolo completo, in una sola transazione breve:
+        riscrive i cicli validi cambiati, rende validi i cicli nuovi (già scritti
+        non validi con salva_batch) e invalida quelli non più trovati. Chi legge
+        vede il vecchio insieme di cicli fino al commit e poi il nuovo, mai una
+        tabella vuota né un misto dei due.
+
+        Args:
+            nuovi: hash_ciclo dei cicli nuovi scritti come non validi
+            spariti: hash_ciclo dei cicli validi non più trovati
+            cambiati: dict del CycleFinder dei cicli validi con contenuto cambiato
+                      (stesso hash, quindi stessa riga: vengono riscritti qui)
+
+        Returns:
+            tuple: (attivati, invalidati)
+        """
+        from django.db import transaction
+
+        attivati = invalidati = 0
+        nuovi = list(nuovi)
+        spariti = list(spariti)
+        cambiati = list(cambiati)
+
+        with transaction.atomic():
+            for inizio in range(0, len(cambiati), batch_size):
+                cls.salva_batch(cambiati[inizio:inizio + batch_size])
+
+            for inizio in range(0, len(nuovi), batch_size):
+                attivati += cls.objects.filter(
+                    valido=False,
+                    hash_ciclo__in=nuovi[inizio:inizio + batch_size]
+                ).update(valido=True)
+
+            for inizio in range(0, len(spariti), batch_size):
+                invalidati += cls.objects.filter(
+                    valido=True,
+                    hash_ciclo__in=spariti[inizio:inizio + batch_size]
+                ).update(valido=False)
+
+        return attivati, invalidati
+
+    @classmethod
+    def invalida_per_annuncio(cls, annuncio_id):
+        """
+        Invalida i cicli validi che mostrano l'annuncio (disattivato o in cancellazione)
+        con un solo UPDATE sull'indice di CicloAnnuncio
+        """
+        return cls.objects.filter(
+            valido=True,
+            id__in=CicloAnnuncio.objects.filter(annuncio_id=annuncio_id).values('ciclo_id')
+        ).update(valido=False)
+
+    @classmethod
+    def rivalida_per_annuncio(cls, annuncio_id):
+        """
+        Riattiva i cicli non validi che mostrano l'annuncio (appena riattivato),
+        con gli stessi controlli di validate_all_cycles: tutti gli annunci mostrati
+        attivi e nessuno cancellato (2 × lunghezza righe CicloAnnuncio).
+        Da usare solo se nessun calcolo è stato fatto dalla disattivazione:
+        altrimenti i cicli li ritrova il prossimo calcolo.
+        """
+        from django.db.models import Count, F
+
+        candidati_ids = list(
+            cls.objects.filter(valido=False, annunci_collegati__annuncio_id=annuncio_id).values_list('id', flat=True)
+        )
+        if not candidati_ids:
+            return 0
+
+        con_annunci_inattivi = CicloAnnuncio.objects.filter(
+            ciclo_id__in=candidati_ids,
+            annuncio__attivo=False
+        ).values('ciclo_id')
+        completi = cls.objects.filter(id__in=candidati_ids).annotate(
+            num_annunci=Count('annunci_collegati')
+        ).filter(num_annunci__gte=2 * F('lunghezza')).values('id')
+        return cls.objects.filter(
+            id__in=completi
+        ).exclude(id__in=con_annunci_inattivi).update(valido=True)
 
     @classmethod
     def invalidate_all(cls):
@@ -1232,17 +1553,10 @@ class CicloScambio(models.Model):
         Valida che tutti gli annunci nel ciclo esistano ancora e siano attivi
         Returns: (bool, list) - (is_valid, missing_annunci_ids)
         """
-        # Estrae gli ID degli annunci dai dettagli
-        annunci_ids = set()
-        if 'utenti' in self.dettagli:
-            for utente_data in self.dettagli['utenti']:
-                if 'richiede' in utente_data and utente_data['richiede']:
-                    annunci_ids.add(utente_data['richiede'].get('id'))
-                if 'offerta' in utente_data and utente_data['offerta']:
-                    annunci_ids.add(utente_data['offerta'].get('id'))
+        from .dettagli_ciclo import annunci_mostrati
 
-        # Rimuovi None se presente
-        annunci_ids.discard(None)
+        # Estrae gli ID degli annunci mostrati dai dettagli (v1 o compatti)
+        annunci_ids = annunci_mostrati(self.dettagli)
 
         if not annunci_ids:
             # Nessun annuncio trovato nei dettagli, ciclo invalido
@@ -1263,25 +1577,47 @@ class CicloScambio(models.Model):
     @classmethod
     def validate_all_cycles(cls):
         """
-        Valida tutti i cicli marcati come validi e invalida quelli con annunci mancanti
+        Valida tutti i cicli marcati come validi e invalida quelli con annunci mancanti,
+        con query sull'indice CicloAnnuncio invece di leggere i dettagli dei cicli
+        (memoria indipendente dal numero di annunci e di cicli):
+        - annunci non attivi: join CicloAnnuncio → Annuncio
+        - annunci cancellati: le loro righe CicloAnnuncio spariscono in cascata, quindi
+          il ciclo ha meno righe degli annunci mostrati (offerto e richiesto per ogni
+          passaggio, 2 × lunghezza) o nessuna
+        - un solo UPDATE per tutti i cicli da invalidare
         Returns: dict con statistiche della validazione
         """
+        from collections import defaultdict
+        from django.db.models import Count, F
+
         cicli_validi = cls.objects.filter(valido=True)
         total_checked = cicli_validi.count()
-        invalidated = 0
-        missing_annunci_log = []
-
-        for ciclo in cicli_validi:
-            is_valid, missing_ids = ciclo.validate_annunci()
-            if not is_valid:
-                ciclo.valido = False
-                ciclo.save(update_fields=['valido'])
-                invalidated += 1
-                missing_annunci_log.append({
-                    'ciclo_id': ciclo.id,
-                    'hash': ciclo.hash_ciclo,
-                    'missing_annunci': missing_ids
-                })
+
+        collegati_non_attivi = CicloAnnuncio.objects.filter(ciclo__valido=True, annuncio__attivo=False)
+        incompleti = cicli_validi.annotate(
+            num_annunci=Count('annunci_collegati')
+        ).filter(num_annunci__lt=2 * F('lunghezza')).values('id')
+        da_invalidare = cicli_validi.filter(
+            Q(id__in=collegati_non_attivi.values('ciclo_id')) | Q(id__in=incompleti)
+        )
+
+        # Dettagli per il log: gli annunci non attivi di ogni ciclo (i cancellati non sono più noti)
+        non_attivi_per_ciclo = defaultdict(list)
+        for ciclo_id, annuncio_id in collegati_non_attivi.order_by('ciclo_id', 'annuncio_id').values_list('ciclo_id', 'annuncio_id'):
+            non_attivi_per_ciclo[ciclo_id].append(annuncio_id)
+        missing_annunci_log = [
+            {
+                'ciclo_id': ciclo_id,
+                'hash': hash_ciclo,
+                'missing_annunci': non_attivi_per_ciclo.get(ciclo_id, [])
+            }
+            for ciclo_id, hash_ciclo in da_invalidare.order_by('id').values_list('id', 'hash_ciclo')
+        ]
+
+        invalidated = cls.objects.filter(
+            valido=True,
+            id__in=da_invalidare.values('id')
+        ).update(valido=False)
 
         return {
             'total_checked': total_checked,
@@ -1291,6 +1627,136 @@ class CicloScambio(models.Model):
         }
 
 
+class CicloUtente(models.Model):
+    """
+    Appartenenza di un utente a un CicloScambio: una riga per ogni utente del ciclo.
+
+    Mantenuta dal calcolo cicli (CicloScambio.salva_batch) insieme ai cicli; la
+    cancellazione avviene in cascata. Sostituisce i filtri sul JSON users
+    (users__contains / users__icontains) con query indicizzate:
+    - cicli di un utente, migliori prima, a pagine (CicloScambio.find_for_user)
+    - invalidazione dei cicli di un insieme di utenti con un solo UPDATE
+      (CycleFinder.invalida_cicli_con_utenti)
+    La validità NON è memorizzata qui: resta su CicloScambio e viene filtrata al momento della query.
+    """
+    ciclo = models.ForeignKey(
+        CicloScambio,
+        on_delete=models.CASCADE,
+        related_name='membri'
+    )
+    utente = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cicli_scambio'
+    )
+    posizione = models.PositiveSmallIntegerField(
+        help_text="Posizione dell'utente nel ciclo (0 = primo di users)"
+    )
+    rank_score = models.IntegerField(
+        default=0,
+        help_text="Punteggio per ordinare i cicli dell'utente (più alto = migliore, vedi calcola_rank_score)"
+    )
+
+    class Meta:
+        verbose_name = "Utente del Ciclo"
+        verbose_name_plural = "Utenti dei Cicli"
+        unique_together = ['ciclo', 'utente']
+        indexes = [
+            models.Index(fields=['utente', '-rank_score', 'ciclo']),
+        ]
+
+    def __str__(self):
+        return f"User({self.utente_id}) nel ciclo {self.ciclo_id} (posizione {self.posizione})"
+
+    @staticmethod
+    def calcola_rank_score(lunghezza, punteggio_qualita, categoria_qualita):
+        """
+        Ordine delle liste di catene in un solo intero: prima la qualità alta,
+        poi i cicli più corti, poi il punteggio di qualità (0-100)
+        """
+        return (
+            (100000 if categoria_qualita == 'alta' else 0)
+            + (100 - lunghezza) * 1000
+            + (punteggio_qualita or 0)
+        )
+
+    @classmethod
+    def sostituisci_per_cicli(cls, cicli):
+        """
+        Riscrive le righe dei cicli indicati (istanze di CicloScambio già salvate)
+        con un DELETE e un INSERT in blocco
+        """
+        cicli = [ciclo for ciclo in cicli if ciclo.id is not None]
+        if not cicli:
+            return 0
+
+        cls.objects.filter(ciclo_id__in=[ciclo.id for ciclo in cicli]).delete()
+        righe = [
+            cls(
+                ciclo_id=ciclo.id,
+                utente_id=user_id,
+                posizione=posizione,
+                rank_score=cls.calcola_rank_score(ciclo.lunghezza, ciclo.punteggio_qualita, ciclo.categoria_qualita),
+            )
+            for ciclo in cicli
+            for posizione, user_id in enumerate(ciclo.users)
+        ]
+        cls.objects.bulk_create(righe)
+        return len(righe)
+
+
+class CicloAnnuncio(models.Model):
+    """
+    Annuncio mostrato in un CicloScambio (l'ultimo oggetto di ogni passaggio,
+    vedi dettagli_ciclo.annunci_mostrati): indice inverso annuncio → cicli.
+
+    Mantenuta dal calcolo cicli (CicloScambio.salva_batch) come CicloUtente.
+    Permette di:
+    - invalidare subito i cicli di un annuncio disattivato o eliminato
+      (signals di Annuncio, CicloScambio.invalida_per_annuncio)
+    - trovare le catene di un annuncio con un join (get_cicli_precalcolati(annuncio_id=...))
+    """
+    ciclo = models.ForeignKey(
+        CicloScambio,
+        on_delete=models.CASCADE,
+        related_name='annunci_collegati'
+    )
+    annuncio = models.ForeignKey(
+        Annuncio,
+        on_delete=models.CASCADE,
+        related_name='cicli_collegati'
+    )
+
+    class Meta:
+        verbose_name = "Annuncio del Ciclo"
+        verbose_name_plural = "Annunci dei Cicli"
+        unique_together = ['ciclo', 'annuncio']
+
+    def __str__(self):
+        return f"Annuncio {self.annuncio_id} nel ciclo {self.ciclo_id}"
+
+    @classmethod
+    def sostituisci_per_cicli(cls, cicli):
+        """
+        Riscrive le righe dei cicli indicati (istanze di CicloScambio già salvate)
+        con un DELETE e un INSERT in blocco
+        """
+        from .dettagli_ciclo import annunci_mostrati
+
+        cicli = [ciclo for ciclo in cicli if ciclo.id is not None]
+        if not cicli:
+            return 0
+
+        cls.objects.filter(ciclo_id__in=[ciclo.id for ciclo in cicli]).delete()
+        righe = [
+            cls(ciclo_id=ciclo.id, annuncio_id=annuncio_id)
+            for ciclo in cicli
+            for annuncio_id in sorted(annunci_mostrati(ciclo.dettagli))
+        ]
+        cls.objects.bulk_create(righe)
+        return len(righe)
+
+
 # === SISTEMA PROPOSTE CATENE MVP ===
 
 class PropostaCatena(models.Model):
@@ -1457,6 +1923,14 @@ class CalcoloMetadata(models.Model):
     cicli_calcolati = models.IntegerField(default=0)
     durata_calcolo_secondi = models.FloatField(default=0.0)
 
+    # Archi del grafo utenti all'ultimo calcolo [[user_da, user_a], ...]
+    # Il calcolo incrementale confronta il grafo attuale con questo per trovare le differenze
+    archi_grafo = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="Archi del grafo utenti usati nell'ultimo calcolo"
+    )
+
     class Meta:
         verbose_name = "Metadata Calcolo"
         verbose_name_plural = "Metadata Calcoli"
@@ -1474,11 +1948,110 @@ class CalcoloMetadata(models.Model):
         return obj
 
     @classmethod
-    def aggiorna_calcolo(cls, cicli_count, durata):
-        """Aggiorna i metadati dopo un calcolo"""
+    def aggiorna_calcolo(cls, cicli_count, durata, archi=None):
+        """Aggiorna i metadati dopo un calcolo (archi: snapshot del grafo, se disponibile)"""
         obj = cls.get_or_create_singleton()
         obj.ultimo_calcolo_completo = timezone.now()
         obj.cicli_calcolati = cicli_count
         obj.durata_calcolo_secondi = durata
+        if archi is not None:
+            obj.archi_grafo = [list(arco) for arco in sorted(archi)]
         obj.save()
         return obj
+
+    def get_archi_grafo(self):
+        """Snapshot degli archi come set di tuple, o None se mai salvato"""
+        if self.archi_grafo is None:
+            return None
+        return {tuple(arco) for arco in self.archi_grafo}
+
+
+class UtenteModificato(models.Model):
+    """
+    Utente i cui archi del grafo possono essere cambiati senza che cambi il
+    last_modified di un suo annuncio (annuncio eliminato, cambio di provincia).
+
+    Registrato dai signals; il calcolo incrementale aggiorna lo snapshot del
+    grafo anche attorno a questi utenti (vedi CycleFinder.get_utenti_modificati).
+    Una riga per utente con la data dell'ultima modifica. utente_id non è una
+    chiave esterna: la riga resta anche se l'utente viene eliminato, così i suoi
+    archi vengono tolti dallo snapshot.
+    """
+    utente_id = models.IntegerField(unique=True)
+    modificato_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = "Utente Modificato"
+        verbose_name_plural = "Utenti Modificati"
+
+    def __str__(self):
+        return f"User({self.utente_id}) modificato il {self.modificato_at}"
+
+    @classmethod
+    def registra(cls, utente_id):
+        """Segna l'utente come modificato adesso"""
+        cls.objects.update_or_create(utente_id=utente_id, defaults={'modificato_at': timezone.now()})
+
+    @classmethod
+    def modificati_dal(cls, timestamp):
+        """Id degli utenti registrati dopo il timestamp indicato"""
+        return set(cls.objects.filter(modificato_at__gt=timestamp).values_list('utente_id', flat=True))
+
+
+class CompatibilitaAnnunci(models.Model):
+    """
+    Coppia compatibile offerta → richiesta (arco a livello di annuncio).
+
+    Mantenuta in modo incrementale dai signals di Annuncio: quando un annuncio
+    viene creato o cambiano i campi usati dal matching si ricalcolano solo le
+    sue righe; la cancellazione avviene in cascata. Quando un utente cambia
+    provincia i signals di UserProfile ricalcolano distanza_km delle sue righe.
+    Lo stato attivo/disattivato NON è memorizzato qui: viene filtrato al momento della query.
+    Il grafo degli utenti si ottiene con una sola query aggregata
+    (vedi CycleFinder.costruisci_grafo_da_compatibilita).
+    """
+    TIPI_MATCH = [
+        ('specifico', 'Specifico'),
+        ('parziale', 'Parziale'),
+        ('sinonimo', 'Sinonimo'),
+        ('categoria', 'Categoria'),
+    ]
+
+    # Campi di Annuncio che influenzano il matching: se cambiano, le righe vanno ricalcolate
+    CAMPI_MATCHING = [
+        'titolo', 'tipo', 'categoria_id', 'cerca_per_categoria', 'utente_id',
+        'prezzo_stimato', 'metodo_scambio', 'distanza_massima_km',
+    ]
+
+    offerta = models.ForeignKey(
+        Annuncio,
+        on_delete=models.CASCADE,
+        related_name='compatibilita_come_offerta'
+    )
+    richiesta = models.ForeignKey(
+        Annuncio,
+        on_delete=models.CASCADE,
+        related_name='compatibilita_come_richiesta'
+    )
+    tipo_match = models.CharField(max_length=20, choices=TIPI_MATCH)
+    punteggio = models.IntegerField(
+        default=0,
+        help_text="Punteggio qualità (calcola_punteggio_qualita_avanzato, 0-100)"
+    )
+    distanza_km = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text="Distanza tra le province dei due utenti al momento del calcolo"
+    )
+    calcolato_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Compatibilità Annunci"
+        verbose_name_plural = "Compatibilità Annunci"
+        unique_together = ['offerta', 'richiesta']
+        indexes = [
+            models.Index(fields=['richiesta']),
+        ]
+
+    def __str__(self):
+        return f"{self.offerta_id} → {self.richiesta_id} ({self.tipo_match})"
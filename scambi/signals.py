@@ -1,11 +1,11 @@
 """
 Signals per il sistema di notifiche Polygonum
 """
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
-from .models import UserProfile, Annuncio
+from .models import UserProfile, Annuncio, CompatibilitaAnnunci, Provincia, CicloScambio, CalcoloMetadata, UtenteModificato
 from .notifications import notifica_benvenuto
 
 
@@ -29,6 +29,8 @@ def track_disattivazione_annuncio(sender, instance, **kwargs):
     Signal per tracciare quando un annuncio viene disattivato/riattivato.
     Questo permette di includere annunci recentemente disattivati (<3 min)
     nel calcolo delle catene di scambio.
+    I cicli pre-calcolati che mostrano l'annuncio vengono aggiornati dopo il
+    salvataggio (vedi aggiorna_cicli_annuncio_salvato).
     """
     if instance.pk:  # Solo se l'annuncio esiste già (non è nuovo)
         try:
@@ -38,14 +40,140 @@ def track_disattivazione_annuncio(sender, instance, **kwargs):
             if old.attivo and not instance.attivo:
                 # È stato disattivato ora
                 instance.disattivato_at = timezone.now()
+                instance._cicli_da_invalidare = True
                 print(f"📴 Annuncio '{instance.titolo}' (ID:{instance.id}) disattivato alle {instance.disattivato_at}")
 
             # Se sta cambiando da inattivo ad attivo
             elif not old.attivo and instance.attivo:
                 # È stato riattivato, reset del timestamp
+                instance._riattivato = True
+                instance._disattivato_at_precedente = old.disattivato_at
                 instance.disattivato_at = None
                 print(f"✅ Annuncio '{instance.titolo}' (ID:{instance.id}) riattivato")
 
+            # Se cambiano i campi usati dal matching, le compatibilità vanno ricalcolate (post_save)
+            instance._matching_modificato = any(
+                getattr(old, campo) != getattr(instance, campo)
+                for campo in CompatibilitaAnnunci.CAMPI_MATCHING
+            )
+
         except Annuncio.DoesNotExist:
             # Caso edge: l'annuncio è stato cancellato nel frattempo
-            pass
\ No newline at end of file
+            pass
+
+
+@receiver(post_save, sender=Annuncio)
+def aggiorna_compatibilita_annuncio_salvato(sender, instance, created, raw=False, **kwargs):
+    """
+    Signal che mantiene la tabella CompatibilitaAnnunci: ricalcola solo le righe
+    dell'annuncio appena creato o con campi di matching modificati.
+    Attivazione/disattivazione non richiedono ricalcolo (filtrate in query),
+    la cancellazione rimuove le righe in cascata.
+    """
+    if raw:
+        return  # loaddata / fixtures
+
+    if not (created or getattr(instance, '_matching_modificato', False)):
+        return
+    instance._matching_modificato = False
+
+    try:
+        from .matching import aggiorna_compatibilita_annuncio
+        coppie = aggiorna_compatibilita_annuncio(instance)
+        print(f"🔗 Annuncio '{instance.titolo}' (ID:{instance.id}): {coppie} compatibilità aggiornate")
+    except Exception as e:
+        print(f"❌ Errore aggiornamento compatibilità annuncio {instance.id}: {e}")
+
+
+@receiver(post_save, sender=Annuncio)
+def aggiorna_cicli_annuncio_salvato(sender, instance, created, raw=False, **kwargs):
+    """
+    Signal che allinea i cicli pre-calcolati allo stato dell'annuncio
+    (un solo UPDATE sull'indice CicloAnnuncio):
+    - disattivato: invalida subito i cicli che lo mostrano
+    - riattivato senza calcoli cicli dalla disattivazione: riattiva quei cicli
+      (altrimenti li ritrova il prossimo calcolo)
+    """
+    if raw or created:
+        return
+
+    try:
+        if getattr(instance, '_cicli_da_invalidare', False):
+            instance._cicli_da_invalidare = False
+            invalidati = CicloScambio.invalida_per_annuncio(instance.id)
+            print(f"❌ Annuncio '{instance.titolo}' (ID:{instance.id}) disattivato: {invalidati} cicli invalidati")
+
+        if getattr(instance, '_riattivato', False):
+            instance._riattivato = False
+            disattivato_at = getattr(instance, '_disattivato_at_precedente', None)
+            metadata = CalcoloMetadata.objects.filter(singleton_id=1).first()
+            ultimo_calcolo = metadata.ultimo_calcolo_completo if metadata else None
+            # Momento della disattivazione o del calcolo non noti: i cicli vengono
+            # comunque riattivati solo se tutti i loro annunci sono attivi
+            if ultimo_calcolo is None or disattivato_at is None or ultimo_calcolo < disattivato_at:
+                rivalidati = CicloScambio.rivalida_per_annuncio(instance.id)
+                print(f"✅ Annuncio '{instance.titolo}' (ID:{instance.id}) riattivato: {rivalidati} cicli di nuovo validi")
+    except Exception as e:
+        print(f"❌ Errore aggiornamento cicli annuncio {instance.id}: {e}")
+
+
+@receiver(pre_delete, sender=Annuncio)
+def invalida_cicli_annuncio_eliminato(sender, instance, **kwargs):
+    """
+    Signal che invalida i cicli che mostrano l'annuncio prima della cancellazione
+    (che rimuove in cascata le sue righe CicloAnnuncio) e segna il proprietario
+    come modificato: la cancellazione non cambia nessun last_modified, ma gli
+    archi del proprietario nello snapshot del grafo vanno ricalcolati.
+    """
+    try:
+        UtenteModificato.registra(instance.utente_id)
+        invalidati = CicloScambio.invalida_per_annuncio(instance.id)
+        print(f"🗑️ Annuncio '{instance.titolo}' (ID:{instance.id}) eliminato: {invalidati} cicli invalidati")
+    except Exception as e:
+        print(f"❌ Errore invalidazione cicli annuncio {instance.id}: {e}")
+
+
+@receiver(pre_save, sender=UserProfile)
+def track_cambio_provincia(sender, instance, **kwargs):
+    """
+    Signal per tracciare il cambio di provincia di un profilo: le distanze
+    memorizzate in CompatibilitaAnnunci vanno ricalcolate (post_save).
+    """
+    if instance.pk:
+        provincia_precedente = UserProfile.objects.filter(pk=instance.pk).values_list('provincia_obj_id', flat=True).first()
+        instance._provincia_cambiata = (
+            provincia_precedente is not None and provincia_precedente != instance.provincia_obj_id
+        )
+
+
+@receiver(post_save, sender=UserProfile)
+def aggiorna_distanze_profilo_salvato(sender, instance, created, raw=False, **kwargs):
+    """
+    Signal che riallinea distanza_km (e punteggio) delle righe CompatibilitaAnnunci
+    dell'utente quando cambia la sua provincia, e lo segna come modificato per
+    il calcolo incrementale (i suoi archi dipendono dalla distanza)
+    """
+    if raw or created or not getattr(instance, '_provincia_cambiata', False):
+        return
+    instance._provincia_cambiata = False
+
+    try:
+        UtenteModificato.registra(instance.user_id)
+        from .matching import aggiorna_distanze_utente
+        righe = aggiorna_distanze_utente(instance.user_id)
+        print(f"🗺️ Provincia dell'utente {instance.user_id} cambiata: {righe} distanze di compatibilità aggiornate")
+    except Exception as e:
+        print(f"❌ Errore aggiornamento distanze utente {instance.user_id}: {e}")
+
+
+@receiver(post_save, sender=Provincia)
+@receiver(post_delete, sender=Provincia)
+def invalida_matrice_distanze_province(sender, **kwargs):
+    """
+    Le coordinate delle province sono cambiate: la matrice delle distanze
+    verrà ricostruita al prossimo utilizzo, in questo processo subito e negli
+    altri al prossimo controllo della versione (vedi geo_distance).
+    """
+    from .geo_distance import segnala_modifica_province
+
+    segnala_modifica_province()
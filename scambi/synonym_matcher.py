@@ -1,45 +1,58 @@
 """
 Modulo per gestire sinonimi italiani con WordNet e caching intelligente
 Ottimizzato per performance massime nel cycle calculator
+
+Se esiste la tabella precompilata (python manage.py compila_sinonimi) i sinonimi
+vengono letti da lì: ogni token è associato agli id delle sue classi di sinonimi
+e il match diventa un'intersezione di insiemi di interi, senza caricare WordNet.
 """
+import json
+import os
 from functools import lru_cache
-import nltk
 from datetime import datetime
 
+from .aho_corasick import AhoCorasick
+
 # Flag per indicare se WordNet è stato inizializzato
 _WORDNET_INITIALIZED = False
 _WORDNET_AVAILABLE = False
 
-# Lista di termini composti comuni da preservare durante l'analisi
+# Tabella sinonimi precompilata (vedi compila_tabella_sinonimi)
+PERCORSO_TABELLA_SINONIMI = os.path.join(os.path.dirname(__file__), 'data', 'sinonimi_ita.json')
+_TABELLA_CARICATA = False
+_LEMMI = []           # id classe -> lemma
+_ID_LEMMI = {}        # lemma -> id classe
+_CLASSI_TOKEN = {}    # token -> frozenset di id classe (espansione significativa)
+
+# Dizionario dei termini composti da preservare durante l'analisi (un termine per riga).
 # Questi termini vengono cercati PRIMA di splittare in singole parole
-COMPOUND_TERMS = {
-    # Elettronica e tecnologia
-    'macchina fotografica', 'fotocamera digitale', 'telefono cellulare', 'hard disk',
-    'scheda madre', 'scheda video', 'carta di credito', 'chiavetta usb',
-    'mouse wireless', 'tastiera meccanica', 'cuffie bluetooth', 'smart tv',
-    'power bank', 'action cam', 'dash cam', 'ring light',
+PERCORSO_TERMINI_COMPOSTI = os.path.join(os.path.dirname(__file__), 'data', 'termini_composti.txt')
 
-    # Casa e mobili
-    'divano letto', 'tavolo da pranzo', 'sedia da ufficio', 'lampada da terra',
-    'mobile tv', 'armadio guardaroba', 'specchio da parete', 'tappeto persiano',
 
-    # Sport e tempo libero
-    'racchetta da tennis', 'mountain bike', 'bici da corsa', 'tavola da surf',
-    'sci da discesa', 'pattini a rotelle', 'borsa da palestra', 'scarpe da ginnastica',
-    'pallone da calcio', 'tuta da sci',
+def carica_termini_composti(percorso=None):
+    """
+    Legge il dizionario dei termini composti (righe vuote e commenti # ignorati)
 
-    # Musica
-    'chitarra elettrica', 'chitarra acustica', 'tastiera elettronica', 'cassa bluetooth',
+    Returns:
+        set: termini in minuscolo (vuoto se il file non esiste)
+    """
+    percorso = percorso or PERCORSO_TERMINI_COMPOSTI
+    termini = set()
+    try:
+        with open(percorso, encoding='utf-8') as f:
+            for riga in f:
+                riga = ' '.join(riga.split('#', 1)[0].lower().split())
+                if riga:
+                    termini.add(riga)
+    except OSError as e:
+        print(f"[{datetime.now()}] ⚠️ Dizionario termini composti non disponibile ({e})")
+    return termini
 
-    # Libri e giochi
-    'gioco da tavolo', 'libro di testo', 'fumetto manga', 'console portatile',
 
-    # Vari
-    'macchina da caffè', 'ferro da stiro', 'asciuga capelli', 'macchina per cucire',
-}
+COMPOUND_TERMS = carica_termini_composti()
 
-# Normalizza i termini composti (tutto minuscolo)
-COMPOUND_TERMS = {term.lower() for term in COMPOUND_TERMS}
+# Automa costruito una volta: ogni titolo viene scansionato in un solo passaggio
+_AUTOMA_TERMINI_COMPOSTI = AhoCorasick(COMPOUND_TERMS)
 
 
 def initialize_wordnet():
@@ -56,6 +69,7 @@ def initialize_wordnet():
 
     try:
         # Prova a importare wordnet
+        import nltk
         from nltk.corpus import wordnet as wn
 
         # Controlla se i dati sono già scaricati testando una query
@@ -83,9 +97,120 @@ def initialize_wordnet():
     return _WORDNET_AVAILABLE
 
 
+def carica_tabella_sinonimi(percorso=None):
+    """
+    Carica (una volta per processo) la tabella token → classi di sinonimi
+
+    Returns:
+        bool: True se la tabella è disponibile
+    """
+    global _TABELLA_CARICATA, _LEMMI, _ID_LEMMI, _CLASSI_TOKEN
+
+    percorso = percorso or PERCORSO_TABELLA_SINONIMI
+    try:
+        with open(percorso, encoding='utf-8') as f:
+            tabella = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print(f"[{datetime.now()}] ⚠️ Tabella sinonimi non leggibile ({percorso}): {e}")
+        return False
+
+    _LEMMI = list(tabella['lemmi'])
+    _ID_LEMMI = {lemma: i for i, lemma in enumerate(_LEMMI)}
+    _CLASSI_TOKEN = {token: frozenset(ids) for token, ids in tabella['token'].items()}
+    _TABELLA_CARICATA = True
+
+    print(f"[{datetime.now()}] ✅ Tabella sinonimi caricata: {len(_CLASSI_TOKEN)} token, {len(_LEMMI)} classi")
+    return True
+
+
+def compila_tabella_sinonimi(token):
+    """
+    Compila la tabella sinonimi per i token indicati usando get_synonyms (WordNet).
+    Vengono salvati solo i token la cui espansione significativa non è banale
+    (diversa dal token stesso): per tutti gli altri il risultato a runtime è identico.
+
+    Args:
+        token (iterable): token/lemmi da includere
+
+    Returns:
+        dict: tabella serializzabile in JSON ('lemmi', 'token')
+    """
+    espansioni = {}
+    for parola in sorted(set(token)):
+        if len(parola) <= 2:
+            continue
+        espansione = {p for p in get_synonyms(parola) if _significativo(p)}
+        banale = {parola} if _significativo(parola) else set()
+        if espansione != banale:
+            espansioni[parola] = espansione
+
+    lemmi = sorted(set().union(*espansioni.values())) if espansioni else []
+    id_lemmi = {lemma: i for i, lemma in enumerate(lemmi)}
+
+    return {
+        'versione': 1,
+        'generato_at': datetime.now().isoformat(),
+        'lemmi': lemmi,
+        'token': {
+            parola: sorted(id_lemmi[p] for p in espansione)
+            for parola, espansione in espansioni.items()
+        },
+    }
+
+
+def tabella_sinonimi_caricata():
+    return _TABELLA_CARICATA
+
+
+def sinonimi_disponibili():
+    """True se il matching per sinonimi è attivo (tabella precompilata o WordNet)"""
+    return _TABELLA_CARICATA or initialize_wordnet()
+
+
+def _significativo(termine):
+    """Solo i termini >3 caratteri o numerici contano per il match sinonimi"""
+    return len(termine) > 3 or termine.isdigit()
+
+
+def _id_lemma(lemma):
+    """Id classe di un lemma; i lemmi fuori tabella ricevono un id nuovo (per processo)"""
+    id_classe = _ID_LEMMI.get(lemma)
+    if id_classe is None:
+        id_classe = _ID_LEMMI[lemma] = len(_LEMMI)
+        _LEMMI.append(lemma)
+    return id_classe
+
+
+def espandi_classi_sinonimi(parole):
+    """
+    Come espandi_sinonimi_significativi, ma con gli id delle classi della tabella
+    precompilata: due insiemi di parole sono sinonimi se gli insiemi si intersecano.
+
+    Returns:
+        set: id delle classi (vuoto se la tabella non è caricata)
+    """
+    if not _TABELLA_CARICATA:
+        return set()
+
+    classi = set()
+    for parola in parole:
+        if len(parola) > 2:
+            ids = _CLASSI_TOKEN.get(parola)
+            if ids is not None:
+                classi.update(ids)
+                continue
+        if _significativo(parola):
+            classi.add(_id_lemma(parola))
+
+    return classi
+
+
 def extract_compound_terms(text):
     """
-    Estrae termini composti da un testo prima di splittarlo in singole parole
+    Estrae termini composti da un testo prima di splittarlo in singole parole.
+    Un termine viene riconosciuto solo a parola intera ("smart tv" non in "smart tvbox").
 
     Args:
         text (str): Testo da analizzare
@@ -93,15 +218,8 @@ def extract_compound_terms(text):
     Returns:
         set: Insieme di termini composti trovati nel testo
     """
-    text_lower = text.lower()
-    found_compounds = set()
-
-    # Cerca ogni termine composto nel testo
-    for compound in COMPOUND_TERMS:
-        if compound in text_lower:
-            found_compounds.add(compound)
-
-    return found_compounds
+    # Un solo passaggio sul testo con l'automa, a parola intera
+    return _AUTOMA_TERMINI_COMPOSTI.cerca(text)
 
 
 @lru_cache(maxsize=10000)
@@ -153,41 +271,55 @@ def check_synonym_match(parole_offerto, parole_cercato):
     Returns:
         tuple: (bool, str) - (compatibile, 'sinonimo' o None)
     """
+    # Tabella precompilata: intersezione di insiemi di interi
+    if _TABELLA_CARICATA:
+        if espandi_classi_sinonimi(parole_offerto) & espandi_classi_sinonimi(parole_cercato):
+            return True, 'sinonimo'
+        return False, None
+
     # Se WordNet non è disponibile, salta il check
     if not _WORDNET_AVAILABLE:
         return False, None
 
-    # Espandi le parole cercate con sinonimi
-    parole_cercato_espanse = set()
-    for parola in parole_cercato:
-        # Solo parole significative (>2 caratteri) vengono espanse
-        if len(parola) > 2:
-            sinonimi = get_synonyms(parola)
-            parole_cercato_espanse.update(sinonimi)
-        else:
-            parole_cercato_espanse.add(parola)
-
-    # Espandi anche le parole offerte per match bidirezionale
-    parole_offerto_espanse = set()
-    for parola in parole_offerto:
-        if len(parola) > 2:
-            sinonimi = get_synonyms(parola)
-            parole_offerto_espanse.update(sinonimi)
-        else:
-            parole_offerto_espanse.add(parola)
-
-    # Trova match tra sinonimi
-    match_trovati = parole_offerto_espanse & parole_cercato_espanse
+    # Espandi le parole cercate e quelle offerte (match bidirezionale)
+    # Un match conta solo su parole significative (>3 caratteri) o numeri
+    match_trovati = espandi_sinonimi_significativi(parole_offerto) & espandi_sinonimi_significativi(parole_cercato)
 
     if match_trovati:
-        # Verifica se ci sono parole significative (>3 caratteri) o numeri
-        parole_significative = [p for p in match_trovati if len(p) > 3 or p.isdigit()]
-        if parole_significative:
-            return True, 'sinonimo'
+        return True, 'sinonimo'
 
     return False, None
 
 
+def espandi_sinonimi_significativi(parole):
+    """
+    Espande un insieme di parole con i loro sinonimi e tiene solo i termini
+    significativi (>3 caratteri o numeri), gli unici che contano per il match.
+    Due insiemi di parole sono sinonimi se le loro espansioni si intersecano.
+
+    Args:
+        parole (set): Parole chiave di un annuncio
+
+    Returns:
+        set: Termini espansi significativi (vuoto se WordNet non è disponibile)
+    """
+    if _TABELLA_CARICATA:
+        return {_LEMMI[i] for i in espandi_classi_sinonimi(parole)}
+
+    if not _WORDNET_AVAILABLE:
+        return set()
+
+    espanse = set()
+    for parola in parole:
+        # Solo parole significative (>2 caratteri) vengono espanse
+        if len(parola) > 2:
+            espanse.update(get_synonyms(parola))
+        else:
+            espanse.add(parola)
+
+    return {p for p in espanse if _significativo(p)}
+
+
 def get_cache_stats():
     """
     Ottiene statistiche sulla cache dei sinonimi
@@ -198,7 +330,9 @@ def get_cache_stats():
     """
     return {
         'get_synonyms_cache_info': get_synonyms.cache_info()._asdict(),
-        'wordnet_available': _WORDNET_AVAILABLE
+        'wordnet_available': _WORDNET_AVAILABLE,
+        'tabella_sinonimi': _TABELLA_CARICATA,
+        'token_in_tabella': len(_CLASSI_TOKEN),
     }
 
 
@@ -211,6 +345,7 @@ def clear_cache():
     print(f"[{datetime.now()}] 🧹 Cache sinonimi svuotata")
 
 
-# Inizializza WordNet al primo import del modulo
-# Questo rende il primo lookup più veloce
-initialize_wordnet()
+# Al primo import: usa la tabella precompilata se presente,
+# altrimenti inizializza WordNet (rende il primo lookup più veloce)
+if not carica_tabella_sinonimi():
+    initialize_wordnet()
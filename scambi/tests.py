@@ -1,3 +1,844 @@
-from django.test import TestCase
+import random
+import types
+from importlib import import_module
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from .compatibility_kernel import CompatibilityKernel
+from .cycle_engine import (
+    archi_del_ciclo,
+    archi_del_grafo,
+    cicli_con_arco,
+    cicli_migliori,
+    cicli_multigrafo,
+    cicli_per_utente,
+    ciclo_usa_archi,
+    costo_arco,
+    enumera_cicli,
+    grafo_inverso,
+)
+from .dettagli_ciclo import comprimi_dettagli, is_compatti
+from .geo_distance import invalida_matrice_distanze
+from .keyword_index import KeywordIndex
+from .matching import (
+    CycleFinder,
+    coppia_ammissibile,
+    distanza_tra_annunci,
+    get_cicli_precalcolati,
+    oggetti_compatibili_con_tipo,
+    ricostruisci_compatibilita,
+)
+from .models import (
+    Annuncio,
+    CalcoloMetadata,
+    Categoria,
+    CicloAnnuncio,
+    CicloScambio,
+    CicloUtente,
+    CompatibilitaAnnunci,
+    Provincia,
+    UserProfile,
+)
+
+
+def grafo_casuale(nodi, archi_per_nodo, seed):
+    """Grafo {user_id: [user_id]} deterministico, senza archi verso sé stessi"""
+    rnd = random.Random(seed)
+    utenti = list(range(1, nodi + 1))
+    return {
+        u: sorted(rnd.sample([v for v in utenti if v != u], archi_per_nodo))
+        for u in utenti
+    }
+
+
+# Grafi fissi: scambio diretto, triangoli nei due versi, componenti separate,
+# archi verso utenti senza uscite, grafo completo (stessi utenti in ordini diversi)
+GRAFI = {
+    'scambio_diretto': {1: [2], 2: [1]},
+    'triangoli': {1: [2, 3], 2: [3, 1], 3: [1, 2]},
+    'componenti': {1: [2], 2: [3], 3: [1, 4], 4: [9], 5: [6], 6: [7, 5], 7: [5], 8: [5]},
+    'completo': {u: [v for v in range(1, 6) if v != u] for u in range(1, 6)},
+    'casuale': grafo_casuale(12, 3, seed=7),
+}
+
+
+def cicli_dfs(grafo, max_length):
+    """Cicli della DFS di riferimento (CycleFinder._trova_cicli_da_nodo), normalizzati"""
+    finder = CycleFinder()
+    return {
+        tuple(finder._normalizza_ciclo(path))
+        for start_node in grafo
+        for path in finder._trova_cicli_da_nodo(start_node, [start_node], max_length, grafo)
+    }
+
+
+def normalizzati(cicli):
+    """Lista di cicli normalizzati (a partire dal minimo), per confrontarli con cicli_dfs"""
+    finder = CycleFinder()
+    return [tuple(finder._normalizza_ciclo(list(ciclo))) for ciclo in cicli]
+
+
+def insiemi_utenti(cicli):
+    """Insiemi di utenti dei cicli: stessa identità di hash_ciclo (un ciclo per insieme)"""
+    return {frozenset(ciclo) for ciclo in cicli}
+
+
+def costo_ciclo(ciclo, punteggi):
+    """Costo top-K di un ciclo: somma dei costi dei suoi archi"""
+    return sum(costo_arco(punteggi[arco]) for arco in archi_del_ciclo(list(ciclo)))
+
+
+class MotoriCicliTest(SimpleTestCase):
+    """Ogni motore di cycle_engine trova gli stessi cicli della DFS di riferimento"""
+
+    def test_enumera_cicli_come_dfs(self):
+        for nome, grafo in GRAFI.items():
+            for max_length in (2, 3, 4, 6):
+                with self.subTest(grafo=nome, max_length=max_length):
+                    cicli = normalizzati(enumera_cicli(grafo, max_length))
+                    self.assertEqual(len(cicli), len(set(cicli)))  # ogni ciclo una volta sola
+                    self.assertEqual(set(cicli), cicli_dfs(grafo, max_length))
+
+    def test_enumera_cicli_con_piu_worker(self):
+        # Abbastanza nodi da dividere il lavoro in più compiti (vedi SOGLIA_PARTIZIONE)
+        grafo = grafo_casuale(60, 2, seed=3)
+        sequenziale = list(enumera_cicli(grafo, 4))
+        parallelo = list(enumera_cicli(grafo, 4, workers=2))
+
+        self.assertEqual(parallelo, sequenziale)  # stesso ordine, indipendente dai worker
+        self.assertEqual(set(normalizzati(parallelo)), cicli_dfs(grafo, 4))
+
+    def test_cicli_migliori_senza_limiti_come_dfs(self):
+        # Il top-K tiene un solo ciclo per insieme di utenti (il verso più economico)
+        for nome, grafo in GRAFI.items():
+            punteggi = {arco: (7 * i) % 101 for i, arco in enumerate(sorted(archi_del_grafo(grafo)))}
+            with self.subTest(grafo=nome):
+                cicli, statistiche = cicli_migliori(
+                    grafo, punteggi, 4, k_per_utente=None, max_espansioni=10 ** 6
+                )
+                self.assertIsNone(statistiche['interrotto'])
+                self.assertEqual(len(cicli), len(insiemi_utenti(c for c, _costo in cicli)))
+                self.assertEqual(insiemi_utenti(c for c, _costo in cicli), insiemi_utenti(cicli_dfs(grafo, 4)))
+
+                # Costi non decrescenti, ognuno il minimo tra i versi dello stesso insieme di utenti
+                costi = [costo for _c, costo in cicli]
+                self.assertEqual(costi, sorted(costi))
+                minimi = {}
+                for ciclo in cicli_dfs(grafo, 4):
+                    chiave = frozenset(ciclo)
+                    minimi[chiave] = min(minimi.get(chiave, float('inf')), costo_ciclo(ciclo, punteggi))
+                for ciclo, costo in cicli:
+                    self.assertAlmostEqual(costo, costo_ciclo(ciclo, punteggi))
+                    self.assertAlmostEqual(costo, minimi[frozenset(ciclo)])
+
+    def test_cicli_migliori_top_k_sono_i_piu_economici(self):
+        grafo = GRAFI['completo']
+        punteggi = {arco: (13 * i) % 101 for i, arco in enumerate(sorted(archi_del_grafo(grafo)))}
+        minimi = {}
+        for ciclo in cicli_dfs(grafo, 5):
+            chiave = frozenset(ciclo)
+            minimi[chiave] = min(minimi.get(chiave, float('inf')), costo_ciclo(ciclo, punteggi))
+
+        cicli, statistiche = cicli_migliori(grafo, punteggi, 5, k_per_utente=None, k_globale=10)
+
+        self.assertEqual(statistiche['interrotto'], 'k_globale')
+        self.assertEqual(len(cicli), 10)
+        for (_ciclo, costo), atteso in zip(cicli, sorted(minimi.values())[:10]):
+            self.assertAlmostEqual(costo, atteso)
+
+    def test_cicli_per_utente_come_dfs(self):
+        for nome, grafo in GRAFI.items():
+            inverso = grafo_inverso(grafo)
+            for max_length in (2, 3, 5, 6):
+                tutti = cicli_dfs(grafo, max_length)
+                for utente in sorted(grafo):
+                    with self.subTest(grafo=nome, max_length=max_length, utente=utente):
+                        cicli = list(cicli_per_utente(grafo, inverso, utente, max_length))
+                        self.assertTrue(all(ciclo[0] == utente for ciclo in cicli))
+                        cicli = normalizzati(cicli)
+                        self.assertEqual(len(cicli), len(set(cicli)))
+                        self.assertEqual(set(cicli), {c for c in tutti if utente in c})
+
+    def test_cicli_con_arco_come_dfs(self):
+        for nome, grafo in GRAFI.items():
+            inverso = grafo_inverso(grafo)
+            tutti = cicli_dfs(grafo, 4)
+            for arco in sorted(archi_del_grafo(grafo)):
+                with self.subTest(grafo=nome, arco=arco):
+                    cicli = list(cicli_con_arco(grafo, inverso, *arco, max_length=4))
+                    self.assertTrue(all(ciclo[:2] == list(arco) for ciclo in cicli))
+                    cicli = normalizzati(cicli)
+                    self.assertEqual(len(cicli), len(set(cicli)))
+                    self.assertEqual(set(cicli), {c for c in tutti if ciclo_usa_archi(list(c), {arco})})
+
+    def test_cicli_multigrafo_come_dfs(self):
+        for nome, grafo in GRAFI.items():
+            # Etichette fittizie (offerta_id, richiesta_id, tipo_match) per ogni arco
+            archi = {
+                (u, v): [(u * 100 + v, v * 100 + u, 'specifico')] + ([(u, v, 'parziale')] if (u + v) % 2 else [])
+                for u, v in archi_del_grafo(grafo)
+            }
+            with self.subTest(grafo=nome):
+                trovati = list(cicli_multigrafo(archi, 5))
+                self.assertEqual(set(normalizzati(c for c, _etichette in trovati)), cicli_dfs(grafo, 5))
+                for ciclo, etichette in trovati:
+                    self.assertEqual(etichette, [archi[arco] for arco in archi_del_ciclo(ciclo)])
+
+
+class CompatibilitaTest(TestCase):
+    """
+    Il kernel a bitmask (CompatibilityKernel) e l'indice invertito (KeywordIndex)
+    danno le stesse coppie, tipi e archi del confronto a coppie con
+    oggetti_compatibili_con_tipo + coppia_ammissibile / filtro_compatibilita_ammissibili
+    """
+
+    # (utente, tipo, titolo, parole chiave, sinonimi, categoria, altri campi)
+    ANNUNCI = [
+        (1, 'offro', 'Chitarra elettrica Fender', ['chitarra', 'elettrica', 'fender'],
+         ['chitarra', 'elettrica', 'fender', 'strumento'], 'Musica', {}),
+        (1, 'offro', 'Violino', ['violino'], ['violino', 'strumento'], 'Musica', {}),
+        (2, 'offro', 'Bicicletta da corsa', ['bicicletta', 'corsa'],
+         ['bicicletta', 'bici', 'corsa', 'velocipede'], 'Sport', {'metodo_scambio': 'mano'}),
+        (3, 'offro', 'Libro di cucina', ['libro', 'cucina'], ['libro', 'volume', 'cucina'], 'Libri',
+         {'metodo_scambio': 'spedizione'}),
+        (4, 'offro', 'Lampada da tavolo', ['lampada', 'tavolo'], ['lampada', 'lume', 'tavolo'], 'Casa', {}),
+        (5, 'offro', 'Telefono cellulare', ['telefono', 'cellulare'],
+         ['telefono', 'cellulare', 'smartphone'], 'Elettronica', {'metodo_scambio': 'mano'}),
+        (6, 'offro', 'Chitarra acustica', ['chitarra', 'acustica'], ['chitarra', 'acustica', 'strumento'],
+         'Musica', {'attivo': False}),
+        (2, 'cerco', 'Chitarra', ['chitarra'], ['chitarra', 'strumento'], 'Musica', {}),
+        (3, 'cerco', 'Bici', ['bici'], ['bici', 'bicicletta', 'velocipede'], 'Sport',
+         {'metodo_scambio': 'mano', 'distanza_massima_km': 20}),
+        (1, 'cerco', 'Cerco Casa', [], [], 'Casa', {'cerca_per_categoria': True}),
+        (4, 'cerco', 'Volume antico', ['volume', 'antico'], ['volume', 'libro', 'antico'], 'Libri', {}),
+        (5, 'cerco', 'Lampada', ['lampada'], ['lampada', 'lume'], 'Casa', {'metodo_scambio': 'spedizione'}),
+        (6, 'cerco', 'Smartphone', ['smartphone'], ['smartphone', 'telefono', 'cellulare'], 'Elettronica',
+         {'metodo_scambio': 'spedizione'}),
+        (3, 'cerco', 'Chitarra Fender', ['chitarra', 'fender'], ['chitarra', 'fender', 'strumento'], 'Musica', {}),
+        (1, 'cerco', 'Chitarra', ['chitarra'], ['chitarra', 'strumento'], 'Musica', {}),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create: niente signals né Annuncio.save, i token restano quelli indicati (niente WordNet)
+        province = Provincia.objects.bulk_create([
+            Provincia(sigla='MI', nome='Milano', regione='Lombardia', latitudine=45.4642, longitudine=9.1900),
+            Provincia(sigla='MB', nome='Monza', regione='Lombardia', latitudine=45.5845, longitudine=9.2744),
+            Provincia(sigla='RM', nome='Roma', regione='Lazio', latitudine=41.9028, longitudine=12.4964),
+        ])
+        invalida_matrice_distanze()
+
+        utenti = User.objects.bulk_create([User(username=f'utente{i}') for i in range(1, 7)])
+        cls.utenti = {i: utente.id for i, utente in enumerate(utenti, start=1)}
+        provincia_utente = {1: 0, 2: 0, 3: 2, 4: 1, 5: 1, 6: 2}
+        UserProfile.objects.bulk_create([
+            UserProfile(user=utente, provincia_obj=province[provincia_utente[i]])
+            for i, utente in enumerate(utenti, start=1)
+        ])
+
+        categorie = {nome: Categoria.objects.create(nome=nome) for nome in {a[5] for a in cls.ANNUNCI}}
+        Annuncio.objects.bulk_create([
+            Annuncio(
+                utente_id=cls.utenti[utente], tipo=tipo, titolo=titolo, descrizione='',
+                categoria=categorie[categoria], parole_chiave=parole, sinonimi_chiave=sinonimi,
+                moderation_status='approved', **altri
+            )
+            for utente, tipo, titolo, parole, sinonimi, categoria, altri in cls.ANNUNCI
+        ])
+
+    def setUp(self):
+        annunci = list(Annuncio.objects.select_related(
+            'utente__userprofile__provincia_obj', 'categoria'
+        ).order_by('id'))
+        self.offerte = [a for a in annunci if a.tipo == 'offro']
+        self.richieste = [a for a in annunci if a.tipo == 'cerco']
+        self.per_titolo = {(a.tipo, a.utente_id, a.titolo): a for a in annunci}
+
+    def annuncio(self, tipo, utente, titolo):
+        return self.per_titolo[(tipo, self.utenti[utente], titolo)]
+
+    def coppie_a_confronto(self):
+        """{(offerta_id, richiesta_id): tipo_match} con oggetti_compatibili_con_tipo su ogni coppia"""
+        coppie = {}
+        for offerta in self.offerte:
+            for richiesta in self.richieste:
+                if offerta.utente_id == richiesta.utente_id:
+                    continue
+                compatible, tipo_match = oggetti_compatibili_con_tipo(offerta, richiesta)
+                if compatible and tipo_match in CompatibilityKernel.TIPI_MATCH:
+                    coppie[(offerta.id, richiesta.id)] = tipo_match
+        return coppie
+
+    def test_kernel_e_indice_come_confronto_a_coppie(self):
+        attese = self.coppie_a_confronto()
+        indice = KeywordIndex(self.richieste)
+
+        kernel = {
+            (offerta.id, richiesta.id): tipo_match
+            for offerta, richiesta, tipo_match in CompatibilityKernel(indice).coppie_compatibili(self.offerte)
+        }
+        per_indice = {
+            (offerta.id, richiesta.id): tipo_match
+            for offerta, richiesta, tipo_match in KeywordIndex(self.richieste).coppie_compatibili(self.offerte)
+        }
+
+        self.assertEqual(kernel, attese)
+        self.assertEqual(per_indice, attese)
+        self.assertEqual(set(attese.values()), set(CompatibilityKernel.TIPI_MATCH))
+
+        # Un caso per tipo (e nessuna coppia dello stesso utente)
+        chitarra = self.annuncio('offro', 1, 'Chitarra elettrica Fender')
+        self.assertEqual(attese[(chitarra.id, self.annuncio('cerco', 2, 'Chitarra').id)], 'specifico')
+        self.assertEqual(attese[(self.annuncio('offro', 2, 'Bicicletta da corsa').id,
+                                 self.annuncio('cerco', 3, 'Bici').id)], 'parziale')
+        self.assertEqual(attese[(self.annuncio('offro', 3, 'Libro di cucina').id,
+                                 self.annuncio('cerco', 4, 'Volume antico').id)], 'sinonimo')
+        self.assertEqual(attese[(self.annuncio('offro', 4, 'Lampada da tavolo').id,
+                                 self.annuncio('cerco', 1, 'Cerco Casa').id)], 'categoria')
+        self.assertNotIn((chitarra.id, self.annuncio('cerco', 1, 'Chitarra').id), attese)
+
+    def test_archi_come_coppia_ammissibile(self):
+        per_id = {a.id: a for a in self.offerte + self.richieste}
+        ammissibili = {
+            (offerta_id, richiesta_id, tipo_match)
+            for (offerta_id, richiesta_id), tipo_match in self.coppie_a_confronto().items()
+            if coppia_ammissibile(
+                per_id[offerta_id], per_id[richiesta_id],
+                distanza_tra_annunci(per_id[offerta_id], per_id[richiesta_id])
+            )
+        }
+        archi_attesi = {(per_id[o].utente_id, per_id[r].utente_id) for o, r, _tipo in ammissibili}
+
+        # Esclusi per distanza (mano, Milano → Roma oltre 20 km), metodo (mano vs spedizione), annuncio non attivo
+        esclusi = {
+            (self.annuncio('offro', 2, 'Bicicletta da corsa').id, self.annuncio('cerco', 3, 'Bici').id),
+            (self.annuncio('offro', 5, 'Telefono cellulare').id, self.annuncio('cerco', 6, 'Smartphone').id),
+            (self.annuncio('offro', 6, 'Chitarra acustica').id, self.annuncio('cerco', 2, 'Chitarra').id),
+        }
+        self.assertTrue(esclusi <= set(self.coppie_a_confronto()))
+        self.assertFalse(esclusi & {(o, r) for o, r, _tipo in ammissibili})
+
+        # Grafo dal kernel (costruisci_grafo)
+        finder = CycleFinder()
+        finder.costruisci_grafo()
+        self.assertEqual(archi_del_grafo(finder.grafo), archi_attesi)
+        self.assertEqual(
+            {(o.id, r.id, tipo) for coppie in finder.archi_annunci.values() for o, r, tipo in coppie},
+            ammissibili
+        )
+
+        # Tabella CompatibilitaAnnunci (kernel) + filtro_compatibilita_ammissibili
+        ricostruisci_compatibilita()
+        tabella = {
+            (offerta_id, richiesta_id): tipo_match
+            for offerta_id, richiesta_id, tipo_match in CompatibilitaAnnunci.objects.values_list(
+                'offerta_id', 'richiesta_id', 'tipo_match'
+            )
+        }
+        self.assertEqual(tabella, self.coppie_a_confronto())
+        finder = CycleFinder()
+        finder.costruisci_grafo(da_compatibilita=True)
+        self.assertEqual(archi_del_grafo(finder.grafo), archi_attesi)
+
+
+class ScenarioScambiTest(TestCase):
+    """
+    Cinque utenti a Milano (più una provincia libera per i cambi di provincia) e
+    annunci con le parole chiave già calcolate: il calcolo completo trova i cicli
+    (4, 5), (1, 2, 3) e (2, 3, 5). Gli utenti sono indicati con il loro numero.
+    """
+
+    # (utente, tipo, titolo): parole chiave e sinonimi = titolo in minuscolo
+    ANNUNCI = [
+        (1, 'offro', 'Chitarra'), (2, 'cerco', 'Chitarra'),
+        (2, 'offro', 'Lampada'), (3, 'cerco', 'Lampada'),
+        (3, 'offro', 'Orologio'), (1, 'cerco', 'Orologio'), (5, 'cerco', 'Orologio'),
+        (4, 'offro', 'Tenda'), (5, 'cerco', 'Tenda'),
+        (5, 'offro', 'Zaino'), (4, 'cerco', 'Zaino'),
+        (5, 'offro', 'Violino'), (2, 'cerco', 'Violino'),
+    ]
+    CICLI = {(4, 5), (1, 2, 3), (2, 3, 5)}
+
+    @classmethod
+    def setUpTestData(cls):
+        # create (non bulk_create): i signals di Provincia aggiornano la matrice delle distanze
+        cls.milano = Provincia.objects.create(
+            sigla='MI', nome='Milano', regione='Lombardia', latitudine=45.4642, longitudine=9.1900
+        )
+        cls.roma = Provincia.objects.create(
+            sigla='RM', nome='Roma', regione='Lazio', latitudine=41.9028, longitudine=12.4964
+        )
+
+        # bulk_create: niente signals né Annuncio.save, i token restano quelli indicati (niente WordNet)
+        utenti = User.objects.bulk_create([User(username=f'utente{i}') for i in range(1, 6)])
+        cls.utenti = {i: utente.id for i, utente in enumerate(utenti, start=1)}
+        cls.numeri = {user_id: i for i, user_id in cls.utenti.items()}
+        UserProfile.objects.bulk_create([UserProfile(user=utente, provincia_obj=cls.milano) for utente in utenti])
+
+        cls.categoria = Categoria.objects.create(nome='Varie')
+        Annuncio.objects.bulk_create([
+            Annuncio(
+                utente_id=cls.utenti[utente], tipo=tipo, titolo=titolo, descrizione='',
+                categoria=cls.categoria, parole_chiave=[titolo.lower()], sinonimi_chiave=[titolo.lower()],
+                moderation_status='approved'
+            )
+            for utente, tipo, titolo in cls.ANNUNCI
+        ])
+
+    def annuncio(self, utente, tipo, titolo):
+        return Annuncio.objects.get(utente_id=self.utenti[utente], tipo=tipo, titolo=titolo)
+
+    def nuovo_annuncio(self, utente, tipo, titolo):
+        """Annuncio salvato con save(): parole chiave e signals come da interfaccia"""
+        annuncio = Annuncio(
+            utente_id=self.utenti[utente], tipo=tipo, titolo=titolo, descrizione='', categoria=self.categoria
+        )
+        annuncio.save()
+        return annuncio
+
+    def calcola(self, **opzioni):
+        call_command('calcola_cicli', stdout=StringIO(), **opzioni)
+
+    def cicli_validi(self):
+        """Cicli validi come tuple di numeri di utente"""
+        return {
+            tuple(self.numeri[user_id] for user_id in users)
+            for users in CicloScambio.objects.filter(valido=True).values_list('users', flat=True)
+        }
+
+    def ciclo(self, *numeri):
+        """CicloScambio valido con gli utenti indicati"""
+        users = [self.utenti[numero] for numero in numeri]
+        return next(ciclo for ciclo in CicloScambio.objects.filter(valido=True) if ciclo.users == users)
+
+
+class CompatibilitaAnnunciTest(ScenarioScambiTest):
+    """I signals mantengono CompatibilitaAnnunci uguale a una ricostruzione completa"""
+
+    def righe_tabella(self):
+        return set(CompatibilitaAnnunci.objects.values_list(
+            'offerta_id', 'richiesta_id', 'tipo_match', 'punteggio', 'distanza_km'
+        ))
+
+    def test_signals_come_ricostruzione(self):
+        ricostruisci_compatibilita()
+
+        # Annuncio nuovo, titolo modificato, annuncio cancellato
+        orologio = self.nuovo_annuncio(4, 'offro', 'Orologio')
+        lampada = self.annuncio(2, 'offro', 'Lampada')
+        lampada.titolo = 'Tenda'
+        lampada.save()
+        self.annuncio(1, 'offro', 'Chitarra').delete()
+        incrementale = self.righe_tabella()
+
+        ricostruisci_compatibilita()
+        self.assertEqual(incrementale, self.righe_tabella())
+        self.assertEqual(
+            {(o, r) for o, r, _tipo, _p, _d in incrementale if o in (orologio.id, lampada.id)},
+            {
+                (orologio.id, self.annuncio(1, 'cerco', 'Orologio').id),
+                (orologio.id, self.annuncio(5, 'cerco', 'Orologio').id),
+                (lampada.id, self.annuncio(5, 'cerco', 'Tenda').id),
+            }
+        )
+
+    def test_disattivazione_non_ricalcola(self):
+        ricostruisci_compatibilita()
+        prima = self.righe_tabella()
+
+        tenda = self.annuncio(4, 'offro', 'Tenda')
+        tenda.attivo = False
+        tenda.save()
+
+        # Lo stato attivo è filtrato in query: le righe restano per la riattivazione
+        self.assertEqual(self.righe_tabella(), prima)
+
+    def test_grafo_da_tabella_come_calcolo_diretto(self):
+        ricostruisci_compatibilita()
+        diretto = CycleFinder()
+        diretto.costruisci_grafo()
+        da_tabella = CycleFinder()
+        da_tabella.costruisci_grafo(da_compatibilita=True)
+
+        def archi(grafo):
+            return {(u, v) for u, vicini in grafo.items() for v in vicini}
+
+        self.assertEqual(archi(da_tabella.grafo), archi(diretto.grafo))
+        self.assertIn((self.utenti[4], self.utenti[5]), archi(da_tabella.grafo))
+
+    def test_cambio_provincia_aggiorna_le_distanze(self):
+        ricostruisci_compatibilita()
+
+        profilo = UserProfile.objects.get(user_id=self.utenti[3])
+        profilo.provincia_obj = self.roma
+        profilo.save()
+        aggiornate = self.righe_tabella()
+
+        ricostruisci_compatibilita()
+        self.assertEqual(aggiornate, self.righe_tabella())
+        self.assertTrue(any(distanza > 400 for *_riga, distanza in aggiornate))
+
+
+class CalcoloIncrementaleTest(ScenarioScambiTest):
+    """Il calcolo incrementale (archi del grafo cambiati) arriva agli stessi cicli del completo"""
+
+    def assertCicliComeCalcoloCompleto(self):
+        incrementale = self.cicli_validi()
+        self.calcola(force_full=True)
+        self.assertEqual(incrementale, self.cicli_validi())
+
+    def test_nuovo_annuncio(self):
+        self.calcola()
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+        # Orologio di 4 → 1 e 5: nuovo ciclo 4 → 1 → 2 → 3 → 5 → 4
+        self.nuovo_annuncio(4, 'offro', 'Orologio')
+        self.calcola(incremental=True)
+
+        self.assertIn((1, 2, 3, 5, 4), self.cicli_validi())
+        self.assertCicliComeCalcoloCompleto()
+
+    def test_annuncio_modificato(self):
+        self.calcola()
+
+        # Lampada di 2 diventa Tenda (cercata da 5): sparisce 1 → 2 → 3, nasce 2 → 5
+        lampada = self.annuncio(2, 'offro', 'Lampada')
+        lampada.titolo = 'Tenda'
+        lampada.parole_chiave = lampada.sinonimi_chiave = ['tenda']
+        lampada.save()
+        self.calcola(incremental=True)
+
+        self.assertNotIn((1, 2, 3), self.cicli_validi())
+        self.assertIn((2, 5), self.cicli_validi())
+        self.assertCicliComeCalcoloCompleto()
+
+    def test_annuncio_cancellato(self):
+        self.calcola()
+
+        # La cancellazione non lascia last_modified: il proprietario va comunque
+        # riconsiderato, anche se nello stesso calcolo cambia un altro utente
+        self.annuncio(1, 'offro', 'Chitarra').delete()
+        self.nuovo_annuncio(4, 'offro', 'Radio')
+        self.calcola(incremental=True)
+
+        finder = CycleFinder()
+        finder.costruisci_grafo()
+        self.assertEqual(CalcoloMetadata.objects.get().get_archi_grafo(), archi_del_grafo(finder.grafo))
+        self.assertNotIn((1, 2, 3), self.cicli_validi())
+        self.assertCicliComeCalcoloCompleto()
+
+
+class AttributiCicloTest(ScenarioScambiTest):
+    """Gli attributi derivati vengono salvati con il ciclo dal calcolo"""
+
+    def annunci_ids(self, *chiavi):
+        return {self.annuncio(*chiave).id for chiave in chiavi}
+
+    def test_attributi_salvati(self):
+        self.calcola()
+
+        ciclo = self.ciclo(1, 2, 3)
+        self.assertEqual(set(ciclo.annunci_ids), self.annunci_ids(
+            (1, 'offro', 'Chitarra'), (2, 'cerco', 'Chitarra'),
+            (2, 'offro', 'Lampada'), (3, 'cerco', 'Lampada'),
+            (3, 'offro', 'Orologio'), (1, 'cerco', 'Orologio'),
+        ))
+        self.assertEqual(ciclo.categoria_qualita, 'generica')
+        self.assertGreater(ciclo.punteggio_qualita, 0)
+        self.assertFalse(ciclo.usa_sinonimi or ciclo.ha_match_parziali or ciclo.ha_match_categoria)
+        self.assertTrue(ciclo.fasce_pari)
+
+    def test_match_per_categoria(self):
+        Annuncio.objects.filter(
+            utente_id=self.utenti[3], tipo='cerco', titolo='Lampada'
+        ).update(cerca_per_categoria=True, parole_chiave=[], sinonimi_chiave=[])
+        self.calcola()
+
+        self.assertTrue(self.ciclo(1, 2, 3).ha_match_categoria)
+        self.assertFalse(self.ciclo(4, 5).ha_match_categoria)
+
+
+class DettagliCompattiTest(ScenarioScambiTest):
+    """Dettagli dei cicli nel formato compatto v2 e conversione da/verso il v1 (migrazione 0032)"""
+
+    def titoli_mostrati(self, dettagli):
+        """Coppie (offerto, richiesto) mostrate per ogni utente nel formato v1"""
+        return {(u['offerta']['titolo'], u['richiede']['titolo']) for u in dettagli['utenti']}
+
+    def test_formato_compatto_e_completo(self):
+        self.calcola()
+
+        ciclo = self.ciclo(1, 2, 3)
+        self.assertTrue(is_compatti(ciclo.dettagli))
+        self.assertNotIn('utenti', ciclo.dettagli)
+
+        completi = ciclo.get_dettagli()
+        self.assertEqual(
+            self.titoli_mostrati(completi),
+            {('Chitarra', 'Chitarra'), ('Lampada', 'Lampada'), ('Orologio', 'Orologio')}
+        )
+        self.assertEqual(ciclo.to_dict()['dettagli'], completi)
+        self.assertEqual(comprimi_dettagli(completi), ciclo.dettagli)
+
+    def test_migrazione_0032(self):
+        self.calcola()
+        compatti = dict(CicloScambio.objects.values_list('id', 'dettagli'))
+        migrazione = import_module('scambi.migrations.0032_cicloscambio_dettagli_compatti')
+
+        # Indietro: formato v1 con titoli e categorie dagli annunci
+        migrazione.espandi(apps, None)
+        for ciclo in CicloScambio.objects.all():
+            self.assertFalse(is_compatti(ciclo.dettagli))
+            self.assertEqual(ciclo.dettagli, CicloScambio(dettagli=compatti[ciclo.id], users=ciclo.users).get_dettagli())
+
+        # Avanti: di nuovo gli stessi dettagli compatti
+        migrazione.comprimi(apps, None)
+        self.assertEqual(dict(CicloScambio.objects.values_list('id', 'dettagli')), compatti)
+
+
+class CalcoloAFlussoTest(ScenarioScambiTest):
+    """I cicli passano dalla ricerca al database uno alla volta, a blocchi di commit-batch-size"""
+
+    def test_itera_cicli_come_trova_tutti_cicli(self):
+        for engine in ('dfs', 'canonico', 'multigrafo'):
+            with self.subTest(engine=engine):
+                finder = CycleFinder()
+                finder.costruisci_grafo()
+                cicli = finder.itera_cicli(engine=engine)
+                self.assertIsInstance(cicli, types.GeneratorType)
+                a_flusso = [ciclo['hash_ciclo'] for ciclo in cicli]
+
+                finder = CycleFinder()
+                finder.costruisci_grafo()
+                self.assertEqual(a_flusso, [ciclo['hash_ciclo'] for ciclo in finder.trova_tutti_cicli(engine=engine)])
+                self.assertEqual(len(a_flusso), len(self.CICLI))
+
+    def test_salvataggio_a_blocchi(self):
+        self.calcola(commit_batch_size=1)
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+
+class SalvaBatchTest(ScenarioScambiTest):
+    """Upsert a blocchi dei cicli calcolati (CicloScambio.salva_batch)"""
+
+    def cicli_calcolati(self):
+        finder = CycleFinder()
+        finder.costruisci_grafo()
+        return finder.trova_tutti_cicli()
+
+    def test_upsert_conserva_gli_id(self):
+        cicli = self.cicli_calcolati()
+        self.assertEqual(CicloScambio.salva_batch(cicli), (3, 0))
+        ids = dict(CicloScambio.objects.values_list('hash_ciclo', 'id'))
+
+        # Secondo salvataggio: stesse righe (le proposte collegate restano valide), di nuovo valide
+        CicloScambio.objects.update(valido=False)
+        self.assertEqual(CicloScambio.salva_batch(cicli + cicli[:1]), (0, 3))
+        self.assertEqual(dict(CicloScambio.objects.values_list('hash_ciclo', 'id')), ids)
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+        ciclo = CicloScambio.objects.get(hash_ciclo=cicli[0]['hash_ciclo'])
+        for campo in ['users', 'lunghezza', 'dettagli'] + CicloScambio.CAMPI_DERIVATI:
+            self.assertEqual(getattr(ciclo, campo), cicli[0][campo])
+
+
+class CalcoloDifferenzeTest(ScenarioScambiTest):
+    """Il calcolo completo riscrive solo i cicli nuovi, cambiati o spariti"""
+
+    def righe_valide(self):
+        return {
+            hash_ciclo: (ciclo_id, calcolato_at)
+            for hash_ciclo, ciclo_id, calcolato_at in CicloScambio.objects.filter(valido=True).values_list(
+                'hash_ciclo', 'id', 'calcolato_at'
+            )
+        }
+
+    def test_cicli_invariati_non_riscritti(self):
+        self.calcola()
+        prima = self.righe_valide()
+        tenda = self.ciclo(4, 5).hash_ciclo
+
+        # Nessun cambiamento: nessuna riga riscritta
+        self.calcola()
+        self.assertEqual(self.righe_valide(), prima)
+
+        # Zaino di 5 sparisce e Lampada di 1 crea (1, 3): il ciclo (4, 5) viene
+        # invalidato (e rimosso), gli altri restano com'erano
+        self.annuncio(5, 'offro', 'Zaino').delete()
+        self.nuovo_annuncio(1, 'offro', 'Lampada')
+        self.calcola()
+
+        dopo = self.righe_valide()
+        self.assertEqual(self.cicli_validi(), {(1, 3), (1, 2, 3), (2, 3, 5)})
+        self.assertFalse(CicloScambio.objects.filter(hash_ciclo=tenda).exists())
+        invariati = {hash_ciclo: righe for hash_ciclo, righe in dopo.items() if hash_ciclo in prima}
+        self.assertEqual(invariati, {hash_ciclo: righe for hash_ciclo, righe in prima.items() if hash_ciclo != tenda})
+
+    def test_cicli_cambiati_riscritti_nel_passaggio_finale(self):
+        self.calcola()
+        ciclo = self.ciclo(1, 2, 3)
+        CicloScambio.objects.filter(pk=ciclo.pk).update(punteggio_qualita=-1)
+
+        # Fino al passaggio finale chi legge vede ancora il ciclo com'era
+        attiva_differenze = CicloScambio.attiva_differenze
+        letti = []
+
+        def leggi_e_attiva(*args, **kwargs):
+            letti.append(CicloScambio.objects.get(pk=ciclo.pk).punteggio_qualita)
+            return attiva_differenze(*args, **kwargs)
+
+        with mock.patch.object(CicloScambio, 'attiva_differenze', side_effect=leggi_e_attiva):
+            self.calcola()
+
+        self.assertEqual(letti, [-1])
+        riscritto = CicloScambio.objects.get(pk=ciclo.pk)
+        self.assertTrue(riscritto.valido)
+        self.assertEqual(riscritto.punteggio_qualita, ciclo.punteggio_qualita)
+
+
+class CicloUtenteTest(ScenarioScambiTest):
+    """Righe CicloUtente dei cicli salvati e ricerca dei cicli di un utente sull'indice"""
+
+    def rank_score(self, ciclo):
+        return CicloUtente.calcola_rank_score(ciclo.lunghezza, ciclo.punteggio_qualita, ciclo.categoria_qualita)
+
+    def test_righe_per_utente(self):
+        self.calcola()
+
+        for ciclo in CicloScambio.objects.filter(valido=True):
+            membri = list(ciclo.membri.order_by('posizione').values_list('utente_id', 'rank_score'))
+            self.assertEqual([utente_id for utente_id, _rank in membri], ciclo.users)
+            self.assertEqual({rank for _utente, rank in membri}, {self.rank_score(ciclo)})
+
+    def test_find_for_user(self):
+        self.calcola()
+
+        cicli = list(CicloScambio.find_for_user(self.utenti[5]))
+        self.assertEqual({tuple(self.numeri[u] for u in ciclo.users) for ciclo in cicli}, {(4, 5), (2, 3, 5)})
+        rank = [self.rank_score(ciclo) for ciclo in cicli]
+        self.assertEqual(rank, sorted(rank, reverse=True))
+        self.assertEqual(len(CicloScambio.find_for_user(self.utenti[5], limit=1, offset=1)), 1)
+
+    def test_invalida_cicli_con_utenti(self):
+        self.calcola()
+
+        self.assertEqual(CycleFinder().invalida_cicli_con_utenti([self.utenti[1]]), 1)
+        self.assertEqual(self.cicli_validi(), {(4, 5), (2, 3, 5)})
+        self.assertEqual(len(CicloScambio.find_for_user(self.utenti[1])), 0)
+
+
+class CicloAnnuncioTest(ScenarioScambiTest):
+    """L'indice CicloAnnuncio allinea subito i cicli allo stato degli annunci"""
+
+    def imposta_attivo(self, annuncio, attivo):
+        annuncio.attivo = attivo
+        annuncio.save()
+
+    def test_righe_degli_annunci_mostrati(self):
+        self.calcola()
+
+        ciclo = self.ciclo(4, 5)
+        self.assertEqual(
+            set(ciclo.annunci_collegati.values_list('annuncio_id', flat=True)),
+            {self.annuncio(4, 'offro', 'Tenda').id, self.annuncio(5, 'cerco', 'Tenda').id,
+             self.annuncio(5, 'offro', 'Zaino').id, self.annuncio(4, 'cerco', 'Zaino').id}
+        )
+
+        risultato = get_cicli_precalcolati(annuncio_id=self.annuncio(2, 'offro', 'Lampada').id)
+        self.assertEqual(
+            {int(ciclo['id_ciclo']) for ciclo in risultato['catene']},
+            {self.ciclo(1, 2, 3).id, self.ciclo(2, 3, 5).id}
+        )
+
+    def test_disattivazione_e_riattivazione(self):
+        self.calcola()
+        tenda = self.annuncio(4, 'offro', 'Tenda')
+
+        self.imposta_attivo(tenda, False)
+        self.assertEqual(self.cicli_validi(), {(1, 2, 3), (2, 3, 5)})
+
+        # Nessun calcolo dalla disattivazione: i cicli tornano validi subito
+        self.imposta_attivo(tenda, True)
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+        # Dopo un calcolo completo li ritrova il calcolo successivo
+        self.imposta_attivo(tenda, False)
+        self.calcola()
+        self.imposta_attivo(tenda, True)
+        self.assertEqual(self.cicli_validi(), {(1, 2, 3), (2, 3, 5)})
+
+    def test_cancellazione(self):
+        self.calcola()
+
+        self.annuncio(3, 'offro', 'Orologio').delete()
+        self.assertEqual(self.cicli_validi(), {(4, 5)})
+
+    def test_migrazione_0034(self):
+        self.calcola()
+        righe = set(CicloAnnuncio.objects.values_list('ciclo_id', 'annuncio_id'))
+        CicloAnnuncio.objects.all().delete()
+
+        import_module('scambi.migrations.0034_cicloannuncio').popola_annunci_cicli(apps, None)
+        self.assertEqual(set(CicloAnnuncio.objects.values_list('ciclo_id', 'annuncio_id')), righe)
+        self.assertEqual(len(righe), sum(2 * ciclo.lunghezza for ciclo in CicloScambio.objects.all()))
+
+    def test_riattivazione_dopo_cancellazione(self):
+        self.calcola()
+        tenda = self.annuncio(4, 'offro', 'Tenda')
+
+        # Il ciclo ha perso uno dei suoi annunci mentre Tenda era disattivato
+        self.imposta_attivo(tenda, False)
+        self.annuncio(5, 'offro', 'Zaino').delete()
+        self.imposta_attivo(tenda, True)
+        self.assertEqual(self.cicli_validi(), {(1, 2, 3), (2, 3, 5)})
+
+    def test_riattivazione_senza_timestamp(self):
+        self.calcola()
+        tenda = self.annuncio(4, 'offro', 'Tenda')
+
+        # Annuncio disattivato prima che esistesse disattivato_at
+        self.imposta_attivo(tenda, False)
+        Annuncio.objects.filter(pk=tenda.pk).update(disattivato_at=None)
+        tenda.refresh_from_db()
+        self.imposta_attivo(tenda, True)
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+
+class ValidazioneCicliTest(ScenarioScambiTest):
+    """validate_all_cycles invalida per insiemi i cicli con annunci mancanti"""
+
+    def test_annunci_non_attivi(self):
+        self.calcola()
+        tenda = self.annuncio(4, 'offro', 'Tenda')
+        orologio = self.annuncio(3, 'offro', 'Orologio')
+
+        # update() non passa dai signal: i cicli restano validi fino alla validazione
+        Annuncio.objects.filter(id__in=[tenda.id, orologio.id]).update(attivo=False)
+        self.assertEqual(self.cicli_validi(), self.CICLI)
+
+        statistiche = CicloScambio.validate_all_cycles()
+        self.assertEqual(self.cicli_validi(), set())
+        self.assertEqual(statistiche['total_checked'], 3)
+        self.assertEqual(statistiche['invalidated'], 3)
+        self.assertEqual(statistiche['still_valid'], 0)
+        self.assertEqual(
+            {tuple(dettaglio['missing_annunci']) for dettaglio in statistiche['missing_annunci_details']},
+            {(tenda.id,), (orologio.id,)}
+        )
+
+        self.assertEqual(CicloScambio.validate_all_cycles()['total_checked'], 0)
+
+    def test_annunci_cancellati(self):
+        self.calcola()
+
+        # Le righe dell'indice di un annuncio cancellato spariscono in cascata
+        CicloAnnuncio.objects.filter(annuncio=self.annuncio(5, 'offro', 'Zaino')).delete()
+
+        statistiche = CicloScambio.validate_all_cycles()
+        self.assertEqual(self.cicli_validi(), {(1, 2, 3), (2, 3, 5)})
+        self.assertEqual(statistiche['invalidated'], 1)
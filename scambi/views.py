@@ -383,6 +383,22 @@ def disattiva_annuncio(request, annuncio_id):
     messages.success(request, f'Annuncio "{annuncio.titolo}" disattivato con successo!')
     return redirect('profilo_utente', username=request.user.username)
 
+def calcola_fasce_pari(catena):
+    """
+    True se tutti gli annunci mostrati nella catena hanno la stessa fascia di prezzo
+    (o nessuna). Usato solo per le catene senza il flag salvato dal calcolo cicli.
+    """
+    fasce = set()
+    for utente_info in catena.get('utenti', []):
+        # Raccogli le fasce da richiede e offerta
+        for chiave in ('richiede', 'offerta'):
+            annuncio = utente_info.get(chiave)
+            if annuncio is not None and getattr(annuncio, 'fascia_prezzo', None):
+                fasce.add(annuncio.fascia_prezzo)
+
+    # Se c'è una sola fascia (o nessuna), gli scambi sono alla pari
+    return len(fasce) <= 1
+
 def catene_scambio(request):
     """
     Mostra le catene di scambio pre-calcolate dalla GitHub Action.
@@ -493,9 +509,9 @@ def catene_scambio(request):
                 invalidati = finder.invalida_cicli_con_utenti([request.user.id])
                 print(f"   Invalidati {invalidati} cicli")
 
-                # Step 2: Costruisci grafo e ricalcola
-                print(f"   🔨 Costruendo grafo...")
-                finder.costruisci_grafo()
+                # Step 2: Aggiorna il grafo dell'ultimo calcolo solo attorno all'utente e ricalcola
+                print(f"   🔨 Aggiornando grafo...")
+                finder.costruisci_grafo_per_utenti([request.user.id])
 
                 print(f"   🔍 Cercando nuovi cicli...")
                 cicli_raw = finder.trova_cicli_per_utenti([request.user.id], max_length=6)
@@ -503,26 +519,11 @@ def catene_scambio(request):
 
                 # Step 3: Salva cicli nel DB
                 print(f"   💾 Salvando cicli nel DB...")
-                from .management.commands.calcola_cicli import Command as CalcolaCicliCommand
-                cmd = CalcolaCicliCommand()
-
-                salvati = 0
-                aggiornati = 0
-                for ciclo_raw in cicli_raw:
-                    # Usa update_or_create per gestire duplicati (hash_ciclo è UNIQUE)
-                    ciclo, created = CicloScambio.objects.update_or_create(
-                        hash_ciclo=ciclo_raw['hash_ciclo'],
-                        defaults={
-                            'users': ciclo_raw['users'],
-                            'lunghezza': ciclo_raw['lunghezza'],
-                            'dettagli': ciclo_raw['dettagli'],
-                            'valido': True
-                        }
-                    )
-                    if created:
-                        salvati += 1
-                    else:
-                        aggiornati += 1
+                from django.db import transaction
+
+                # Upsert in blocco per hash_ciclo (preserva gli id dei cicli esistenti)
+                with transaction.atomic():
+                    salvati, aggiornati = CicloScambio.salva_batch(cicli_raw)
 
                 print(f"   ✅ Salvati {salvati} nuovi cicli, aggiornati {aggiornati} cicli nel DB")
 
@@ -763,19 +764,9 @@ def catene_scambio(request):
 
     # Aggiungi flag per i preferiti, hash e fasce pari
     for catena in catene_specifiche:
-        # Calcola se tutti gli annunci hanno la stessa fascia di prezzo
-        fasce = set()
-        for utente_info in catena.get('utenti', []):
-            # Raccogli le fasce da richiede e offerta
-            if utente_info.get('richiede') and hasattr(utente_info['richiede'], 'fascia_prezzo'):
-                if utente_info['richiede'].fascia_prezzo:
-                    fasce.add(utente_info['richiede'].fascia_prezzo)
-            if utente_info.get('offerta') and hasattr(utente_info['offerta'], 'fascia_prezzo'):
-                if utente_info['offerta'].fascia_prezzo:
-                    fasce.add(utente_info['offerta'].fascia_prezzo)
-
-        # Se c'è una sola fascia (o nessuna), gli scambi sono alla pari
-        catena['fasce_pari'] = len(fasce) <= 1
+        # Flag fasce_pari salvato dal calcolo cicli; ricalcolato solo se assente
+        if catena.get('fasce_pari') is None:
+            catena['fasce_pari'] = calcola_fasce_pari(catena)
 
         if request.user.is_authenticated:
             # Riordina la catena in modo che l'utente loggato sia sempre il primo
@@ -1249,22 +1240,13 @@ def le_mie_catene(request):
         # Filtra per annuncio specifico se richiesto
         if annuncio_selezionato:
             # Filtra cicli che contengono l'annuncio selezionato
-            cicli_filtrati = []
-            for ciclo in cicli_db:
-                if 'utenti' in ciclo.dettagli:
-                    for utente_info in ciclo.dettagli['utenti']:
-                        annunci_ids = []
-                        if utente_info.get('richiede'):
-                            annunci_ids.append(utente_info['richiede'].get('id'))
-                        if utente_info.get('offerta'):
-                            annunci_ids.append(utente_info['offerta'].get('id'))
-                        if annuncio_selezionato.id in annunci_ids:
-                            cicli_filtrati.append(ciclo)
-                            break
-            cicli_db = cicli_filtrati
-
-        # Converti cicli DB in formato template
-        catene_uniche = [converti_ciclo_a_catena(ciclo) for ciclo in cicli_db]
+            from .dettagli_ciclo import annunci_mostrati
+
+            cicli_db = [ciclo for ciclo in cicli_db if annuncio_selezionato.id in annunci_mostrati(ciclo.dettagli)]
+
+        # Converti cicli DB in formato template (annunci dei dettagli compatti in una query)
+        annunci = CicloScambio.annunci_dei_cicli(cicli_db)
+        catene_uniche = [converti_ciclo_a_catena(ciclo, annunci) for ciclo in cicli_db]
 
         print(f"✅ Caricate {len(catene_uniche)} catene dal DB")
 
@@ -1278,19 +1260,9 @@ def le_mie_catene(request):
 
         # Aggiungi flag per preferiti e fasce pari
         for catena in catene_alta_qualita + catene_generiche:
-            # Calcola se tutti gli annunci hanno la stessa fascia di prezzo
-            fasce = set()
-            for utente_info in catena.get('utenti', []):
-                # Raccogli le fasce da richiede e offerta
-                if utente_info.get('richiede') and hasattr(utente_info['richiede'], 'fascia_prezzo'):
-                    if utente_info['richiede'].fascia_prezzo:
-                        fasce.add(utente_info['richiede'].fascia_prezzo)
-                if utente_info.get('offerta') and hasattr(utente_info['offerta'], 'fascia_prezzo'):
-                    if utente_info['offerta'].fascia_prezzo:
-                        fasce.add(utente_info['offerta'].fascia_prezzo)
-
-            # Se c'è una sola fascia (o nessuna), gli scambi sono alla pari
-            catena['fasce_pari'] = len(fasce) <= 1
+            # Flag fasce_pari salvato dal calcolo cicli; ricalcolato solo se assente
+            if catena.get('fasce_pari') is None:
+                catena['fasce_pari'] = calcola_fasce_pari(catena)
 
             catena['is_favorita'] = is_catena_preferita(request.user, catena)
             catena['json_data'] = json.dumps(catena, default=str)
@@ -1429,19 +1401,9 @@ def le_mie_catene(request):
 
         # Aggiungi flag per i preferiti, hash e fasce pari
         for catena in catene_alta_qualita + catene_generiche:
-            # Calcola se tutti gli annunci hanno la stessa fascia di prezzo
-            fasce = set()
-            for utente_info in catena.get('utenti', []):
-                # Raccogli le fasce da richiede e offerta
-                if utente_info.get('richiede') and hasattr(utente_info['richiede'], 'fascia_prezzo'):
-                    if utente_info['richiede'].fascia_prezzo:
-                        fasce.add(utente_info['richiede'].fascia_prezzo)
-                if utente_info.get('offerta') and hasattr(utente_info['offerta'], 'fascia_prezzo'):
-                    if utente_info['offerta'].fascia_prezzo:
-                        fasce.add(utente_info['offerta'].fascia_prezzo)
-
-            # Se c'è una sola fascia (o nessuna), gli scambi sono alla pari
-            catena['fasce_pari'] = len(fasce) <= 1
+            # Flag fasce_pari salvato dal calcolo cicli; ricalcolato solo se assente
+            if catena.get('fasce_pari') is None:
+                catena['fasce_pari'] = calcola_fasce_pari(catena)
 
             if request.user.is_authenticated:
                 catena['is_favorita'] = is_catena_preferita(request.user, catena)
@@ -1541,15 +1503,16 @@ def le_mie_catene(request):
 import hashlib
 import json
 
-def converti_ciclo_a_catena(ciclo):
+def converti_ciclo_a_catena(ciclo, annunci=None):
     """
     Converte un oggetto CicloScambio dal DB nel formato catena per il template
+    annunci: dict {id: Annuncio} già caricato per i titoli (vedi CicloScambio.annunci_dei_cicli)
     Returns: dict con struttura catena
     """
     from django.contrib.auth.models import User
 
-    # Estrai dettagli dal JSON
-    dettagli = ciclo.dettagli
+    # Estrai dettagli dal JSON (formato completo anche per i cicli compatti)
+    dettagli = ciclo.get_dettagli(annunci)
 
     # Costruisci la lista utenti con i loro annunci
     utenti_data = []
@@ -1567,11 +1530,20 @@ def converti_ciclo_a_catena(ciclo):
     catena = {
         'id_ciclo': ciclo.id,
         'utenti': utenti_data,
-        'punteggio_qualita': dettagli.get('punteggio_qualita', 0),
-        'categoria_qualita': dettagli.get('categoria_qualita', 'generica'),
+        # Attributi salvati dal calcolo cicli; None per i cicli salvati prima delle colonne
+        'punteggio_qualita': (
+            ciclo.punteggio_qualita if ciclo.punteggio_qualita is not None
+            else dettagli.get('punteggio_qualita', 0)
+        ),
+        'categoria_qualita': ciclo.categoria_qualita or dettagli.get('categoria_qualita', 'generica'),
         'tipo': 'scambio_diretto' if ciclo.lunghezza == 2 else 'catena_lunga',
-        'usa_sinonimi': dettagli.get('usa_sinonimi', False),
+        'usa_sinonimi': (
+            ciclo.usa_sinonimi if ciclo.usa_sinonimi is not None
+            else dettagli.get('usa_sinonimi', False)
+        ),
+        'ha_match_parziali': bool(ciclo.ha_match_parziali),
         'hash_catena': ciclo.hash_ciclo,
+        'fasce_pari': ciclo.fasce_pari,
     }
 
     return catena
@@ -2139,20 +2111,14 @@ def ricerca_annunci(request):
             ricerca_effettuata = True
             try:
                 user_profile = UserProfile.objects.get(user=request.user)
-                if user_profile.citta_obj:
-                    # Filtra annunci entro la distanza specificata
-                    from .models import DistanzaCitta
-                    annunci_filtrati = []
-                    for annuncio in annunci:
-                        try:
-                            annuncio_profile = annuncio.utente.userprofile
-                            if annuncio_profile.citta_obj:
-                                distanza = DistanzaCitta.get_distanza(user_profile.citta_obj, annuncio_profile.citta_obj)
-                                if distanza is not None and distanza <= distanza_max:
-                                    annunci_filtrati.append(annuncio.id)
-                        except UserProfile.DoesNotExist:
-                            pass
-                    annunci = annunci.filter(id__in=annunci_filtrati)
+                if user_profile.provincia_obj_id:
+                    # Filtra annunci entro la distanza specificata: province vicine
+                    # dalla matrice distanze, poi un solo filtro SQL
+                    from .geo_distance import get_matrice_distanze
+                    province_vicine = get_matrice_distanze().province_entro(
+                        user_profile.provincia_obj_id, distanza_max
+                    )
+                    annunci = annunci.filter(utente__userprofile__provincia_obj_id__in=province_vicine)
             except UserProfile.DoesNotExist:
                 pass
 
@@ -2519,8 +2485,9 @@ def api_cicli_utente(request, user_id):
         offset = int(request.GET.get('offset', 0))
 
         # Usa il metodo ottimizzato del model
-        cicli_queryset = CicloScambio.find_for_user(user_id, limit + offset)[offset:offset + limit]
-        cicli_data = [ciclo.to_dict() for ciclo in cicli_queryset]
+        cicli_queryset = list(CicloScambio.find_for_user(user_id, limit, offset))
+        annunci = CicloScambio.annunci_dei_cicli(cicli_queryset)
+        cicli_data = [ciclo.to_dict(annunci) for ciclo in cicli_queryset]
 
         # Statistiche totali
         cicli_totali = CicloScambio.objects.filter(valido=True).count()
@@ -3078,13 +3045,11 @@ def mie_proposte_catene(request):
 
         # Ottieni gli scambi dal campo dettagli del ciclo e costruisci il formato atteso dal template
         exchanges = []
-        if ciclo and ciclo.dettagli and 'scambi' in ciclo.dettagli:
+        if ciclo and ciclo.dettagli:
             from django.contrib.auth.models import User
+            from .dettagli_ciclo import passaggi
 
-            for scambio in ciclo.dettagli['scambi']:
-                da_user_id = scambio.get('da_user')
-                a_user_id = scambio.get('a_user')
-
+            for da_user_id, a_user_id, oggetti in passaggi(ciclo.dettagli):
                 # Ottieni gli utenti
                 try:
                     giver = User.objects.get(id=da_user_id)
@@ -3093,14 +3058,11 @@ def mie_proposte_catene(request):
                     continue
 
                 # Processa ogni oggetto scambiato
-                for oggetto in scambio.get('oggetti', []):
-                    offerto_data = oggetto.get('offerto', {})
-                    richiesto_data = oggetto.get('richiesto', {})
-
+                for offerto_id, richiesto_id, _tipo_match in oggetti:
                     # Ottieni gli annunci
                     try:
-                        giving_ad = Annuncio.objects.get(id=offerto_data.get('id'))
-                        receiving_ad = Annuncio.objects.get(id=richiesto_data.get('id'))
+                        giving_ad = Annuncio.objects.get(id=offerto_id)
+                        receiving_ad = Annuncio.objects.get(id=richiesto_id)
 
                         # Crea l'oggetto exchange nel formato atteso dal template
                         exchange = type('Exchange', (), {
@@ -10,6 +10,7 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'scambio_sito.settings')
 django.setup()
 
+from scambi.dettagli_ciclo import annunci_ids_dettagli
 from scambi.models import CicloScambio, Annuncio, UserProfile
 from django.contrib.auth.models import User
 from scambi.matching import converti_ciclo_db_a_view_format
@@ -46,15 +47,7 @@ print("\n👥 TEST CONVERSIONE CICLI PER UTENTE:")
 # Pre-carica annunci una volta sola
 annunci_ids = set()
 for ciclo_db in CicloScambio.objects.filter(valido=True):
-    dettagli = ciclo_db.dettagli
-    if 'scambi' in dettagli:
-        for scambio in dettagli['scambi']:
-            oggetti = scambio.get('oggetti', [])
-            for oggetto in oggetti:
-                if 'offerto' in oggetto and 'id' in oggetto['offerto']:
-                    annunci_ids.add(oggetto['offerto']['id'])
-                if 'richiesto' in oggetto and 'id' in oggetto['richiesto']:
-                    annunci_ids.add(oggetto['richiesto']['id'])
+    annunci_ids.update(annunci_ids_dettagli(ciclo_db.dettagli))
 
 annunci_dict = {a.id: a for a in Annuncio.objects.filter(id__in=annunci_ids)}
 print(f"📦 Pre-caricati {len(annunci_dict)} annunci")